@@ -1,210 +1,387 @@
+import json
+import logging
 import os
-import numpy as np
+import time
 import pandas as pd
-from flask import Flask, request, jsonify, send_from_directory, session, redirect
+from flask import Flask, Response, g, request, jsonify, send_file, send_from_directory, session, redirect
 from flask_cors import CORS
-from catboost import CatBoostClassifier
-import mysql.connector
 from mysql.connector import Error
-import bcrypt
 import re
+import sqlite3
 import uuid
+import base64
+import hmac
 from datetime import datetime
-
-app = Flask(__name__, static_folder='.', static_url_path='')
+from config import db_pool, get_db_connection
+from database import RESULT_COLUMNS, db as analysis_db
+from feature_engine import DERIVED_SIGNALS, live_feature_state
+from scoring import raw_columns, score_upload
+from prediction_cache import prediction_cache
+from micro_batch import micro_batcher
+from model_set import model_set
+from jobs import JobManager, JobQueueFull
+from ingestion import detect_format, feature_schema
+from result_store import ResultStoreWriter, open_results, records, results_size, store_filename
+from result_export import (COMPRESSION_GZIP, EXPORT_FORMATS, build_export, content_disposition, export_chunks,
+                           export_filename, export_path, save_while_streaming)
+from password_hashing import HashQueueFull, password_hasher
+from maintenance import storage_maintenance
+from static_assets import StaticAssetMiddleware, static_assets
+from reputation import reputation_index
+from metrics import http_request_seconds, registry as metrics_registry, stage
+
+# مستوى السجلات: DEBUG يعرض تفاصيل كل ملف مرفوع (الأعمدة، نسخة النموذج...)
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+logging.basicConfig(level=LOG_LEVEL, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+logger = logging.getLogger(__name__)
+
+# الملفات الثابتة تُخدم عبر static_assets (الصفحات العامة قبل Flask) وserve_static لباقيها
+app = Flask(__name__, static_folder=None)
+app.wsgi_app = StaticAssetMiddleware(app.wsgi_app, static_assets)
 CORS(app)
 app.secret_key = 'fraud_detection_secret_key_2025'
 
 UPLOAD_FOLDER = "uploads"
+# رمز Prometheus لـ /metrics (ترويسة Authorization: Bearer)؛ بدونه المسار معطل
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
 USER_DATA_FOLDER = "user_data"
+# أقصى عدد معاملات في طلب /api/score واحد
+MAX_SCORE_ROWS = 1000
+SCORE_TIMEOUT_SECONDS = 5
+# حجم صفحة نتائج التجربة الافتراضي والأقصى
+RESULTS_PAGE_SIZE = 50
+MAX_RESULTS_PAGE_SIZE = 500
+# عدد الصفوف المقروءة من مخزن النتائج في كل دفعة عند أرشفة التجربة في FraudDatabase
+ARCHIVE_CHUNK_ROWS = 500_000
+# المرشحات المسموحة في /api/experiments/<id>/results
+RESULT_FILTERS = ['predicted_fraud', 'type', 'branch', 'device']
+# المرشحات الرقمية تُحوَّل قبل الاستعلام (القيمة غير الرقمية خطأ 400)
+NUMERIC_RESULT_FILTERS = ['predicted_fraud']
+# حجم صفحة سجل التجارب الافتراضي والأقصى
+EXPERIMENTS_PAGE_SIZE = 20
+MAX_EXPERIMENTS_PAGE_SIZE = 100
+# عدد الأيام المعروضة في منحنى ملخص المستخدم
+SUMMARY_TREND_DAYS = 30
+# أعمدة سجل التجارب المعروضة (بدل SELECT *)
+EXPERIMENT_COLUMNS = ("id, filename, result_filename, total_count, fraud_count, fraud_rate, created_at, "
+                      "status, rows_processed, error")
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(USER_DATA_FOLDER, exist_ok=True)
 
-required_columns = ['user_id',
- 'transaction_date',
- 'type',
- 'amount',
- 'old_balance',
- 'new_balance',
- 'balance_mismatch',
- 'amount_spike',
- 'destination_account',
- 'new_destination',
- 'blacklisted_dest',
- 'source_account',
- 'branch',
- 'currency',
- 'device',
- 'device_change',
- 'ip',
- 'ip_unusual',
- 'location',
- 'odd_hour',
- 'velocity']
 # دوال قاعدة البيانات
-def get_db_connection():
-    try:
-        connection = mysql.connector.connect(
-            host='localhost',
-            database='fraud_users',
-            user='root',
-            password=''
-        )
-        return connection
-    except Error as e:
-        print(f"Error connecting to MySQL: {e}")
-        return None
-
 def validate_email(email):
     pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
     return re.match(pattern, email) is not None
 
+# التجزئة والتحقق يعملان على خيوط password_hasher المحدودة بدل خيط الطلب مباشرة
 def hash_password(password):
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    return password_hasher.hash(password)
 
 def check_password(password, hashed):
-    try:
-        return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
-    except (ValueError, Exception):
-        return password == hashed
+    return password_hasher.verify(password, hashed)
+
+def upgrade_password_hash(user_id, password, old_hash):
+    """ترقية كلمة مرور قديمة (نص صريح أو كلفة أقل) بعد تسجيل دخول ناجح"""
+    def save(new_hash):
+        connection = get_db_connection()
+        if connection:
+            try:
+                cursor = connection.cursor()
+                # الشرط على التجزئة القديمة حتى لا يُلغى تغيير كلمة مرور حدث في الأثناء
+                cursor.execute("UPDATE users SET pass = %s WHERE id = %s AND pass = %s",
+                               (new_hash, user_id, old_hash))
+                connection.commit()
+                logger.info("Upgraded password hash for user %s", user_id)
+            finally:
+                cursor.close()
+                connection.close()
 
-# دالة لتحويل كلمات المرور القديمة إلى مشفرة
-def migrate_passwords():
+    password_hasher.rehash_later(password, save)
+
+# إضافة أعمدة حالة المهام إلى جدول التجارب (مرة واحدة عند التشغيل)
+def migrate_experiments_table():
+    columns = [
+        "status VARCHAR(16) NOT NULL DEFAULT 'done'",
+        "rows_processed BIGINT NOT NULL DEFAULT 0",
+        "upload_path VARCHAR(512) NULL",
+        "error TEXT NULL",
+        "rollup MEDIUMTEXT NULL",
+        "result_bytes BIGINT NULL",
+    ]
+    indexes = {
+        # فهرس مركب لصفحات سجل المستخدم (keyset على created_at ثم id)
+        "idx_user_experiments_user_created": "(user_id, created_at, id)",
+        # حذف صفوف الضيوف المنتهية على دفعات بالأقدم أولاً
+        "idx_user_experiments_temporary_created": "(is_temporary, created_at)",
+    }
     connection = get_db_connection()
     if connection:
         try:
-            cursor = connection.cursor(dictionary=True)
-            cursor.execute("SELECT id, pass FROM users WHERE LENGTH(pass) < 60")
-            users = cursor.fetchall()
-            
-            for user in users:
-                if len(user['pass']) < 60:
-                    hashed = hash_password(user['pass'])
-                    cursor.execute("UPDATE users SET pass = %s WHERE id = %s", (hashed, user['id']))
-                    print(f"Updated password for user {user['id']}")
-            
+            cursor = connection.cursor()
+            for column in columns:
+                try:
+                    cursor.execute(f"ALTER TABLE user_experiments ADD COLUMN {column}")
+                    logger.info("Added column user_experiments.%s", column.split()[0])
+                except Error as e:
+                    # 1060: العمود موجود مسبقاً
+                    if e.errno != 1060:
+                        raise
+
+            for name, columns_spec in indexes.items():
+                try:
+                    cursor.execute(f"CREATE INDEX {name} ON user_experiments {columns_spec}")
+                    logger.info("Added index %s", name)
+                except Error as e:
+                    # 1061: الفهرس موجود مسبقاً
+                    if e.errno != 1061:
+                        raise
+
+            # ملخص تراكمي لكل مستخدم ولكل يوم يُحدَّث عند حفظ كل تجربة
+            cursor.execute(
+                """CREATE TABLE IF NOT EXISTS user_experiment_summary (
+                    user_id INT NOT NULL PRIMARY KEY,
+                    experiments INT NOT NULL DEFAULT 0,
+                    transactions BIGINT NOT NULL DEFAULT 0,
+                    fraud_count BIGINT NOT NULL DEFAULT 0,
+                    first_experiment_at DATETIME NULL,
+                    last_experiment_at DATETIME NULL
+                )"""
+            )
+            cursor.execute(
+                """CREATE TABLE IF NOT EXISTS user_experiment_daily (
+                    user_id INT NOT NULL,
+                    day DATE NOT NULL,
+                    experiments INT NOT NULL DEFAULT 0,
+                    transactions BIGINT NOT NULL DEFAULT 0,
+                    fraud_count BIGINT NOT NULL DEFAULT 0,
+                    PRIMARY KEY (user_id, day)
+                )"""
+            )
+            cursor.execute("SELECT COUNT(*) FROM user_experiment_summary")
+            if cursor.fetchone()[0] == 0:
+                _backfill_experiment_summary(cursor)
             connection.commit()
-            print("Password migration completed")
-            
         except Error as e:
-            print(f"Error migrating passwords: {e}")
+            logger.error("Error migrating experiments table: %s", e)
         finally:
             cursor.close()
             connection.close()
 
 # دوال إدارة تجارب المستخدم
-def save_user_experiment(user_id, filename, result_data, save_data=False):
-    """حفظ تجربة المستخدم في قاعدة البيانات"""
+def _backfill_experiment_summary(cursor):
+    """بناء الملخصات من التجارب الموجودة (مرة واحدة عند إنشاء الجداول)"""
+    saved = "user_id IS NOT NULL AND is_temporary = FALSE AND status = 'done'"
+    cursor.execute(
+        f"""INSERT INTO user_experiment_summary
+        (user_id, experiments, transactions, fraud_count, first_experiment_at, last_experiment_at)
+        SELECT user_id, COUNT(*), SUM(total_count), SUM(fraud_count), MIN(created_at), MAX(created_at)
+        FROM user_experiments WHERE {saved} GROUP BY user_id"""
+    )
+    cursor.execute(
+        f"""INSERT INTO user_experiment_daily (user_id, day, experiments, transactions, fraud_count)
+        SELECT user_id, DATE(created_at), COUNT(*), SUM(total_count), SUM(fraud_count)
+        FROM user_experiments WHERE {saved} GROUP BY user_id, DATE(created_at)"""
+    )
+    if cursor.rowcount:
+        logger.info("Backfilled experiment summaries")
+
+def _update_experiment_summary(cursor, user_id, experiment_id, result_data, now):
+    """تحديث الملخص التراكمي بفرق هذه التجربة فقط (آمن عند إعادة حفظ نفس التجربة)"""
+    cursor.execute(
+        "SELECT status, total_count, fraud_count, created_at FROM user_experiments WHERE id = %s FOR UPDATE",
+        (experiment_id,)
+    )
+    rows = cursor.fetchall()
+    previous = rows[0] if rows else None
+    already_counted = previous is not None and previous[0] == 'done'
+    experiments = 0 if already_counted else 1
+    transactions = result_data['total_count'] - (previous[1] if already_counted else 0)
+    fraud = result_data['fraud_count'] - (previous[2] if already_counted else 0)
+    created_at = previous[3] if previous is not None and previous[3] else now
+
+    cursor.execute(
+        """INSERT INTO user_experiment_summary
+        (user_id, experiments, transactions, fraud_count, first_experiment_at, last_experiment_at)
+        VALUES (%s, %s, %s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE experiments = experiments + VALUES(experiments),
+        transactions = transactions + VALUES(transactions), fraud_count = fraud_count + VALUES(fraud_count),
+        first_experiment_at = LEAST(COALESCE(first_experiment_at, VALUES(first_experiment_at)), VALUES(first_experiment_at)),
+        last_experiment_at = GREATEST(COALESCE(last_experiment_at, VALUES(last_experiment_at)), VALUES(last_experiment_at))""",
+        (user_id, experiments, transactions, fraud, created_at, created_at)
+    )
+    cursor.execute(
+        """INSERT INTO user_experiment_daily (user_id, day, experiments, transactions, fraud_count)
+        VALUES (%s, %s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE experiments = experiments + VALUES(experiments),
+        transactions = transactions + VALUES(transactions), fraud_count = fraud_count + VALUES(fraud_count)""",
+        (user_id, created_at.date(), experiments, transactions, fraud)
+    )
+
+def _fraud_rows(result_path, chunk_rows=ARCHIVE_CHUNK_ROWS):
+    """صفوف الاحتيال من مخزن نتائج التجربة على دفعات (مولّد يُقرأ في خيط FraudDatabase)"""
+    results = open_results(result_path)
+    columns = [c for c in RESULT_COLUMNS.values() if c in results.columns]
+    for start in range(0, len(results), chunk_rows):
+        chunk = results.read(start, start + chunk_rows, columns)
+        yield chunk[chunk['predicted_fraud'] == 1]
+
+def save_user_experiment(user_id, filename, result_data, save_data=False, experiment_id=None):
+    """حفظ تجربة المستخدم في قاعدة البيانات (أو إكمال صف مهمة موجودة)"""
     connection = get_db_connection()
     if connection:
         try:
             cursor = connection.cursor()
-            experiment_id = str(uuid.uuid4())
+            experiment_id = experiment_id or str(uuid.uuid4())
+            now = datetime.now()
+            # التجميعات حسب الأبعاد تُحفظ مع التجربة حتى تُرسم بدون قراءة النتائج
+            rollup = json.dumps(result_data['rollup']) if result_data.get('rollup') else None
             
             # حفظ البيانات إذا كان المستخدم مسجل
             if save_data and user_id:
-                # حفظ ملف النتائج
-                result_filename = f"{experiment_id}_results.csv"
+                # النتائج الكاملة تُكتب أثناء التقييم بالتنسيق العمودي
+                result_filename = store_filename(experiment_id)
                 result_path = os.path.join(USER_DATA_FOLDER, result_filename)
                 
-                # تحويل البيانات إلى CSV وحفظها
-                df = pd.DataFrame(result_data['data'])
-                df.to_csv(result_path, index=False)
+                if not os.path.isdir(result_path):
+                    # حفظ الصفوف المعروضة فقط إذا لم تُكتب النتائج مسبقاً
+                    writer = ResultStoreWriter(result_path)
+                    writer.append(pd.DataFrame(result_data['data']))
+                    writer.close()
+                # الحجم يُخزَّن مع التجربة لفرض حصة المستخدم بدون مسح المجلدات
+                result_bytes = results_size(result_path)
+
+                _update_experiment_summary(cursor, user_id, experiment_id, result_data, now)
                 
                 cursor.execute(
                     """INSERT INTO user_experiments 
-                    (id, user_id, filename, result_filename, total_count, fraud_count, fraud_rate, created_at) 
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)""",
+                    (id, user_id, filename, result_filename, total_count, fraud_count, fraud_rate, created_at,
+                     status, rows_processed, rollup, result_bytes) 
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, 'done', %s, %s, %s)
+                    ON DUPLICATE KEY UPDATE result_filename = VALUES(result_filename),
+                    total_count = VALUES(total_count), fraud_count = VALUES(fraud_count),
+                    fraud_rate = VALUES(fraud_rate), status = 'done', rows_processed = VALUES(rows_processed),
+                    rollup = VALUES(rollup), result_bytes = VALUES(result_bytes)""",
                     (experiment_id, user_id, filename, result_filename, 
                      result_data['total_count'], result_data['fraud_count'], 
-                     result_data['fraud_rate'], datetime.now())
+                     result_data['fraud_rate'], now, result_data['total_count'], rollup, result_bytes)
                 )
             else:
                 # تجربة بدون حفظ (للضيوف)
                 cursor.execute(
                     """INSERT INTO user_experiments 
-                    (id, user_id, filename, total_count, fraud_count, fraud_rate, created_at, is_temporary) 
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)""",
+                    (id, user_id, filename, total_count, fraud_count, fraud_rate, created_at, is_temporary,
+                     status, rows_processed, rollup) 
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, 'done', %s, %s)
+                    ON DUPLICATE KEY UPDATE total_count = VALUES(total_count),
+                    fraud_count = VALUES(fraud_count), fraud_rate = VALUES(fraud_rate),
+                    status = 'done', rows_processed = VALUES(rows_processed), rollup = VALUES(rollup)""",
                     (experiment_id, None, filename, 
                      result_data['total_count'], result_data['fraud_count'], 
-                     result_data['fraud_rate'], datetime.now(), True)
+                     result_data['fraud_rate'], datetime.now(), True, result_data['total_count'], rollup)
                 )
             
             connection.commit()
+            # ملخص التجربة (مع أعلى مبلغ احتيال والنوع الأكثر من التجميعات) وصفوف الاحتيال
+            # تُؤرشف في FraudDatabase في الخلفية
+            analysis_db.save_analysis_later({'session_id': experiment_id, 'file_name': filename}, result_data,
+                                            _fraud_rows(result_path) if save_data and user_id else [])
+            if save_data and user_id:
+                # أزواج التجربة تُضاف إلى ما سبق رؤيته في الخلفية (قراءة كل النتائج)
+                reputation_index.record_results_later(result_path)
             return experiment_id
             
         except Error as e:
-            print(f"Error saving experiment: {e}")
+            logger.error("Error saving experiment: %s", e)
             return None
         finally:
             cursor.close()
             connection.close()
     return None
 
-def get_user_experiments(user_id):
-    """جلب تجارب المستخدم"""
+def get_user_experiments(user_id, limit=EXPERIMENTS_PAGE_SIZE, before=None):
+    """صفحة من تجارب المستخدم (الأحدث أولاً) ومفتاح الصفحة التالية
+
+    before هو (created_at, id) لآخر تجربة في الصفحة السابقة؛ الاستعلام يتبع
+    الفهرس (user_id, created_at, id) بدل تخطي الصفوف بـ OFFSET.
+    """
+    connection = get_db_connection()
+    if connection:
+        try:
+            cursor = connection.cursor(dictionary=True)
+            query = f"SELECT {EXPERIMENT_COLUMNS} FROM user_experiments WHERE user_id = %s AND is_temporary = FALSE"
+            params = [user_id]
+            if before is not None:
+                query += " AND (created_at < %s OR (created_at = %s AND id < %s))"
+                params += [before[0], before[0], before[1]]
+            query += " ORDER BY created_at DESC, id DESC LIMIT %s"
+            params.append(limit + 1)
+            cursor.execute(query, params)
+            experiments = cursor.fetchall()
+            next_key = None
+            if len(experiments) > limit:
+                experiments = experiments[:limit]
+                next_key = (experiments[-1]['created_at'], experiments[-1]['id'])
+            return experiments, next_key
+        except Error as e:
+            logger.error("Error getting experiments: %s", e)
+            return [], None
+        finally:
+            cursor.close()
+            connection.close()
+    return [], None
+
+def get_experiment_summary(user_id, days=SUMMARY_TREND_DAYS):
+    """الملخص التراكمي للمستخدم وأرقام آخر الأيام (بدون تجميع السجل كاملاً)"""
     connection = get_db_connection()
     if connection:
         try:
             cursor = connection.cursor(dictionary=True)
+            cursor.execute("SELECT * FROM user_experiment_summary WHERE user_id = %s", (user_id,))
+            rows = cursor.fetchall()
+            summary = rows[0] if rows else {
+                "experiments": 0, "transactions": 0, "fraud_count": 0,
+                "first_experiment_at": None, "last_experiment_at": None,
+            }
+            summary.pop('user_id', None)
+            summary['fraud_rate'] = (round(summary['fraud_count'] / summary['transactions'] * 100, 2)
+                                     if summary['transactions'] else 0.0)
+
             cursor.execute(
-                "SELECT * FROM user_experiments WHERE user_id = %s AND is_temporary = FALSE ORDER BY created_at DESC",
-                (user_id,)
+                "SELECT day, experiments, transactions, fraud_count FROM user_experiment_daily "
+                "WHERE user_id = %s AND day >= CURDATE() - INTERVAL %s DAY ORDER BY day",
+                (user_id, days)
             )
-            experiments = cursor.fetchall()
-            return experiments
+            trend = [{
+                "day": row['day'].isoformat(),
+                "experiments": row['experiments'],
+                "transactions": row['transactions'],
+                "fraud_count": row['fraud_count'],
+                "fraud_rate": round(row['fraud_count'] / row['transactions'] * 100, 2) if row['transactions'] else 0.0,
+            } for row in cursor.fetchall()]
+            return {"summary": summary, "trend": trend}
         except Error as e:
-            print(f"Error getting experiments: {e}")
-            return []
+            logger.error("Error getting experiment summary: %s", e)
+            return None
         finally:
             cursor.close()
             connection.close()
-    return []
-
-# دوال تحضير البيانات
-def prepare_data(df):
-    print("Original columns:", df.columns.tolist())
-
-    missing = [c for c in required_columns if c not in df.columns]
-    if missing:
-        raise ValueError(f"Missing columns: {', '.join(missing)}")
-
-    # df["hour"] = pd.to_datetime(df["transaction_date"]).dt.hour
-    # df["dayofweek"] = pd.to_datetime(df["transaction_date"]).dt.dayofweek
-    # df = df.drop(columns=["transaction_date"], errors="ignore")
-
-    # df["balance_diff"] = df["old_balance"] - df["new_balance"]
-    # df["amount_ratio"] = df["amount"] / (df["old_balance"] + 1e-6)
-
-    final_columns = ['user_id',
- 'transaction_date',
- 'type',
- 'amount',
- 'old_balance',
- 'new_balance',
- 'balance_mismatch',
- 'amount_spike',
- 'destination_account',
- 'new_destination',
- 'blacklisted_dest',
- 'source_account',
- 'branch',
- 'currency',
- 'device',
- 'device_change',
- 'ip',
- 'ip_unusual',
- 'location',
- 'odd_hour',
- 'velocity']
-
-    print("✅ Final columns for model:", final_columns)
-    return df[final_columns]
+    return None
+
+def send_asset(name):
+    """صفحة أو أصل ثابت من الذاكرة (مضغوط مع ETag)، أو من القرص لباقي الملفات"""
+    asset = static_assets.get(name)
+    if asset is None:
+        return send_from_directory('.', name)
+    status, headers, body = asset.respond(request.environ)
+    return Response(body, status=status, headers=headers)
+
+# مهام التقييم في الخلفية
+job_manager = JobManager(save_user_experiment)
 
 # Routes الأساسية
 @app.route("/")
 def serve_home():
-    return send_from_directory('.', 'home.html')
+    return send_asset('home.html')
 
 @app.route("/login", methods=['GET', 'POST'])
 def login():
@@ -218,28 +395,36 @@ def login():
                 cursor = connection.cursor(dictionary=True)
                 cursor.execute("SELECT * FROM users WHERE email = %s", (email,))
                 user = cursor.fetchone()
-                
-                if user and check_password(password, user['pass']):
-                    session['user_id'] = user['id']
-                    session['first_name'] = user['first_name']
-                    session['email'] = user['email']
-                    return jsonify({"success": True, "message": "تم تسجيل الدخول بنجاح"})
-                else:
-                    return jsonify({"error": "البريد الإلكتروني أو كلمة المرور غير صحيحة"}), 401
-                    
             except Error as e:
-                print(f"Database error: {e}")
+                logger.error("Database error: %s", e)
                 return jsonify({"error": f"خطأ في قاعدة البيانات: {str(e)}"}), 500
-            except Exception as e:
-                print(f"Login error: {e}")
-                return jsonify({"error": f"خطأ في تسجيل الدخول: {str(e)}"}), 500
             finally:
                 cursor.close()
                 connection.close()
         else:
             return jsonify({"error": "خطأ في الاتصال بقاعدة البيانات"}), 500
+
+        # التحقق بعد إعادة الاتصال إلى المجمع: انتظار خيوط التجزئة لا يحجز اتصالاً
+        try:
+            valid = user is not None and check_password(password, user['pass'])
+        except HashQueueFull as e:
+            return jsonify({"error": str(e)}), 429
+        except TimeoutError:
+            return jsonify({"error": "Authentication is busy, try again later"}), 503
+        except Exception as e:
+            logger.error("Login error: %s", e)
+            return jsonify({"error": f"خطأ في تسجيل الدخول: {str(e)}"}), 500
+
+        if not valid:
+            return jsonify({"error": "البريد الإلكتروني أو كلمة المرور غير صحيحة"}), 401
+        if password_hasher.needs_rehash(user['pass']):
+            upgrade_password_hash(user['id'], password, user['pass'])
+        session['user_id'] = user['id']
+        session['first_name'] = user['first_name']
+        session['email'] = user['email']
+        return jsonify({"success": True, "message": "تم تسجيل الدخول بنجاح"})
     
-    return send_from_directory('.', 'login.html')
+    return send_asset('login.html')
 
 @app.route("/register", methods=['GET', 'POST'])
 def register():
@@ -255,6 +440,14 @@ def register():
         if len(password) < 6:
             return jsonify({"error": "كلمة المرور يجب أن تكون 6 أحرف على الأقل"}), 400
         
+        # التجزئة قبل أخذ اتصال من المجمع حتى لا يُحجز أثناء انتظار خيوطها
+        try:
+            hashed_password = hash_password(password)
+        except HashQueueFull as e:
+            return jsonify({"error": str(e)}), 429
+        except TimeoutError:
+            return jsonify({"error": "Authentication is busy, try again later"}), 503
+
         connection = get_db_connection()
         if connection:
             try:
@@ -264,7 +457,6 @@ def register():
                 if cursor.fetchone():
                     return jsonify({"error": "البريد الإلكتروني مسجل مسبقاً"}), 400
                 
-                hashed_password = hash_password(password)
                 username = f"{first_name}_{last_name}".lower()
                 
                 cursor.execute(
@@ -276,7 +468,7 @@ def register():
                 return jsonify({"success": True, "message": "تم إنشاء الحساب بنجاح"})
                 
             except Error as e:
-                print(f"Database error: {e}")
+                logger.error("Database error: %s", e)
                 return jsonify({"error": f"خطأ في قاعدة البيانات: {str(e)}"}), 500
             finally:
                 cursor.close()
@@ -284,7 +476,7 @@ def register():
         else:
             return jsonify({"error": "خطأ في الاتصال بقاعدة البيانات"}), 500
     
-    return send_from_directory('.', 'register.html')
+    return send_asset('register.html')
 
 @app.route("/logout")
 def logout():
@@ -296,21 +488,196 @@ def dashboard():
     if 'user_id' not in session:
         # السماح للضيوف بالدخول ولكن بدون حفظ البيانات
         session['guest'] = True
-    return send_from_directory('.', 'index.html')
+    return send_asset('index.html')
 
 @app.route("/my-experiments")
 def my_experiments():
     if 'user_id' not in session:
         return redirect('/login')
-    return send_from_directory('.', 'experiments.html')
+    return send_asset('experiments.html')
 
 @app.route("/api/experiments")
 def get_experiments():
     if 'user_id' not in session:
         return jsonify({"error": "يجب تسجيل الدخول"}), 401
     
-    experiments = get_user_experiments(session['user_id'])
-    return jsonify({"experiments": experiments})
+    try:
+        limit = min(max(int(request.args.get('limit', EXPERIMENTS_PAGE_SIZE)), 1), MAX_EXPERIMENTS_PAGE_SIZE)
+        before = _decode_keyset(request.args['cursor']) if request.args.get('cursor') else None
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    experiments, next_key = get_user_experiments(session['user_id'], limit, before)
+    return jsonify({
+        "experiments": experiments,
+        "next_cursor": _encode_keyset(*next_key) if next_key else None,
+    })
+
+@app.route("/api/experiments/summary")
+def experiments_summary():
+    """ملخص تجارب المستخدم ومنحنى آخر الأيام"""
+    if 'user_id' not in session:
+        return jsonify({"error": "يجب تسجيل الدخول"}), 401
+
+    summary = get_experiment_summary(session['user_id'])
+    if summary is None:
+        return jsonify({"error": "Summary unavailable"}), 503
+    return jsonify(summary)
+
+def get_user_experiment(user_id, experiment_id):
+    """جلب تجربة واحدة محفوظة تخص المستخدم"""
+    connection = get_db_connection()
+    if connection:
+        try:
+            cursor = connection.cursor(dictionary=True)
+            cursor.execute(
+                "SELECT * FROM user_experiments WHERE id = %s AND user_id = %s AND is_temporary = FALSE",
+                (experiment_id, user_id)
+            )
+            return cursor.fetchone()
+        except Error as e:
+            logger.error("Error getting experiment: %s", e)
+            return None
+        finally:
+            cursor.close()
+            connection.close()
+    return None
+
+def _encode_cursor(sort, position):
+    return base64.urlsafe_b64encode(f"{sort or ''}:{position}".encode()).decode()
+
+def _encode_keyset(created_at, experiment_id):
+    return base64.urlsafe_b64encode(f"{created_at.isoformat()}|{experiment_id}".encode()).decode()
+
+def _decode_keyset(cursor):
+    try:
+        created_at, experiment_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|', 1)
+        return datetime.fromisoformat(created_at), experiment_id
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError("Invalid cursor")
+
+def _decode_cursor(cursor, sort):
+    try:
+        cursor_sort, position = base64.urlsafe_b64decode(cursor.encode()).decode().rsplit(':', 1)
+        position = int(position)
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError("Invalid cursor")
+    if cursor_sort != (sort or '') or position < 0:
+        raise ValueError("Cursor does not match this query")
+    return position
+
+def _result_filters(args):
+    """مرشحات النتائج من معاملات الطلب مع تحويل الرقمية منها"""
+    filters = {}
+    for name in RESULT_FILTERS:
+        if name not in args:
+            continue
+        if name in NUMERIC_RESULT_FILTERS:
+            try:
+                filters[name] = float(args[name])
+            except ValueError:
+                raise ValueError(f"{name} must be a number") from None
+        else:
+            filters[name] = args[name]
+    return filters
+
+@app.route("/api/experiments/<experiment_id>/results")
+def experiment_results(experiment_id):
+    """صفحة من نتائج تجربة محفوظة مع التصفية والترتيب حسب احتمال الاحتيال"""
+    if 'user_id' not in session:
+        return jsonify({"error": "يجب تسجيل الدخول"}), 401
+
+    experiment = get_user_experiment(session['user_id'], experiment_id)
+    if not experiment or not experiment.get('result_filename'):
+        return jsonify({"error": "Experiment not found"}), 404
+
+    result_path = os.path.join(USER_DATA_FOLDER, experiment['result_filename'])
+    if not os.path.exists(result_path):
+        return jsonify({"error": "Experiment results are no longer available"}), 404
+
+    args = request.args
+    sort = 'fraud_probability' if args.get('sort', 'fraud_probability') == 'fraud_probability' else None
+    try:
+        limit = min(max(int(args.get('limit', RESULTS_PAGE_SIZE)), 1), MAX_RESULTS_PAGE_SIZE)
+        low = float(args['min_probability']) if 'min_probability' in args else None
+        high = float(args['max_probability']) if 'max_probability' in args else None
+        position = _decode_cursor(args['cursor'], sort) if 'cursor' in args else 0
+        filters = _result_filters(args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    results = open_results(result_path)
+    try:
+        page, next_position = results.query(filters, low=low, high=high, sort=sort,
+                                            position=position, limit=limit)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    rows = records(page)
+    explanations = results.attachment('explanations')
+    if explanations:
+        for row, record in zip(page.index, rows):
+            if str(row) in explanations:
+                record['explanation'] = explanations[str(row)]
+    return jsonify({
+        "experiment_id": experiment_id,
+        "total_rows": len(results),
+        "rows": rows,
+        "next_cursor": _encode_cursor(sort, next_position) if next_position is not None else None,
+    })
+
+@app.route("/api/experiments/<experiment_id>/rollup")
+def experiment_rollup(experiment_id):
+    """التجميعات المحفوظة مع التجربة (حسب النوع والفرع والجهاز والموقع والعملة والساعة)"""
+    if 'user_id' not in session:
+        return jsonify({"error": "يجب تسجيل الدخول"}), 401
+
+    experiment = get_user_experiment(session['user_id'], experiment_id)
+    if not experiment:
+        return jsonify({"error": "Experiment not found"}), 404
+    if not experiment.get('rollup'):
+        return jsonify({"error": "No breakdowns stored for this experiment"}), 404
+    return jsonify({"experiment_id": experiment_id, **json.loads(experiment['rollup'])})
+
+@app.route("/api/experiments/<experiment_id>/export")
+def export_experiment(experiment_id):
+    """تنزيل كل نتائج تجربة كـ CSV أو NDJSON (مع gzip اختيارياً) على أجزاء
+
+    أول تنزيل يُبث مباشرة ويُحفظ بجانب المخزن، وطلبات Range (الاستئناف)
+    تُخدم من النسخة المحفوظة.
+    """
+    if 'user_id' not in session:
+        return jsonify({"error": "يجب تسجيل الدخول"}), 401
+
+    fmt = request.args.get('format', 'csv')
+    compression = request.args.get('compression') or None
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({"error": f"Unsupported export format: {fmt}"}), 400
+    if compression not in (None, COMPRESSION_GZIP):
+        return jsonify({"error": f"Unsupported compression: {compression}"}), 400
+
+    experiment = get_user_experiment(session['user_id'], experiment_id)
+    if not experiment or not experiment.get('result_filename'):
+        return jsonify({"error": "Experiment not found"}), 404
+
+    result_path = os.path.join(USER_DATA_FOLDER, experiment['result_filename'])
+    if not os.path.exists(result_path):
+        return jsonify({"error": "Experiment results are no longer available"}), 404
+
+    download_name = export_filename(experiment['filename'], fmt, compression)
+    mimetype = 'application/gzip' if compression else EXPORT_FORMATS[fmt]
+    cached = export_path(result_path, fmt, compression)
+    if not os.path.exists(cached) and request.range is not None:
+        build_export(open_results(result_path), cached, fmt, compression)
+    if os.path.exists(cached):
+        # send_file يعالج Range وIf-Range وETag و304
+        return send_file(cached, mimetype=mimetype, as_attachment=True, download_name=download_name,
+                         conditional=True)
+
+    chunks = save_while_streaming(export_chunks(open_results(result_path), fmt, compression), cached)
+    response = Response(chunks, mimetype=mimetype)
+    response.headers.set('Content-Disposition', 'attachment', **content_disposition(download_name))
+    response.headers['Accept-Ranges'] = 'bytes'
+    return response
 
 @app.route("/predict", methods=["POST"])
 def predict_route():
@@ -324,88 +691,216 @@ def predict_route():
     if data_file.filename == '':
         return jsonify({"error": "No file selected"}), 400
 
-    if not (data_file.filename.endswith('.csv') or data_file.filename.endswith('.xlsx')):
-        return jsonify({"error": "Only CSV and Excel files are supported"}), 400
-
     # الحصول على خيار الحفظ من النموذج
     save_option = request.form.get('saveOption', 'guest')
     
     data_path = os.path.join(UPLOAD_FOLDER, data_file.filename)
-    data_file.save(data_path)
+    with stage('upload_save'):
+        data_file.save(data_path)
 
+    # الصيغة تُكتشف من المحتوى (CSV عادي أو مضغوط، Excel، Parquet، Arrow)
     try:
-        print(f"📂 Processing file: {data_path}")
-        if data_path.endswith(".csv"):
-            df = pd.read_csv(data_path)
+        detect_format(data_path)
+    except ValueError as e:
+        os.remove(data_path)
+        return jsonify({"error": str(e)}), 400
+
+    save_data = bool(session.get('user_id')) and save_option == 'save'
+    experiment_id = str(uuid.uuid4()) if save_data else None
+    # كل الصفوف المقيَّمة تُكتب في مخزن عمودي إذا اختار المستخدم الحفظ
+    store = ResultStoreWriter(os.path.join(USER_DATA_FOLDER, store_filename(experiment_id))) if save_data else None
+
+    try:
+        stream = request.form.get('mode') == 'stream' or None
+        response = {"success": True, **score_upload(data_path, stream=stream, store=store)}
+        response["filename"] = data_file.filename
+
+        # حفظ التجربة إذا كان المستخدم مسجل واختار الحفظ
+        if save_data:
+            with stage('persist'):
+                store.close()
+                store = None
+                response["experiment_id"] = experiment_id
+                save_user_experiment(
+                    session['user_id'], 
+                    data_file.filename, 
+                    response, 
+                    save_data=True,
+                    experiment_id=experiment_id
+                )
+            logger.debug("✅ Experiment saved to user account")
         else:
-            df = pd.read_excel(data_path)
+            # تجربة ضيف (لا تحفظ البيانات)
+            with stage('persist'):
+                save_user_experiment(
+                    None, 
+                    data_file.filename, 
+                    response, 
+                    save_data=False
+                )
+            logger.debug("✅ Guest experiment (not saved)")
 
-        print(f"✅ File loaded successfully with {len(df)} rows")
+        logger.debug("✅ Prediction complete: %s fraud cases out of %s", response['fraud_count'], response['total_count'])
+        with stage('serialize'):
+            return jsonify(response)
 
-        df_prepared = prepare_data(df.copy())
+    except Exception as e:
+        logger.exception("🔥 Error scoring upload: %s", e)
+        return jsonify({"error": str(e)}), 500
 
-        model = CatBoostClassifier()
-        model.load_model("fra_catboost_model.cbm")
-        print("🤖 Model loaded successfully.")
+    finally:
+        if store is not None:
+            store.abort()
+        if os.path.exists(data_path):
+            os.remove(data_path)
 
-        model_features = model.feature_names_
-        print("🧩 Model was trained on features:", model_features)
+@app.route("/api/score", methods=["POST"])
+def score_api():
+    """تقييم معاملة واحدة أو دفعة صغيرة بصيغة JSON"""
+    if 'user_id' not in session and 'guest' not in session:
+        return jsonify({"error": "يجب تسجيل الدخول أولاً"}), 401
 
-        for col in model_features:
-            if col not in df_prepared.columns:
-                df_prepared[col] = 0
+    payload = request.get_json(silent=True)
+    if isinstance(payload, dict):
+        payload = payload.get('transactions', payload.get('transaction', payload))
+    records = [payload] if isinstance(payload, dict) else payload
+
+    if not isinstance(records, list) or not records or not all(isinstance(r, dict) for r in records):
+        return jsonify({"error": "Expected a transaction object or a list of transactions"}), 400
+    if len(records) > MAX_SCORE_ROWS:
+        return jsonify({"error": f"At most {MAX_SCORE_ROWS} transactions per request"}), 400
+
+    for i, record in enumerate(records):
+        missing = [c for c in raw_columns if c not in record]
+        if missing:
+            return jsonify({"error": f"Transaction {i}: missing columns: {', '.join(missing)}"}), 400
+        # الأنواع تُتحقق لكل طلب قبل دمجه في دفعة مشتركة مع طلبات أخرى
+        try:
+            records[i] = feature_schema.coerce_record(record)
+        except ValueError as e:
+            return jsonify({"error": f"Transaction {i}: {e}"}), 400
 
-        df_prepared = df_prepared[model_features]
-        print("✅ Final aligned columns:", df_prepared.columns.tolist())
+    # الإشارات غير المرسلة تُحسب من تاريخ المستخدم في الحالة المشتركة
+    for i, record in enumerate(records):
+        try:
+            signals = live_feature_state.update(record)
+        except (TypeError, ValueError) as e:
+            return jsonify({"error": f"Transaction {i}: {e}"}), 400
+        except sqlite3.Error as e:
+            logger.error("Feature state unavailable: %s", e)
+            return jsonify({"error": "Scoring is busy, try again later"}), 503
+        for name in DERIVED_SIGNALS:
+            record.setdefault(name, signals[name])
 
-        preds = model.predict(df_prepared)
-        probas = model.predict_proba(df_prepared)[:, 1]
+    try:
+        results = micro_batcher.score(records, timeout=SCORE_TIMEOUT_SECONDS)
+    except Exception as e:
+        logger.error("Scoring error: %s", e)
+        return jsonify({"error": str(e)}), 500
 
-        df["predicted_fraud"] = preds
-        df["fraud_probability"] = np.round(probas * 100, 2)
+    return jsonify({"success": True, "results": results})
 
-        result_data = df.head(50).replace({np.nan: None}).to_dict(orient="records")
+@app.route("/api/score/stats")
+def score_stats():
+    return jsonify(micro_batcher.stats())
 
-        response = {
-            "success": True,
-            "total_count": len(df),
-            "fraud_count": int((df["predicted_fraud"] == 1).sum()),
-            "fraud_rate": round((df["predicted_fraud"] == 1).mean() * 100, 2),
-            "data": result_data,
-            "filename": data_file.filename
-        }
+@app.route("/api/jobs", methods=["POST"])
+def submit_job():
+    """رفع ملف للتقييم في الخلفية وإرجاع رقم المهمة فوراً"""
+    if 'user_id' not in session and 'guest' not in session:
+        return jsonify({"error": "يجب تسجيل الدخول أولاً"}), 401
 
-        # حفظ التجربة إذا كان المستخدم مسجل واختار الحفظ
-        if 'user_id' in session and session['user_id'] and save_option == 'save':
-            save_user_experiment(
-                session['user_id'], 
-                data_file.filename, 
-                response, 
-                save_data=True
-            )
-            print("✅ Experiment saved to user account")
-        else:
-            # تجربة ضيف (لا تحفظ البيانات)
-            save_user_experiment(
-                None, 
-                data_file.filename, 
-                response, 
-                save_data=False
-            )
-            print("✅ Guest experiment (not saved)")
+    if 'file' not in request.files:
+        return jsonify({"error": "Data file required"}), 400
 
-        print(f"✅ Prediction complete: {response['fraud_count']} fraud cases out of {response['total_count']}")
-        return jsonify(response)
+    data_file = request.files['file']
+    if data_file.filename == '':
+        return jsonify({"error": "No file selected"}), 400
 
-    except Exception as e:
-        import traceback
-        traceback.print_exc()
-        print("🔥 Error details:", str(e))
-        return jsonify({"error": str(e)}), 500
+    save_option = request.form.get('saveOption', 'guest')
+    user_id = session.get('user_id')
+    save_data = bool(user_id) and save_option == 'save'
 
-    finally:
-        if os.path.exists(data_path):
-            os.remove(data_path)
+    job_id = str(uuid.uuid4())
+    data_path = os.path.join(UPLOAD_FOLDER, f"{job_id}_{os.path.basename(data_file.filename)}")
+    data_file.save(data_path)
+
+    try:
+        detect_format(data_path)
+    except ValueError as e:
+        os.remove(data_path)
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        job = job_manager.submit(user_id if save_data else None, data_file.filename, data_path, save_data)
+    except JobQueueFull as e:
+        os.remove(data_path)
+        return jsonify({"error": str(e)}), 429
+
+    session.setdefault('jobs', [])
+    session['jobs'] = session['jobs'][-49:] + [job.id]
+    return jsonify({"success": True, "job_id": job.id, **job.to_dict()}), 202
+
+def _owned_job(job_id):
+    """التحقق من أن المهمة تخص المستخدم أو الضيف الحالي"""
+    found = job_manager.get(job_id)
+    if not found:
+        return None
+    owner, state = found
+    if owner is not None and owner == session.get('user_id'):
+        return state
+    if job_id in session.get('jobs', []):
+        return state
+    return None
+
+@app.route("/api/jobs/<job_id>")
+def job_status(job_id):
+    state = _owned_job(job_id)
+    if state is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(state)
+
+@app.route("/api/jobs/<job_id>/result")
+def job_result(job_id):
+    state = _owned_job(job_id)
+    if state is None:
+        return jsonify({"error": "Job not found"}), 404
+    if state['status'] == 'failed':
+        return jsonify({"error": state['error'] or "Job failed"}), 500
+    result = job_manager.result(job_id)
+    if result is None:
+        return jsonify({"error": "Job not finished", "status": state['status']}), 409
+    return jsonify(result)
+
+@app.route("/api/models")
+def models_stats():
+    """النماذج المحمّلة: زمن التقييم لكل نموذج واتفاق نماذج الظل مع الأساسي"""
+    return jsonify(model_set.stats())
+
+@app.route("/api/cache/stats")
+def cache_stats():
+    """إحصائيات ذاكرة نتائج التقييم"""
+    return jsonify(prediction_cache.stats())
+
+@app.route("/metrics")
+def metrics_endpoint():
+    """المقاييس بصيغة Prometheus"""
+    return Response(metrics_registry.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route("/api/db/pool")
+def db_pool_stats():
+    """مقاييس مجمع اتصالات قاعدة البيانات"""
+    return jsonify(db_pool.stats())
+
+@app.route("/api/reputation/stats")
+def reputation_stats():
+    """أحجام القائمة السوداء وفهرس ما سبق رؤيته ونسخة ملف القائمة"""
+    return jsonify(reputation_index.stats())
+
+@app.route("/api/storage/stats")
+def storage_stats():
+    """نتيجة آخر دورة صيانة للتخزين في هذه العملية"""
+    return jsonify(storage_maintenance.stats())
 
 # أضف هذا الroute في app.py
 @app.route("/api/auth-status")
@@ -422,25 +917,58 @@ def auth_status():
 # Routes للملفات الثابتة
 @app.route('/<path:path>')
 def serve_static(path):
-    return send_from_directory('.', path)
+    return send_asset(path)
 
 
 # Middleware للتحقق من تسجيل الدخول
 @app.before_request
 def check_auth():
     public_routes = ['/', '/login', '/register', 'home.html', 'login.html', 'register.html', 'static']
-    
+
+    if request.path == '/metrics':
+        # المقاييس للمراقبة الداخلية فقط: رمز ثابت بدل جلسة مستخدم
+        if not METRICS_TOKEN:
+            return jsonify({"error": "Not found"}), 404
+        supplied = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(supplied.encode(), f"Bearer {METRICS_TOKEN}".encode()):
+            return jsonify({"error": "Unauthorized"}), 401, {'WWW-Authenticate': 'Bearer'}
+        return
+
     if request.path in public_routes or request.path.startswith('/static'):
         return
     
     if 'user_id' not in session and 'guest' not in session:
         return redirect('/login')
 
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_time(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        # المسار المسجَّل (وليس الرابط الفعلي) حتى لا تتضخم قيم الوسوم
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        http_request_seconds.observe(time.perf_counter() - started, endpoint=endpoint,
+                                     method=request.method, status=response.status_code)
+    return response
+
 if __name__ == "__main__":
-    print("🚀 Starting Fraud Detection Server...")
-    
-    # تحويل كلمات المرور القديمة إلى مشفرة
-    print("🔄 Migrating passwords...")
-    migrate_passwords()
+    logger.info("🚀 Starting Fraud Detection Server...")
+
+    # تحميل كل النماذج مرة واحدة قبل استقبال الطلبات (التوجيه لا يحمّل داخل طلب)
+    model_set.load()
+    # ضغط الصفحات مسبقاً (gzip/brotli) قبل أول طلب
+    static_assets.load()
+    reputation_index.load()
+
+    migrate_experiments_table()
+    # استئناف المهام التي انقطعت قبل إعادة التشغيل
+    job_manager.recover()
+    # حذف النتائج والملفات المنتهية وضغط القديمة في الخلفية
+    storage_maintenance.start()
+    # كلمات المرور القديمة تُرقّى عند أول تسجيل دخول ناجح (upgrade_password_hash)
     
+    # خادم التطوير؛ للإنتاج بعدة عمليات: python serve.py
     app.run(debug=True, host='0.0.0.0', port=5000)
@@ -0,0 +1,43 @@
+"""منحنى تسريع التقييم المتوازي مقابل عدد الأنوية
+
+python -m benchmarks.parallel_scoring --rows 1000000
+"""
+import argparse
+import os
+import time
+
+from benchmarks.synthetic import generate_transactions
+from ingestion import feature_schema
+from model_registry import model_registry
+from scoring import predict_probas, prepare_data
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=500_000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--thread-count', type=int, default=1)
+    args = parser.parse_args()
+
+    cores = os.cpu_count() or 1
+    worker_counts = sorted({1, *[2 ** i for i in range(1, cores.bit_length()) if 2 ** i <= cores], cores})
+
+    loaded = model_registry.get()
+    df = feature_schema.cast(generate_transactions(args.rows))
+    features = loaded.align(prepare_data(df))
+
+    baseline = None
+    print(f"{'workers':>8} {'seconds':>9} {'rows/s':>12} {'speedup':>8}")
+    for workers in worker_counts:
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            predict_probas(features, loaded, workers=workers, thread_count=args.thread_count)
+            timings.append(time.perf_counter() - start)
+        best = min(timings)
+        baseline = baseline or best
+        print(f"{workers:>8} {best:>9.3f} {args.rows / best:>12,.0f} {baseline / best:>8.2f}")
+
+
+if __name__ == '__main__':
+    main()
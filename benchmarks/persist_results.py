@@ -0,0 +1,47 @@
+"""سرعة حفظ نتائج تحليل كبير في FraudDatabase (صف/ثانية)
+
+python -m benchmarks.persist_results --rows 1000000
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks.synthetic import generate_transactions
+from database import FraudDatabase
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    df = generate_transactions(args.rows)
+    rng = np.random.default_rng(0)
+    df['fraud_probability'] = np.round(rng.random(args.rows) * 100, 2)
+    df['predicted_fraud'] = (df['fraud_probability'] > 50).astype('int8')
+    summary = {
+        'total_count': args.rows,
+        'fraud_count': int(df['predicted_fraud'].sum()),
+        'fraud_rate': round(float(df['predicted_fraud'].mean()) * 100, 2),
+    }
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = FraudDatabase(os.path.join(tmp, 'bench.db'))
+        start = time.perf_counter()
+        analysis_id = db.save_analysis({'session_id': 'bench', 'file_name': 'synthetic.csv'}, summary, df)
+        elapsed = time.perf_counter() - start
+
+        start = time.perf_counter()
+        fetched = db.get_analysis_results(analysis_id, limit=args.rows)
+        read_elapsed = time.perf_counter() - start
+        db.close()
+
+    print(f"persisted {args.rows:,} rows in {elapsed:.2f}s ({args.rows / elapsed:,.0f} rows/s)")
+    print(f"read back {len(fetched):,} rows in {read_elapsed:.2f}s")
+
+
+if __name__ == '__main__':
+    main()
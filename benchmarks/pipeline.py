@@ -0,0 +1,323 @@
+"""قياس مراحل مسار /predict على أحجام مختلفة ومقارنتها بخط أساس محفوظ
+
+القياس يستدعي scoring.score_file نفسه (بدون ذاكرة النتائج) ويقرأ زمن كل
+مرحلة من fraud_stage_seconds، فأي مرحلة جديدة في المسار الحقيقي تظهر هنا
+بدون تعديل. إضافة مرحلة أو تغيير المسار يتطلب إعادة إنشاء خط الأساس في نفس
+التغيير.
+
+python -m benchmarks.pipeline --sizes 1000,100000,1000000,10000000
+python -m benchmarks.pipeline --save-baseline
+
+كل حجم يُقاس في عملية مستقلة حتى تكون ذروة الذاكرة (RSS) وزمن تحميل
+النموذج خاصة به. ينتهي التشغيل برمز 1 إذا تراجع أي حجم عن خط الأساس
+بأكثر من النسبة المسموحة. خط الأساس يعتمد على الجهاز، لذا يُعاد إنشاؤه
+بـ --save-baseline عند تغيير جهاز القياس.
+
+مرحلة persist (save_user_experiment) تُقاس فقط مع قاعدة بيانات متاحة؛
+بدونها تُسجَّل في 'unmeasured' ويطبع التقرير أنها لم تُفحص. خط الأساس
+المحفوظ حالياً سُجّل بدون قاعدة بيانات، فيُعاد إنشاؤه على جهاز تتوفر فيه.
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks.synthetic import generate_transactions
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'baseline.json')
+DEFAULT_SIZES = [1_000, 100_000, 1_000_000, 10_000_000]
+# مراحل المسار بالترتيب الذي تحدث به في /predict؛ كلها عدا model_load وpersist تسجلها score_file
+# (explain يعمل على خيوط موازية، لذا الإجمالي زمن فعلي وليس مجموع المراحل)
+STAGES = ['model_load', 'parse', 'prepare', 'align', 'predict', 'explain', 'explain_wait', 'rollup', 'store',
+          'serialize', 'persist']
+# يُولَّد الملف على أجزاء حتى لا يعتمد استهلاك الذاكرة على حجمه
+GENERATE_CHUNK_ROWS = 1_000_000
+# التراجع المسموح قبل اعتبار القياس فاشلاً
+DEFAULT_TOLERANCE = 0.25
+# فروق زمنية أصغر من هذا تُعتبر ضجيجاً في المراحل القصيرة
+MIN_REGRESSION_SECONDS = 0.005
+
+
+def default_repeat(rows):
+    """عدد التكرارات: أكثر للأحجام الصغيرة حتى تكون النسب المئوية ذات معنى"""
+    return int(min(50, max(3, 1_000_000 // rows)))
+
+
+def write_dataset(path, n_rows, seed=42, derive=False):
+    """كتابة ملف CSV صناعي على أجزاء (التواريخ بالنانوثانية كما يقرؤها النموذج)"""
+    from feature_engine import DERIVED_SIGNALS
+
+    tmp_path = path + '.tmp'
+    for i, start in enumerate(range(0, n_rows, GENERATE_CHUNK_ROWS)):
+        df = generate_transactions(min(GENERATE_CHUNK_ROWS, n_rows - start), seed=seed + i)
+        df['transaction_date'] = df['transaction_date'].to_numpy('datetime64[ns]').view('int64')
+        if derive:
+            df = df.drop(columns=DERIVED_SIGNALS)
+        df.to_csv(tmp_path, mode='w' if i == 0 else 'a', header=i == 0, index=False)
+    os.replace(tmp_path, path)
+    return path
+
+
+def percentiles(values):
+    values = np.asarray(values, dtype=np.float64)
+    return {
+        'p50': float(np.percentile(values, 50)),
+        'p95': float(np.percentile(values, 95)),
+        'p99': float(np.percentile(values, 99)),
+        'max': float(values.max()),
+    }
+
+
+def run_pipeline(path, store_dir, save_experiment=None):
+    """تشغيل واحد لمسار /predict حول scoring.score_file: (زمن كل مرحلة، الزمن الكلي) بالثواني"""
+    from metrics import stage_seconds
+    from model_registry import ModelRegistry
+    from result_store import ResultStoreWriter
+    from scoring import score_file
+
+    timings = dict.fromkeys(STAGES, 0.0)
+    started = time.perf_counter()
+    loaded = ModelRegistry().get()
+    timings['model_load'] = time.perf_counter() - started
+
+    before = stage_seconds.totals()
+    store = ResultStoreWriter(os.path.join(store_dir, 'bench_results'))
+    response = {"success": True, **score_file(path, store=store, loaded=loaded)}
+    response["filename"] = os.path.basename(path)
+    with stage_seconds.time(stage='store'):
+        store.close()
+    with stage_seconds.time(stage='serialize'):
+        json.dumps(response, default=str)
+    if save_experiment is None:
+        timings['persist'] = None
+    else:
+        with stage_seconds.time(stage='persist'):
+            save_experiment(None, response['filename'], response, save_data=False)
+
+    for (name,), seconds in stage_seconds.totals().items():
+        delta = seconds - before.get((name,), 0.0)
+        if delta and timings.get(name, 0.0) is not None:
+            timings[name] = timings.get(name, 0.0) + delta
+    return timings, time.perf_counter() - started
+
+
+def _experiment_saver():
+    """save_user_experiment من التطبيق إذا كانت قاعدة البيانات متاحة، وإلا None"""
+    from config import get_db_connection
+
+    connection = get_db_connection()
+    if connection is None:
+        return None
+    connection.close()
+    from app import save_user_experiment
+    return save_user_experiment
+
+
+def stage_names(runs):
+    """STAGES بترتيبها ثم أي مرحلة جديدة سجلتها score_file"""
+    extra = sorted({name for run in runs for name in run} - set(STAGES))
+    return STAGES + extra
+
+
+def baseline_key(result):
+    return f"{result['rows']}_raw" if result.get('derive') else str(result['rows'])
+
+
+def measure(path, rows, repeat):
+    """قياس حجم واحد داخل العملية الحالية"""
+    save_experiment = _experiment_saver()
+    runs = []
+    totals = []
+    with tempfile.TemporaryDirectory() as store_dir:
+        for _ in range(repeat):
+            timings, seconds = run_pipeline(path, store_dir, save_experiment)
+            runs.append(timings)
+            totals.append(seconds)
+
+    stages = {}
+    for name in stage_names(runs):
+        values = [run[name] for run in runs if run.get(name) is not None]
+        stages[name] = percentiles(values) if values else None
+
+    total = percentiles(totals)
+    return {
+        'rows': rows,
+        'repeat': repeat,
+        'total': total,
+        'throughput_rows_per_s': rows / total['p50'] if total['p50'] else None,
+        'stages': stages,
+        # مراحل لم تُقس في هذا التشغيل (persist بدون قاعدة بيانات) فلا تُفحص مقابلها التراجعات
+        'unmeasured': [name for name, stats in stages.items() if stats is None],
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def run_size(rows, data_dir, repeat, derive=False):
+    """توليد البيانات (مرة واحدة) ثم القياس في عملية فرعية جديدة"""
+    suffix = '_raw' if derive else ''
+    path = os.path.join(data_dir, f'synthetic_{rows}{suffix}.csv')
+    if not os.path.exists(path):
+        print(f"generating {rows:,} rows -> {path}", flush=True)
+        write_dataset(path, rows, derive=derive)
+
+    with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as f:
+        output = f.name
+    try:
+        subprocess.run(
+            [sys.executable, '-m', 'benchmarks.pipeline', '--worker', path,
+             '--rows', str(rows), '--repeat', str(repeat), '--output', output],
+            check=True, stdout=subprocess.DEVNULL,
+        )
+        with open(output) as f:
+            result = json.load(f)
+        result['derive'] = derive
+        return result
+    finally:
+        os.remove(output)
+
+
+def compare(results, baseline, tolerance):
+    """قائمة التراجعات مقارنة بخط الأساس (فارغة إذا لم يوجد تراجع)"""
+    regressions = []
+    for result in results:
+        base = baseline.get(baseline_key(result))
+        if base is None:
+            continue
+        label = f"{result['rows']:,} rows"
+        missing = sorted(set(result['stages']) ^ set(base['stages']))
+        if missing:
+            # خط أساس لمسار مختلف: مقارنة الإجمالي لا معنى لها حتى يُعاد إنشاؤه
+            regressions.append(f"{label}: baseline stages differ ({', '.join(missing)}); "
+                               f"re-run with --save-baseline")
+            continue
+
+        if base['throughput_rows_per_s'] and result['throughput_rows_per_s'] < \
+                base['throughput_rows_per_s'] * (1 - tolerance):
+            regressions.append(f"{label}: throughput {result['throughput_rows_per_s']:,.0f} rows/s "
+                               f"< baseline {base['throughput_rows_per_s']:,.0f}")
+
+        for name in result['stages']:
+            current, previous = result['stages'].get(name), base['stages'].get(name)
+            if current is None or previous is None:
+                continue
+            limit = max(previous['p50'] * (1 + tolerance), previous['p50'] + MIN_REGRESSION_SECONDS)
+            if current['p50'] > limit:
+                regressions.append(f"{label}: {name} p50 {current['p50']:.4f}s > baseline {previous['p50']:.4f}s")
+
+        if result['peak_rss_mb'] > base['peak_rss_mb'] * (1 + tolerance):
+            regressions.append(f"{label}: peak RSS {result['peak_rss_mb']:.0f}MB > baseline {base['peak_rss_mb']:.0f}MB")
+    return regressions
+
+
+def unmeasured(result):
+    return result.get('unmeasured', [name for name, stats in result['stages'].items() if stats is None])
+
+
+def unchecked(results, baseline):
+    """المراحل التي لا تُفحص لأنها لم تُقس في التشغيل الحالي أو في خط الأساس"""
+    notes = []
+    for result in results:
+        base = baseline.get(baseline_key(result)) if baseline else None
+        label = f"{result['rows']:,} rows"
+        for name in unmeasured(result):
+            notes.append(f"{label}: {name} not measured in this run")
+        for name in (unmeasured(base) if base else []):
+            if name not in unmeasured(result):
+                notes.append(f"{label}: {name} not measured in the baseline; re-run with --save-baseline "
+                             f"where it can be measured")
+    return notes
+
+
+def print_report(results):
+    print(f"{'rows':>11} {'p50 s':>9} {'p95 s':>9} {'p99 s':>9} {'rows/s':>12} {'RSS MB':>8}")
+    for r in results:
+        total = r['total']
+        print(f"{r['rows']:>11,} {total['p50']:>9.3f} {total['p95']:>9.3f} {total['p99']:>9.3f} "
+              f"{r['throughput_rows_per_s']:>12,.0f} {r['peak_rss_mb']:>8.0f}")
+
+    print()
+    names = stage_names([r['stages'] for r in results])
+    print(f"{'rows':>11} " + ' '.join(f"{name[:12]:>12}" for name in names) + "   (p50 seconds)")
+    for r in results:
+        cells = []
+        for name in names:
+            stats = r['stages'].get(name)
+            cells.append(f"{stats['p50']:>12.4f}" if stats else f"{'n/a':>12}")
+        print(f"{r['rows']:>11,} " + ' '.join(cells))
+    if any(unmeasured(r) for r in results):
+        print("n/a = not measured (persist needs a reachable database; without one save_user_experiment "
+              "is not regression-checked)")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default=','.join(str(s) for s in DEFAULT_SIZES),
+                        help='comma separated row counts')
+    parser.add_argument('--repeat', type=int, default=None, help='runs per size (default depends on size)')
+    parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'fraud_benchmarks'))
+    parser.add_argument('--derive', action='store_true', help='omit derived signals so prepare_data computes them')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument('--output', help='write the results as JSON')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    parser.add_argument('--rows', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        result = measure(args.worker, args.rows, args.repeat)
+        with open(args.output, 'w') as f:
+            json.dump(result, f)
+        return 0
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    sizes = [int(s) for s in args.sizes.split(',') if s]
+    results = [run_size(rows, args.data_dir, args.repeat or default_repeat(rows), args.derive) for rows in sizes]
+    print_report(results)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.save_baseline:
+        for line in unchecked(results, None):
+            print(f"WARNING: {line}; the baseline will not cover it")
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        baseline.update({baseline_key(r): r for r in results})
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print(f"\nbaseline saved to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"\nno baseline at {args.baseline}; run with --save-baseline first")
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance)
+    notes = unchecked(results, baseline)
+    if notes:
+        print("\nNOT CHECKED:")
+        for line in notes:
+            print(f"  {line}")
+    if regressions:
+        print("\nREGRESSIONS:")
+        for line in regressions:
+            print(f"  {line}")
+        return 1
+    print("\nno regressions against baseline")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,66 @@
+"""مطابقة الإشارات المشتقة في الخادم مع الإشارات المرسلة في ملفات موسومة
+
+python -m benchmarks.signals
+python -m benchmarks.signals user_data/*.csv --min-agreement 0.9
+
+كل ملف يحتوي أعمدة DERIVED_SIGNALS تُعاد إشاراته بـ derive_signals وتُقارن
+بالقيم المرسلة. ينتهي التشغيل برمز 1 إذا قلّت نسبة الاتفاق الإجمالية لأي
+إشارة عن الحد، فتغيير تعريف إشارة أو ثوابتها في feature_engine يُفحص هنا.
+"""
+import argparse
+import glob
+import os
+import sys
+
+import pandas as pd
+
+from feature_engine import DERIVED_SIGNALS, derive_signals
+
+DEFAULT_PATTERN = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'user_data', '*.csv')
+# أقل نسبة اتفاق مقبولة لكل إشارة على كل الملفات
+DEFAULT_MIN_AGREEMENT = 0.85
+
+
+def agreement(df):
+    """نسبة تطابق كل إشارة مشتقة مع المرسلة في ملف واحد: {الإشارة: (متطابق، الكل)}"""
+    derived = derive_signals(df, overwrite=True)
+    return {name: (int((derived[name].to_numpy() == df[name].to_numpy()).sum()), len(df))
+            for name in DERIVED_SIGNALS}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('paths', nargs='*', help=f'labelled CSV files (default {DEFAULT_PATTERN})')
+    parser.add_argument('--min-agreement', type=float, default=DEFAULT_MIN_AGREEMENT)
+    args = parser.parse_args()
+
+    paths = args.paths or sorted(glob.glob(DEFAULT_PATTERN))
+    totals = {name: [0, 0] for name in DERIVED_SIGNALS}
+    print(f"{'file':>40}" + ''.join(f'{name:>18}' for name in DERIVED_SIGNALS))
+    for path in paths:
+        df = pd.read_csv(path)
+        if any(name not in df.columns for name in DERIVED_SIGNALS):
+            print(f'{os.path.basename(path)[:40]:>40}  skipped (no supplied signals)')
+            continue
+        counts = agreement(df)
+        for name, (matched, rows) in counts.items():
+            totals[name][0] += matched
+            totals[name][1] += rows
+        print(f'{os.path.basename(path)[:40]:>40}'
+              + ''.join(f'{matched / rows:>18.3f}' for matched, rows in counts.values()))
+
+    if not any(rows for _, rows in totals.values()):
+        print('no labelled files found')
+        return 1
+    overall = {name: matched / rows for name, (matched, rows) in totals.items()}
+    print(f"{'all files':>40}" + ''.join(f'{value:>18.3f}' for value in overall.values()))
+
+    failed = [name for name, value in overall.items() if value < args.min_agreement]
+    if failed:
+        print(f'\nagreement below {args.min_agreement:.0%}: {", ".join(failed)}')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,32 @@
+import numpy as np
+import pandas as pd
+
+from ingestion import feature_schema
+
+FLAG_RATE = 0.05
+
+
+def generate_transactions(n_rows, seed=42, schema=feature_schema):
+    """توليد معاملات عشوائية تتبع مخطط features.json وقيم الفئات المعروفة"""
+    rng = np.random.default_rng(seed)
+    data = {}
+    for col in schema.all_features:
+        if col in schema.cat_values:
+            data[col] = rng.choice(schema.cat_values[col], n_rows)
+        elif col == 'transaction_date':
+            start = np.datetime64('2025-01-01T00:00:00')
+            seconds = rng.integers(0, 180 * 24 * 3600, n_rows).astype('timedelta64[s]')
+            data[col] = (start + seconds).astype('datetime64[ns]')
+        elif col == 'amount':
+            data[col] = rng.lognormal(6, 1.2, n_rows).round(2)
+        elif col == 'old_balance':
+            data[col] = rng.lognormal(9, 1.0, n_rows).round(2)
+        elif col == 'new_balance':
+            data[col] = None
+        else:
+            data[col] = (rng.random(n_rows) < FLAG_RATE).astype('int8')
+
+    df = pd.DataFrame(data)
+    if 'new_balance' in df.columns:
+        df['new_balance'] = (df['old_balance'] - df['amount']).round(2)
+    return df
@@ -1,16 +1,231 @@
 # config.py
+import logging
+import os
+import threading
+import time
+from collections import deque
+
 import mysql.connector
 from mysql.connector import Error
 
+from metrics import Gauge, db_pool_wait_seconds, db_query_seconds, registry
+
+logger = logging.getLogger(__name__)
+
+DB_CONFIG = {
+    'host': 'localhost',
+    'database': 'fraud_users',
+    'user': 'root',
+    'password': '',
+}
+
+# أقصى عدد اتصالات مفتوحة لكل عملية
+DB_POOL_SIZE = 10
+# أقصى انتظار لاتصال متاح قبل إرجاع خطأ
+DB_POOL_TIMEOUT_SECONDS = 5
+# الاتصالات الخاملة أكثر من هذه المدة تُفحص قبل إعادة استخدامها
+DB_HEALTH_CHECK_SECONDS = 30
+
+
+class PoolTimeout(Error):
+    pass
+
+
+def _operation(statement):
+    """نوع الاستعلام (SELECT, INSERT, ...) كوسم لمقياس الزمن"""
+    words = str(statement).split(None, 1)
+    return words[0].upper() if words else 'UNKNOWN'
+
+
+class TimedCursor:
+    """غلاف للمؤشر يسجل زمن كل استعلام في fraud_db_query_seconds"""
+
+    def __init__(self, raw):
+        self._raw = raw
+
+    def execute(self, operation, *args, **kwargs):
+        with db_query_seconds.time(operation=_operation(operation)):
+            return self._raw.execute(operation, *args, **kwargs)
+
+    def executemany(self, operation, *args, **kwargs):
+        with db_query_seconds.time(operation=_operation(operation)):
+            return self._raw.executemany(operation, *args, **kwargs)
+
+    def __iter__(self):
+        return iter(self._raw)
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+
+class PooledConnection:
+    """غلاف للاتصال: close() يعيده إلى المجمع بدل إغلاقه"""
+
+    def __init__(self, pool, raw):
+        self._pool = pool
+        self._raw = raw
+
+    def cursor(self, *args, **kwargs):
+        return TimedCursor(self.__getattr__('cursor')(*args, **kwargs))
+
+    def commit(self):
+        with db_query_seconds.time(operation='COMMIT'):
+            return self.__getattr__('commit')()
+
+    def close(self):
+        if self._raw is not None:
+            raw, self._raw = self._raw, None
+            self._pool.release(raw)
+
+    def __getattr__(self, name):
+        if self._raw is None:
+            raise Error("Connection already returned to the pool")
+        return getattr(self._raw, name)
+
+
+class ConnectionPool:
+    """مجمع اتصالات MySQL محدود الحجم مع فحص صحة ومقاييس استخدام"""
+
+    def __init__(self, size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT_SECONDS,
+                 health_check_seconds=DB_HEALTH_CHECK_SECONDS, **connect_args):
+        self.size = size
+        self.timeout = timeout
+        self.health_check_seconds = health_check_seconds
+        self.connect_args = connect_args or DB_CONFIG
+        self._cond = threading.Condition()
+        self._reset_state()
+
+    def _reset_state(self):
+        self._pid = os.getpid()
+        self._idle = deque()
+        self._open = 0
+        self.in_use = 0
+        self.created = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.health_check_failures = 0
+
+    def _check_fork(self):
+        # الاتصالات لا تُشارك بين العمليات بعد fork
+        if os.getpid() != self._pid:
+            self._reset_state()
+
+    def _healthy(self, raw, idle_since):
+        if time.monotonic() - idle_since < self.health_check_seconds:
+            return True
+        try:
+            raw.ping(reconnect=False)
+            return True
+        except Error:
+            self.health_check_failures += 1
+            return False
+
+    def acquire(self, timeout=None):
+        with db_pool_wait_seconds.time():
+            return self._acquire(timeout)
+
+    def _acquire(self, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        while True:
+            raw = None
+            with self._cond:
+                self._check_fork()
+                while True:
+                    if self._idle:
+                        raw, idle_since = self._idle.pop()
+                        self.in_use += 1
+                        break
+                    if self._open < self.size:
+                        self._open += 1
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.timeouts += 1
+                        raise PoolTimeout(f"No database connection available after {timeout}s")
+                    self.waits += 1
+                    self._cond.wait(remaining)
+            if raw is None:
+                break
+            # فحص الصحة (ping) خارج القفل: رحلة شبكة لا تنتظرها بقية الطلبات
+            if self._healthy(raw, idle_since):
+                return PooledConnection(self, raw)
+            with self._cond:
+                self.in_use -= 1
+            self._discard(raw)
+
+        # فتح الاتصال خارج القفل حتى لا تنتظر الطلبات الأخرى المصافحة
+        try:
+            raw = mysql.connector.connect(**self.connect_args)
+        except Error:
+            with self._cond:
+                self._open -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self.created += 1
+            self.in_use += 1
+        return PooledConnection(self, raw)
+
+    def _discard(self, raw):
+        with self._cond:
+            self._open -= 1
+            self._cond.notify()
+        try:
+            raw.close()
+        except Error:
+            pass
+
+    def release(self, raw):
+        if os.getpid() != self._pid:
+            return
+        try:
+            # إلغاء أي معاملة لم تُثبَّت حتى لا تنتقل حالتها للطلب التالي (خارج القفل)
+            if raw.in_transaction:
+                raw.rollback()
+        except Error:
+            with self._cond:
+                self.in_use -= 1
+            self._discard(raw)
+            return
+        with self._cond:
+            if os.getpid() != self._pid:
+                return
+            self.in_use -= 1
+            self._idle.append((raw, time.monotonic()))
+            self._cond.notify()
+
+    def close_idle(self):
+        """إغلاق الاتصالات الخاملة (قبل fork حتى لا ترث العمليات الفرعية مقابس مفتوحة)"""
+        with self._cond:
+            while self._idle:
+                raw, _ = self._idle.pop()
+                self._discard(raw)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "size": self.size,
+                "open": self._open,
+                "idle": len(self._idle),
+                "in_use": self.in_use,
+                "created": self.created,
+                "waits": self.waits,
+                "timeouts": self.timeouts,
+                "health_check_failures": self.health_check_failures,
+            }
+
+
+db_pool = ConnectionPool(**DB_CONFIG)
+
+registry.register(Gauge(
+    'fraud_db_pool_connections', 'MySQL pool connections by state',
+    lambda: {state: db_pool.stats()[state] for state in ('open', 'idle', 'in_use')}, labelnames=('state',)))
+
+
 def get_db_connection():
     try:
-        connection = mysql.connector.connect(
-            host='localhost',
-            database='fraud_users',
-            user='root',
-            password=''
-        )
-        return connection
+        return db_pool.acquire()
     except Error as e:
-        print(f"Error connecting to MySQL: {e}")
-        return None
\ No newline at end of file
+        logger.error("Error connecting to MySQL: %s", e)
+        return None
@@ -1,168 +1,261 @@
+import logging
 import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 from datetime import datetime
 import json
 
+# عدد الصفوف في كل دفعة إدخال
+INSERT_BATCH_SIZE = 50_000
+
+logger = logging.getLogger(__name__)
+
+# أعمدة جدول النتائج وما يقابلها في إطار النتائج
+RESULT_COLUMNS = {
+    'user_id': 'user_id',
+    'transaction_type': 'type',
+    'amount': 'amount',
+    'old_balance': 'old_balance',
+    'new_balance': 'new_balance',
+    'source_account': 'source_account',
+    'destination_account': 'destination_account',
+    'is_fraud': 'predicted_fraud',
+    'fraud_probability': 'fraud_probability',
+}
+
 class FraudDatabase:
     def __init__(self, db_path='fraud_detection.db'):
         self.db_path = db_path
+        # اتصال واحد طويل العمر تحميه قفلة بدل فتح اتصال جديد لكل عملية
+        self._lock = threading.Lock()
+        self._executor = None
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._configure()
         self.init_database()
-    
+
+    def _configure(self):
+        """إعدادات SQLite للكتابة السريعة: WAL وذاكرة مؤقتة أكبر"""
+        cursor = self.conn.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA temp_store=MEMORY')
+        cursor.execute('PRAGMA cache_size=-65536')
+        cursor.execute('PRAGMA mmap_size=268435456')
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
     def init_database(self):
         """تهيئة قاعدة البيانات والجداول"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # جدول المستخدمين
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE,
-                email TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # جدول التحليلات (لحفظ الإحصائيات)
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS analyses (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                session_id TEXT,
-                total_transactions INTEGER,
-                fraud_count INTEGER,
-                fraud_rate REAL,
-                highest_fraud_amount REAL,
-                most_common_type TEXT,
-                analysis_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                file_name TEXT,
-                FOREIGN KEY (user_id) REFERENCES users (id)
-            )
-        ''')
-        
-        # جدول النتائج (لحفظ البيانات المهمة فقط)
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS results (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                analysis_id INTEGER,
-                user_id TEXT,
-                transaction_type TEXT,
-                amount REAL,
-                old_balance REAL,
-                new_balance REAL,
-                source_account TEXT,
-                destination_account TEXT,
-                is_fraud INTEGER,
-                fraud_probability REAL,
-                transaction_date TIMESTAMP,
-                FOREIGN KEY (analysis_id) REFERENCES analyses (id)
-            )
-        ''')
-        
-        conn.commit()
-        conn.close()
-    
+        with self._lock:
+            cursor = self.conn.cursor()
+
+            # جدول المستخدمين
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS users (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    username TEXT UNIQUE,
+                    email TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+
+            # جدول التحليلات (لحفظ الإحصائيات)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS analyses (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER,
+                    session_id TEXT,
+                    total_transactions INTEGER,
+                    fraud_count INTEGER,
+                    fraud_rate REAL,
+                    highest_fraud_amount REAL,
+                    most_common_type TEXT,
+                    analysis_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    file_name TEXT,
+                    FOREIGN KEY (user_id) REFERENCES users (id)
+                )
+            ''')
+
+            # جدول النتائج (لحفظ البيانات المهمة فقط)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS results (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    analysis_id INTEGER,
+                    user_id TEXT,
+                    transaction_type TEXT,
+                    amount REAL,
+                    old_balance REAL,
+                    new_balance REAL,
+                    source_account TEXT,
+                    destination_account TEXT,
+                    is_fraud INTEGER,
+                    fraud_probability REAL,
+                    transaction_date TIMESTAMP,
+                    FOREIGN KEY (analysis_id) REFERENCES analyses (id)
+                )
+            ''')
+
+            # فهارس لجلب نتائج تحليل معين وتصفية الاحتيال بدون مسح كامل للجدول
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_results_analysis_id ON results (analysis_id)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_results_is_fraud ON results (is_fraud)')
+
+            self.conn.commit()
+            cursor.close()
+
+    def _result_rows(self, results_data, analysis_id, created_at):
+        """تحويل النتائج (DataFrame أو قائمة قواميس أو دفعات DataFrame) إلى صفوف جاهزة للإدخال على دفعات"""
+        if isinstance(results_data, list):
+            results_data = pd.DataFrame.from_records(results_data)
+        frames = [results_data] if isinstance(results_data, pd.DataFrame) else results_data
+        for frame in frames:
+            yield from self._frame_rows(frame, analysis_id, created_at)
+
+    def _frame_rows(self, results_data, analysis_id, created_at):
+        for start in range(0, len(results_data), INSERT_BATCH_SIZE):
+            chunk = results_data.iloc[start:start + INSERT_BATCH_SIZE]
+            batch = pd.DataFrame({'analysis_id': analysis_id}, index=chunk.index)
+            for column, source in RESULT_COLUMNS.items():
+                if column in ('is_fraud', 'fraud_probability'):
+                    batch[column] = chunk[source].fillna(0) if source in chunk.columns else 0
+                elif source in chunk.columns:
+                    batch[column] = chunk[source].astype(object)
+                else:
+                    batch[column] = None
+            batch = batch.astype(object).where(batch.notna(), None)
+            batch['transaction_date'] = created_at
+            yield batch.itertuples(index=False, name=None)
+
     def save_analysis(self, user_data, analysis_data, results_data):
         """حفظ التحليل والنتائج في قاعدة البيانات"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        try:
-            # إدخال أو تحديث المستخدم
-            if 'username' in user_data:
-                cursor.execute('''
-                    INSERT OR IGNORE INTO users (username, email) 
-                    VALUES (?, ?)
-                ''', (user_data.get('username'), user_data.get('email')))
-                
-                cursor.execute('SELECT id FROM users WHERE username = ?', (user_data['username'],))
-                user_id = cursor.fetchone()[0]
-            else:
-                user_id = None
-            
-            # إدخال التحليل
-            cursor.execute('''
-                INSERT INTO analyses 
-                (user_id, session_id, total_transactions, fraud_count, fraud_rate, 
-                 highest_fraud_amount, most_common_type, file_name)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                user_id,
-                user_data.get('session_id', 'anonymous'),
-                analysis_data['total_count'],
-                analysis_data['fraud_count'],
-                analysis_data['fraud_rate'],
-                analysis_data.get('highest_fraud_amount', 0),
-                analysis_data.get('most_common_type', 'Unknown'),
-                user_data.get('file_name', 'unknown')
-            ))
-            
-            analysis_id = cursor.lastrowid
-            
-            # إدخال النتائج (البيانات المهمة فقط)
-            for result in results_data:
+        with self._lock:
+            cursor = self.conn.cursor()
+
+            try:
+                # إدخال أو تحديث المستخدم
+                if 'username' in user_data:
+                    cursor.execute('''
+                        INSERT OR IGNORE INTO users (username, email)
+                        VALUES (?, ?)
+                    ''', (user_data.get('username'), user_data.get('email')))
+
+                    cursor.execute('SELECT id FROM users WHERE username = ?', (user_data['username'],))
+                    user_id = cursor.fetchone()[0]
+                else:
+                    user_id = None
+
+                # إدخال التحليل
                 cursor.execute('''
-                    INSERT INTO results 
-                    (analysis_id, user_id, transaction_type, amount, old_balance, 
-                     new_balance, source_account, destination_account, is_fraud, 
-                     fraud_probability, transaction_date)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    INSERT INTO analyses
+                    (user_id, session_id, total_transactions, fraud_count, fraud_rate,
+                     highest_fraud_amount, most_common_type, file_name)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
                 ''', (
-                    analysis_id,
-                    result.get('user_id'),
-                    result.get('type'),
-                    result.get('amount'),
-                    result.get('old_balance'),
-                    result.get('new_balance'),
-                    result.get('source_account'),
-                    result.get('destination_account'),
-                    result.get('predicted_fraud', 0),
-                    result.get('fraud_probability', 0),
-                    datetime.now()
+                    user_id,
+                    user_data.get('session_id', 'anonymous'),
+                    analysis_data['total_count'],
+                    analysis_data['fraud_count'],
+                    analysis_data['fraud_rate'],
+                    analysis_data.get('highest_fraud_amount', 0),
+                    analysis_data.get('most_common_type', 'Unknown'),
+                    user_data.get('file_name', 'unknown')
                 ))
-            
-            conn.commit()
-            return analysis_id
-            
-        except Exception as e:
-            conn.rollback()
-            print(f"Database error: {e}")
-            return None
-        finally:
-            conn.close()
-    
+
+                analysis_id = cursor.lastrowid
+
+                # إدخال النتائج دفعة واحدة لكل مجموعة صفوف داخل نفس المعاملة
+                created_at = datetime.now().isoformat(' ')
+                for rows in self._result_rows(results_data, analysis_id, created_at):
+                    cursor.executemany('''
+                        INSERT INTO results
+                        (analysis_id, user_id, transaction_type, amount, old_balance,
+                         new_balance, source_account, destination_account, is_fraud,
+                         fraud_probability, transaction_date)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ''', rows)
+
+                self.conn.commit()
+                return analysis_id
+
+            except Exception as e:
+                self.conn.rollback()
+                logger.error("Database error: %s", e)
+                return None
+            finally:
+                cursor.close()
+
+    def _get_executor(self):
+        # يُنشأ عند أول استخدام حتى لا تُورَّث خيوطه عبر fork
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="fraud-db")
+        return self._executor
+
+    def save_analysis_later(self, user_data, analysis_data, results_data=()):
+        """save_analysis في خيط خلفي واحد حتى لا ينتظر الطلب إدخال النتائج
+
+        results_data قد يكون مولّد دفعات؛ يُقرأ في الخيط الخلفي.
+        """
+        self._get_executor().submit(self.save_analysis, user_data, analysis_data, results_data)
+
     def get_user_analyses(self, username):
         """جلب تحليلات المستخدم"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT a.*, u.username 
-            FROM analyses a 
-            LEFT JOIN users u ON a.user_id = u.id 
-            WHERE u.username = ? 
-            ORDER BY a.analysis_date DESC
-        ''', (username,))
-        
-        analyses = cursor.fetchall()
-        conn.close()
-        return analyses
-    
+        with self._lock:
+            cursor = self.conn.cursor()
+
+            cursor.execute('''
+                SELECT a.*, u.username
+                FROM analyses a
+                LEFT JOIN users u ON a.user_id = u.id
+                WHERE u.username = ?
+                ORDER BY a.analysis_date DESC
+            ''', (username,))
+
+            analyses = cursor.fetchall()
+            cursor.close()
+            return analyses
+
     def get_analysis_results(self, analysis_id, limit=1000):
         """جلب نتائج تحليل معين"""
-        conn = sqlite3.connect(self.db_path)
-        
-        # جلب النتائج مع تحديد الحد
-        results_df = pd.read_sql('''
-            SELECT user_id, transaction_type, amount, old_balance, new_balance,
-                   source_account, destination_account, is_fraud, fraud_probability
-            FROM results 
-            WHERE analysis_id = ? 
-            LIMIT ?
-        ''', conn, params=(analysis_id, limit))
-        
-        conn.close()
-        return results_df
-
-# إنشاء instance من قاعدة البيانات
-db = FraudDatabase()
\ No newline at end of file
+        with self._lock:
+            # جلب النتائج مع تحديد الحد
+            results_df = pd.read_sql('''
+                SELECT user_id, transaction_type, amount, old_balance, new_balance,
+                       source_account, destination_account, is_fraud, fraud_probability
+                FROM results
+                WHERE analysis_id = ?
+                LIMIT ?
+            ''', self.conn, params=(analysis_id, limit))
+
+            return results_df
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+_db = None
+_db_lock = threading.Lock()
+
+
+def get_db():
+    """نسخة قاعدة البيانات المشتركة؛ تُنشأ عند أول استخدام لا عند الاستيراد
+
+    الإنشاء يحوّل الملف إلى WAL ويضيف الفهارس، فلا يجب أن يعدّله مجرد استيراد الوحدة.
+    """
+    global _db
+    if _db is None:
+        with _db_lock:
+            if _db is None:
+                _db = FraudDatabase()
+    return _db
+
+
+class _LazyDatabase:
+    """db كما كان في الوحدة: نفس الواجهة، والإنشاء عند أول استخدام عبر get_db"""
+
+    def __getattr__(self, name):
+        return getattr(get_db(), name)
+
+
+db = _LazyDatabase()
@@ -0,0 +1,236 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from catboost import Pool
+
+from metrics import stage_seconds
+
+# عدد المساهمات الأعلى (بالقيمة المطلقة) المحفوظة لكل صف
+EXPLAIN_TOP_K = 5
+# تُشرح فقط الصفوف فوق عتبة الاحتيال (نفس عتبة التصنيف)
+EXPLAIN_THRESHOLD = 0.5
+# عدد الصفوف في كل استدعاء لـ CatBoost على خيوط الشرح
+EXPLAIN_BATCH_ROWS = 512
+EXPLAIN_WORKERS = int(os.environ.get('EXPLAIN_WORKERS', 2))
+# أقصى نسبة من زمن التقييم تُصرف على الشرح؛ الصفوف الأعلى احتمالاً تُشرح أولاً
+EXPLAIN_BUDGET_FRACTION = float(os.environ.get('EXPLAIN_BUDGET_FRACTION', 0.1))
+# أول صفوف الملف (المعاينة) تُشرح دائماً خارج الميزانية
+EXPLAIN_PREVIEW_ROWS = 50
+# عدد الشروح المحفوظة في الذاكرة حسب (نسخة النموذج، بصمة الصف)
+EXPLAIN_CACHE_SIZE = 200_000
+# بعد هذا العدد من الصفوف يُنصّف وزن القياسات القديمة
+EXPLAIN_COST_WINDOW_ROWS = 100_000
+# Approximate أسرع بعدة مرات من Regular مع نفس ترتيب المساهمات تقريباً
+SHAP_CALC_TYPE = 'Approximate'
+
+logger = logging.getLogger(__name__)
+
+
+def row_hashes(features):
+    return pd.util.hash_pandas_object(features, index=False).to_numpy()
+
+
+def top_contributions(features, shap_values, top_k=EXPLAIN_TOP_K):
+    """أعلى top_k مساهمات لكل صف: [{feature, value, contribution}, ...]"""
+    contributions = shap_values[:, :-1]  # العمود الأخير هو القيمة المتوقعة
+    k = min(top_k, contributions.shape[1])
+    magnitude = np.abs(contributions)
+    top = np.argpartition(-magnitude, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(magnitude, top, axis=1), axis=1)
+    top = np.take_along_axis(top, order, axis=1)
+
+    names = features.columns
+    values = features.to_numpy(dtype=object)
+    explanations = []
+    for i, columns in enumerate(top):
+        explanations.append([{
+            "feature": names[j],
+            "value": values[i, j].item() if hasattr(values[i, j], 'item') else values[i, j],
+            "contribution": round(float(contributions[i, j]), 4),
+        } for j in columns])
+    return explanations
+
+
+class ExplanationCache:
+    def __init__(self, max_entries=EXPLAIN_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, version, row_hash):
+        with self._lock:
+            explanation = self._entries.get((version, row_hash))
+            if explanation is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end((version, row_hash))
+            self.hits += 1
+            return explanation
+
+    def put(self, version, row_hash, explanation):
+        with self._lock:
+            self._entries[(version, row_hash)] = explanation
+            self._entries.move_to_end((version, row_hash))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def on_model_reload(self, loaded):
+        # الشروح مرتبطة بنسخة النموذج؛ النسخ القديمة لن تُطلب مرة أخرى
+        with self._lock:
+            self._entries.clear()
+
+
+class Explainer:
+    """حساب مساهمات الميزات (SHAP) على دفعات في خيوط مخصصة"""
+
+    def __init__(self, workers=EXPLAIN_WORKERS, cache=None):
+        self.workers = workers
+        self.cache = cache or ExplanationCache()
+        self._lock = threading.Lock()
+        self._executor = None
+        # زمن الشرح وعدد الصفوف المشروحة مؤخراً (يحددان كم صفاً تتسع له الميزانية)
+        self._seconds = 0.0
+        self._rows = 0
+
+    @property
+    def seconds_per_row(self):
+        with self._lock:
+            return self._seconds / self._rows if self._rows else None
+
+    def _get_executor(self):
+        # يُنشأ عند أول استخدام حتى لا تُورَّث خيوطه عبر fork
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="explain")
+        return self._executor
+
+    def explain(self, features, loaded, hashes=None):
+        """شرح كل صفوف features في استدعاء واحد وحفظ النتائج في الذاكرة"""
+        start = time.perf_counter()
+        # زمن المعالج لهذا الخيط فقط، لا يتأثر بانتظار الخيوط الأخرى على نفس الأنوية
+        cpu_start = time.thread_time()
+        pool = Pool(features, cat_features=loaded.model.get_cat_feature_indices())
+        shap_values = loaded.model.get_feature_importance(
+            pool, type='ShapValues', shap_calc_type=SHAP_CALC_TYPE, thread_count=1)
+        explanations = top_contributions(features, shap_values)
+        stage_seconds.observe(time.perf_counter() - start, stage='explain')
+        seconds = time.thread_time() - cpu_start
+
+        with self._lock:
+            # موزون بعدد الصفوف حتى لا تطغى كلفة الاستدعاء الثابتة للدفعات الصغيرة
+            self._seconds += seconds
+            self._rows += len(features)
+            if self._rows > EXPLAIN_COST_WINDOW_ROWS:
+                self._seconds /= 2
+                self._rows //= 2
+        if hashes is not None:
+            for row_hash, explanation in zip(hashes, explanations):
+                self.cache.put(loaded.version, int(row_hash), explanation)
+        return explanations
+
+    def submit(self, features, loaded, hashes=None):
+        return self._get_executor().submit(self.explain, features, loaded, hashes)
+
+
+class ExplanationRun:
+    """شروح ملف واحد: تُجمع دفعة بدفعة أثناء التقييم وتُنتظر في النهاية
+
+    لكل دفعة مقيَّمة تُختار الصفوف فوق العتبة، ما سبق شرحه يُؤخذ من الذاكرة،
+    والباقي يُرسل إلى خيوط الشرح ضمن ميزانية زمنية نسبة من زمن التقييم.
+    """
+
+    def __init__(self, explainer=None, budget_fraction=EXPLAIN_BUDGET_FRACTION, preview_rows=EXPLAIN_PREVIEW_ROWS,
+                 threshold=EXPLAIN_THRESHOLD):
+        self.explainer = explainer or default_explainer
+        self.budget_fraction = budget_fraction
+        self.preview_rows = preview_rows
+        self.threshold = threshold
+        self.offset = 0
+        self.scoring_seconds = 0.0
+        self.committed_seconds = 0.0
+        self.flagged = 0
+        self.cached = 0
+        self._results = {}
+        self._pending = []
+
+    def _allowed_rows(self, candidates):
+        per_row = self.explainer.seconds_per_row
+        if per_row is None:
+            # أول دفعة تقيس الكلفة الفعلية
+            return min(candidates, EXPLAIN_BATCH_ROWS)
+        budget = self.budget_fraction * self.scoring_seconds - self.committed_seconds
+        return min(candidates, max(int(budget / per_row), 0))
+
+    def add(self, features, probas, loaded, seconds):
+        """تسجيل دفعة مقيَّمة (features بعد المحاذاة) وإرسال صفوفها المشبوهة للشرح"""
+        offset = self.offset
+        self.offset += len(features)
+        self.scoring_seconds += seconds
+        flagged = np.flatnonzero(np.asarray(probas) > self.threshold)
+        self.flagged += len(flagged)
+        if len(flagged) == 0:
+            return
+
+        subset = features.iloc[flagged]
+        hashes = row_hashes(subset)
+        missing = []
+        for position, row_hash in zip(flagged, hashes):
+            explanation = self.explainer.cache.get(loaded.version, int(row_hash))
+            if explanation is None:
+                missing.append(position)
+            else:
+                self._results[offset + int(position)] = explanation
+        self.cached += len(flagged) - len(missing)
+        if not missing:
+            return
+
+        missing = np.array(missing)
+        in_preview = offset + missing < self.preview_rows
+        preview, rest = missing[in_preview], missing[~in_preview]
+        allowed = self._allowed_rows(len(rest))
+        if allowed < len(rest):
+            # الأعلى احتمالاً أولاً
+            rest = rest[np.argsort(-np.asarray(probas)[rest], kind='stable')[:allowed]]
+        self.committed_seconds += len(rest) * (self.explainer.seconds_per_row or 0.0)
+        missing = np.sort(np.concatenate([preview, rest]))
+        if len(missing) == 0:
+            return
+
+        lookup = {int(p): h for p, h in zip(flagged, hashes)}
+        for start in range(0, len(missing), EXPLAIN_BATCH_ROWS):
+            batch = missing[start:start + EXPLAIN_BATCH_ROWS]
+            batch_hashes = [lookup[int(p)] for p in batch]
+            future = self.explainer.submit(features.iloc[batch], loaded, batch_hashes)
+            self._pending.append((offset + batch, future))
+
+    def finish(self):
+        """انتظار كل الدفعات وإرجاع {رقم الصف: المساهمات} مرتبة حسب الصف"""
+        for rows, future in self._pending:
+            try:
+                for row, explanation in zip(rows, future.result()):
+                    self._results[int(row)] = explanation
+            except Exception as e:
+                logger.error("Explanation batch failed: %s", e)
+        self._pending = []
+        return dict(sorted(self._results.items()))
+
+    def summary(self):
+        return {
+            "flagged_rows": self.flagged,
+            "explained_rows": len(self._results),
+            "from_cache": self.cached,
+            "top_k": EXPLAIN_TOP_K,
+        }
+
+
+explanation_cache = ExplanationCache()
+default_explainer = Explainer(cache=explanation_cache)
@@ -0,0 +1,399 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+
+import numpy as np
+import pandas as pd
+
+# الإشارات التي يمكن حسابها من المعاملات الخام بدل الاعتماد على العميل
+DERIVED_SIGNALS = [
+    'velocity',
+    'amount_spike',
+    'balance_mismatch',
+    'new_destination',
+    'device_change',
+    'ip_unusual',
+    'odd_hour',
+]
+
+# نافذة السرعة: عدد معاملات المستخدم (مع الحالية) خلال الساعة الأخيرة
+# (في البيانات الموسومة تُعلَّم كل معاملة ضمن دفعة متقاربة، لا الثالثة فقط)
+VELOCITY_WINDOW_SECONDS = 3600
+VELOCITY_MIN_TRANSACTIONS = 2
+# المبلغ أكبر من هذا المضاعف لمتوسط مبالغ المستخدم السابقة
+AMOUNT_SPIKE_FACTOR = 3.0
+# فرق الرصيد المسموح قبل اعتباره عدم تطابق؛ الأرصدة في البيانات الموسومة
+# تحمل رسوماً وتقريباً بمئات الريالات وعدم التطابق الفعلي بالآلاف
+BALANCE_TOLERANCE = 1000.0
+# الوجهة الجديدة تُعلَّم فقط لمستخدم تذهب هذه النسبة من معاملاته السابقة على الأقل
+# إلى وجهات سبق أن دفع لها (من يدفع لتجار مختلفين في كل مرة لا تُعد وجهته الجديدة شاذة)
+NEW_DESTINATION_MIN_REPEAT_SHARE = 0.5
+# الساعات من 0 حتى 5 صباحاً
+ODD_HOURS = (0, 5)
+# أنواع المعاملات التي تزيد الرصيد
+CREDIT_TYPES = {'Deposit'}
+# إشارات "أول ظهور": (الإشارة، عمود المعاملة، مجموعة القيم السابقة في UserState)
+FIRST_SEEN_SIGNALS = [
+    ('new_destination', 'destination_account', 'destinations'),
+    ('device_change', 'device', 'devices'),
+    ('ip_unusual', 'ip', 'ips'),
+]
+# أقصى عدد مستخدمين في ذاكرة الحالة (الأقدم استخداماً يُحذف أولاً)
+MAX_TRACKED_USERS = 1_000_000
+# ملف حالة المستخدمين لـ /api/score؛ يتشاركه عمال serve.py ويبقى بعد إعادة تشغيلهم
+FEATURE_STATE_PATH = os.environ.get('FEATURE_STATE_PATH', 'feature_state.db')
+# مهلة انتظار قفل الكتابة عندما يحدّث عاملان الحالة في نفس الوقت
+FEATURE_STATE_BUSY_SECONDS = 5.0
+# عدد التحديثات بين كل حذف لأقدم المستخدمين فوق MAX_TRACKED_USERS
+FEATURE_STATE_PRUNE_EVERY = 10_000
+
+
+class UserState:
+    __slots__ = ('recent', 'amount_sum', 'amount_count', 'repeats', 'devices', 'ips', 'destinations')
+
+    def __init__(self):
+        self.recent = deque()
+        self.amount_sum = 0.0
+        self.amount_count = 0
+        # عدد المعاملات التي ذهبت إلى وجهة سبق الدفع لها
+        self.repeats = 0
+        self.devices = set()
+        self.ips = set()
+        self.destinations = set()
+
+
+class FeatureState:
+    """حالة تراكمية لكل مستخدم لحساب الإشارات لمعاملة واحدة في O(1)"""
+
+    def __init__(self, max_users=MAX_TRACKED_USERS):
+        self.max_users = max_users
+        self.users = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _user(self, user_id):
+        state = self.users.get(user_id)
+        if state is None:
+            state = self.users[user_id] = UserState()
+            if len(self.users) > self.max_users:
+                self.users.popitem(last=False)
+        else:
+            self.users.move_to_end(user_id)
+        return state
+
+    def update(self, txn):
+        """حساب إشارات معاملة واحدة ثم إضافتها إلى تاريخ المستخدم"""
+        with self._lock:
+            return _update_user(self._user(str(txn['user_id'])), txn)
+
+    def absorb(self, work):
+        """إضافة دفعة كاملة (مرتبة حسب المستخدم والوقت) إلى الحالة"""
+        with self._lock:
+            grouped = work.groupby('user_id', sort=False)
+            sums = grouped['amount'].agg(['sum', 'count'])
+            for user_id, group in grouped:
+                state = self._user(user_id)
+                state.amount_sum += sums.at[user_id, 'sum']
+                state.amount_count += int(sums.at[user_id, 'count'])
+                destinations = group['destination_account']
+                state.repeats += int(destinations.duplicated().sum()
+                                     + destinations.drop_duplicates().isin(state.destinations).sum())
+                state.devices.update(group['device'].unique())
+                state.ips.update(group['ip'].unique())
+                state.destinations.update(group['destination_account'].unique())
+                seconds = group['seconds'].to_numpy()
+                state.recent.extend(seconds[seconds >= seconds[-1] - VELOCITY_WINDOW_SECONDS].tolist())
+                while state.recent and state.recent[0] < seconds[-1] - VELOCITY_WINDOW_SECONDS:
+                    state.recent.popleft()
+
+
+class SharedFeatureState:
+    """حالة المستخدمين في SQLite يتشاركها كل العمال بدل نسخة في ذاكرة كل عملية
+
+    كل معاملة تُقرأ وتُكتب حالة مستخدمها داخل BEGIN IMMEDIATE، فلا يحسب
+    عاملان إشارات نفس المستخدم من تاريخ قديم ويكتب أحدهما فوق الآخر.
+    """
+
+    def __init__(self, path=FEATURE_STATE_PATH, max_users=MAX_TRACKED_USERS):
+        self.path = path
+        self.max_users = max_users
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        self._updates = 0
+
+    def _connection(self):
+        # اتصال لكل عملية يُفتح عند أول استخدام حتى لا يُورَّث عبر fork
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=FEATURE_STATE_BUSY_SECONDS, isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS user_state (
+                    user_id TEXT PRIMARY KEY,
+                    state TEXT NOT NULL,
+                    touched REAL NOT NULL
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_user_state_touched ON user_state (touched)')
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    def update(self, txn):
+        """حساب إشارات معاملة واحدة ثم إضافتها إلى تاريخ المستخدم المشترك"""
+        user_id = str(txn['user_id'])
+        with self._lock:
+            conn = self._connection()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute('SELECT state FROM user_state WHERE user_id = ?', (user_id,)).fetchone()
+                state = _load_user(row[0]) if row else UserState()
+                signals = _update_user(state, txn)
+                conn.execute('INSERT OR REPLACE INTO user_state (user_id, state, touched) VALUES (?, ?, ?)',
+                             (user_id, _dump_user(state), time.time()))
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            self._updates += 1
+            if self._updates % FEATURE_STATE_PRUNE_EVERY == 0:
+                conn.execute('''
+                    DELETE FROM user_state WHERE touched < (
+                        SELECT touched FROM user_state ORDER BY touched DESC LIMIT 1 OFFSET ?
+                    )
+                ''', (self.max_users - 1,))
+        return signals
+
+
+def _dump_user(state):
+    return json.dumps({
+        'recent': list(state.recent),
+        'amount_sum': state.amount_sum,
+        'amount_count': state.amount_count,
+        'repeats': state.repeats,
+        'devices': sorted(state.devices),
+        'ips': sorted(state.ips),
+        'destinations': sorted(state.destinations),
+    })
+
+
+def _load_user(text):
+    data = json.loads(text)
+    state = UserState()
+    state.recent = deque(data['recent'])
+    state.amount_sum = data['amount_sum']
+    state.amount_count = data['amount_count']
+    state.repeats = data['repeats']
+    state.devices = set(data['devices'])
+    state.ips = set(data['ips'])
+    state.destinations = set(data['destinations'])
+    return state
+
+
+def _update_user(state, txn):
+    """إشارات معاملة واحدة من تاريخ المستخدم state ثم إضافتها إليه
+
+    الوجهة والجهاز وعنوان IP تُعتبر جديدة فقط مقارنة بتاريخ معروف للمستخدم؛
+    أول معاملة له لا تُعلَّم، والوجهة الجديدة تُعلَّم فقط لمستخدم يكرر وجهاته عادة.
+    """
+    ts = pd.Timestamp(txn['transaction_date'])
+    seconds = ts.value // 10 ** 9
+    amount = float(txn['amount'])
+    has_history = state.amount_count > 0
+
+    while state.recent and state.recent[0] < seconds - VELOCITY_WINDOW_SECONDS:
+        state.recent.popleft()
+    previous_mean = state.amount_sum / state.amount_count if has_history else None
+    destination = str(txn['destination_account'])
+    ip = str(txn['ip'])
+    device = str(txn['device'])
+    repeat = destination in state.destinations
+    settled = has_history and state.repeats >= NEW_DESTINATION_MIN_REPEAT_SHARE * state.amount_count
+
+    signals = {
+        'velocity': int(len(state.recent) + 1 >= VELOCITY_MIN_TRANSACTIONS),
+        'amount_spike': int(previous_mean is not None and amount > AMOUNT_SPIKE_FACTOR * previous_mean),
+        'balance_mismatch': int(_balance_mismatch(txn['type'], amount, txn['old_balance'], txn['new_balance'])),
+        'new_destination': int(settled and not repeat),
+        'device_change': int(has_history and device not in state.devices),
+        'ip_unusual': int(has_history and ip not in state.ips),
+        'odd_hour': int(ODD_HOURS[0] <= ts.hour <= ODD_HOURS[1]),
+    }
+
+    state.recent.append(seconds)
+    state.amount_sum += amount
+    state.amount_count += 1
+    state.repeats += int(repeat)
+    state.devices.add(device)
+    state.ips.add(ip)
+    state.destinations.add(destination)
+    return signals
+
+
+def _balance_mismatch(txn_type, amount, old_balance, new_balance):
+    sign = 1 if txn_type in CREDIT_TYPES else -1
+    return abs(float(old_balance) + sign * amount - float(new_balance)) > BALANCE_TOLERANCE
+
+
+def derive_signals(df, state=None, overwrite=False):
+    """حساب الإشارات الناقصة لدفعة كاملة بعمليات متجهة وgroupby
+
+    إذا مُرِّرت state تُستخدم كتاريخ سابق للمستخدمين ثم تُحدَّث بالدفعة
+    (للقراءة المتدفقة على دفعات). تفترض الحالة أن الدفعات تصل بترتيب زمني.
+    """
+    needed = [s for s in DERIVED_SIGNALS if overwrite or s not in df.columns]
+    if not needed or len(df) == 0:
+        return df
+
+    ts = pd.to_datetime(df['transaction_date'], errors='coerce')
+    work = pd.DataFrame({
+        'user_id': df['user_id'].astype(str).to_numpy(),
+        'seconds': ts.to_numpy('datetime64[ns]').view('int64') // 10 ** 9,
+        'amount': df['amount'].to_numpy(dtype=np.float64),
+        'device': df['device'].astype(str).to_numpy(),
+        'ip': df['ip'].astype(str).to_numpy(),
+        'destination_account': df['destination_account'].astype(str).to_numpy(),
+        'row': np.arange(len(df)),
+    })
+    # ترتيب ثابت حسب المستخدم ثم الوقت؛ الحسابات التالية تفترض هذا الترتيب
+    work = work.sort_values(['user_id', 'seconds'], kind='stable', ignore_index=True)
+    grouped = work.groupby('user_id', sort=False)
+    position = grouped.cumcount().to_numpy()
+    first_in_chunk = position == 0
+    signals = {}
+
+    seed = _state_seed(work, state)
+
+    if 'velocity' in needed:
+        user_codes = pd.factorize(work['user_id'])[0].astype(np.int64)
+        key = (user_codes << 32) + work['seconds'].to_numpy()
+        window_start = np.searchsorted(key, key - VELOCITY_WINDOW_SECONDS, side='left')
+        recent = np.arange(len(work)) - window_start
+        if seed is not None:
+            recent = recent + _recent_from_state(work, state)
+        signals['velocity'] = recent + 1 >= VELOCITY_MIN_TRANSACTIONS
+
+    if 'amount_spike' in needed:
+        previous_sum = grouped['amount'].cumsum().to_numpy() - work['amount'].to_numpy()
+        previous_count = position.astype(np.float64)
+        if seed is not None:
+            previous_sum = previous_sum + seed['amount_sum'].to_numpy()
+            previous_count = previous_count + seed['amount_count'].to_numpy()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            previous_mean = previous_sum / previous_count
+        signals['amount_spike'] = (previous_count > 0) & (work['amount'].to_numpy() > AMOUNT_SPIKE_FACTOR * previous_mean)
+
+    has_history = ~first_in_chunk
+    if seed is not None:
+        has_history = has_history | (seed['amount_count'].to_numpy() > 0)
+
+    # قيمة لم تظهر في تاريخ المستخدم (صفوفه السابقة والحالة)؛ أول معاملة له لا تُعلَّم
+    for name, column, attribute in FIRST_SEEN_SIGNALS:
+        if name in needed:
+            fresh = ~work.duplicated(['user_id', column]).to_numpy()
+            if seed is not None:
+                fresh &= ~_seen_in_state(work, state, column, attribute, fresh)
+            signals[name] = has_history & fresh
+
+    if 'new_destination' in needed:
+        # الوجهة الجديدة تُعلَّم فقط لمستخدم تذهب معظم معاملاته السابقة إلى وجهات مكررة
+        repeat = has_history & ~signals['new_destination']
+        repeats = pd.Series(repeat, dtype=np.int64).groupby(work['user_id'], sort=False).cumsum()
+        previous_repeats = repeats.to_numpy() - repeat
+        previous_count = position.astype(np.float64)
+        if seed is not None:
+            previous_repeats = previous_repeats + seed['repeats'].to_numpy()
+            previous_count = previous_count + seed['amount_count'].to_numpy()
+        settled = has_history & (previous_repeats >= NEW_DESTINATION_MIN_REPEAT_SHARE * previous_count)
+        signals['new_destination'] &= settled
+
+    if state is not None:
+        state.absorb(work)
+
+    # إعادة الإشارات إلى ترتيب الصفوف الأصلي
+    rows = work['row'].to_numpy()
+    derived = {}
+    for name, values in signals.items():
+        ordered = np.empty(len(df), dtype=np.int8)
+        ordered[rows] = values
+        derived[name] = ordered
+
+    if 'odd_hour' in needed:
+        derived['odd_hour'] = ts.dt.hour.between(*ODD_HOURS).to_numpy(dtype=np.int8)
+
+    if 'balance_mismatch' in needed:
+        sign = np.where(df['type'].astype(str).isin(CREDIT_TYPES), 1.0, -1.0)
+        expected = df['old_balance'].to_numpy(dtype=np.float64) + sign * df['amount'].to_numpy(dtype=np.float64)
+        derived['balance_mismatch'] = (
+            np.abs(expected - df['new_balance'].to_numpy(dtype=np.float64)) > BALANCE_TOLERANCE
+        ).astype(np.int8)
+
+    return df.assign(**derived)
+
+
+def _dates(df):
+    return pd.to_datetime(df['transaction_date'], errors='coerce')
+
+
+# أعمدة إضافية تحتاجها بعض النماذج المرفقة وتُشتق من أعمدة الإدخال
+MODEL_FEATURES = {
+    'hour': lambda df: _dates(df).dt.hour,
+    'dayofweek': lambda df: _dates(df).dt.dayofweek,
+    'day_of_week': lambda df: _dates(df).dt.dayofweek,
+    'balance_diff': lambda df: df['old_balance'] - df['new_balance'],
+    'amount_ratio': lambda df: df['amount'] / (df['old_balance'] + 1e-6),
+}
+
+
+def model_features(df, names):
+    """إضافة الأعمدة المشتقة المطلوبة لنموذج معين (الأسماء غير المعروفة تُتجاهل)"""
+    derived = {name: MODEL_FEATURES[name](df) for name in names if name in MODEL_FEATURES}
+    return df.assign(**derived) if derived else df
+
+
+def _state_seed(work, state):
+    """قيم بداية كل صف من الحالة السابقة للمستخدم (أو None بدون حالة)"""
+    if state is None or not state.users:
+        return None
+    users = work['user_id']
+    known = {u: state.users[u] for u in users.unique() if u in state.users}
+    return pd.DataFrame({
+        'amount_sum': users.map({u: s.amount_sum for u, s in known.items()}).fillna(0.0),
+        'amount_count': users.map({u: s.amount_count for u, s in known.items()}).fillna(0),
+        'repeats': users.map({u: s.repeats for u, s in known.items()}).fillna(0),
+    })
+
+
+def _recent_from_state(work, state):
+    """عدد معاملات المستخدم السابقة (من الحالة) داخل نافذة السرعة لكل صف"""
+    counts = np.zeros(len(work), dtype=np.int64)
+    seconds = work['seconds'].to_numpy()
+    for user_id, index in work.groupby('user_id', sort=False).indices.items():
+        user_state = state.users.get(user_id)
+        if user_state is None or not user_state.recent:
+            continue
+        history = np.fromiter(user_state.recent, dtype=np.int64)
+        starts = np.searchsorted(history, seconds[index] - VELOCITY_WINDOW_SECONDS, side='left')
+        ends = np.searchsorted(history, seconds[index], side='right')
+        counts[index] = ends - starts
+    return counts
+
+
+def _seen_in_state(work, state, column, attribute, candidates):
+    """هل ظهرت القيمة للمستخدم في دفعات سابقة (يُفحص فقط أول ظهور داخل الدفعة)"""
+    seen = np.zeros(len(work), dtype=bool)
+    index = np.flatnonzero(candidates)
+    users = work['user_id'].to_numpy()[index]
+    values = work[column].to_numpy()[index]
+    for i, user_id, value in zip(index, users, values):
+        user_state = state.users.get(user_id)
+        if user_state is not None and value in getattr(user_state, attribute):
+            seen[i] = True
+    return seen
+
+
+# حالة مشتركة لتقييم المعاملات المفردة عبر /api/score (بين العمال وعبر إعادة التشغيل)
+live_feature_state = SharedFeatureState()
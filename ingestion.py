@@ -0,0 +1,280 @@
+import json
+import zipfile
+
+import pandas as pd
+
+FEATURES_PATH = "features.json"
+
+# صيغ الملفات المدعومة (تُكتشف من أول بايتات الملف لا من اسمه)
+FORMAT_CSV = 'csv'
+FORMAT_CSV_GZIP = 'csv.gz'
+FORMAT_CSV_ZSTD = 'csv.zst'
+FORMAT_EXCEL = 'xlsx'
+FORMAT_PARQUET = 'parquet'
+FORMAT_ARROW = 'arrow'
+FORMAT_ARROW_STREAM = 'arrow_stream'
+CSV_COMPRESSION = {FORMAT_CSV: None, FORMAT_CSV_GZIP: 'gzip', FORMAT_CSV_ZSTD: 'zstd'}
+# عدد الصفوف في كل دفعة عند قراءة Excel/Parquet/Arrow بدون تحديد حجم
+READ_BATCH_ROWS = 65_536
+
+# الأعمدة المالية تُخزَّن float32 (وهي الدقة التي يستخدمها CatBoost داخلياً)
+FLOAT_COLUMNS = ['amount', 'old_balance', 'new_balance']
+# أعلام 0/1 المحسوبة مسبقاً
+FLAG_COLUMNS = [
+    'balance_mismatch',
+    'amount_spike',
+    'new_destination',
+    'blacklisted_dest',
+    'device_change',
+    'ip_unusual',
+    'odd_hour',
+    'velocity',
+]
+
+
+class FeatureSchema:
+    """مخطط الإدخال المبني على features.json: أنواع صريحة وقواميس الفئات المعروفة"""
+
+    def __init__(self, path=FEATURES_PATH):
+        with open(path, encoding='utf-8') as f:
+            meta = json.load(f)
+        self.all_features = meta['all_features']
+        self.cat_features = meta['cat_features']
+        self.cat_values = {col: [str(v) for v in values] for col, values in meta.get('cat_values', {}).items()}
+
+        self.dtypes = {col: 'category' for col in self.cat_features}
+        self.dtypes.update({col: 'float32' for col in FLOAT_COLUMNS if col in self.all_features})
+        self.dtypes.update({col: 'int8' for col in FLAG_COLUMNS if col in self.all_features})
+
+    def validate_header(self, columns, required=None):
+        """رفض الملف قبل قراءة محتواه إذا كانت الأعمدة المطلوبة ناقصة"""
+        required = required or self.all_features
+        missing = [c for c in required if c not in columns]
+        if missing:
+            raise ValueError(f"Missing columns: {', '.join(missing)}")
+
+    def read_header(self, path, compression=None):
+        return pd.read_csv(path, nrows=0, compression=compression).columns.tolist()
+
+    def _dtypes_for(self, columns):
+        return {col: dtype for col, dtype in self.dtypes.items() if col in columns}
+
+    def encode_categories(self, df):
+        """ترتيب الفئات بحيث تأخذ القيم المعروفة أكواداً ثابتة وتُضاف القيم الجديدة بعدها"""
+        for col, known in self.cat_values.items():
+            if col in df.columns and isinstance(df[col].dtype, pd.CategoricalDtype):
+                seen = df[col].cat.categories
+                extra = sorted(set(seen) - set(known))
+                df[col] = df[col].cat.set_categories(known + extra)
+        return df
+
+    def read_csv(self, path, required=None, chunksize=None, compression=None, **kwargs):
+        """قراءة CSV (عادي أو مضغوط gzip/zstd) بأنواع صريحة بعد التحقق من الترويسة"""
+        try:
+            columns = self.read_header(path, compression)
+        except (ImportError, OSError, EOFError) as e:
+            raise ValueError(f"Malformed file: {e}") from e
+        self.validate_header(columns, required)
+        dtypes = self._dtypes_for(columns)
+
+        try:
+            reader = pd.read_csv(path, dtype=dtypes, chunksize=chunksize, compression=compression, **kwargs)
+        except (ValueError, TypeError) as e:
+            raise ValueError(f"Malformed file: {e}") from e
+
+        if chunksize is None:
+            return self.encode_categories(reader)
+        return self._iter_chunks(reader)
+
+    def _iter_chunks(self, reader):
+        try:
+            for chunk in reader:
+                yield self.encode_categories(chunk)
+        except (ValueError, TypeError, OSError, EOFError) as e:
+            raise ValueError(f"Malformed file: {e}") from e
+
+    def read(self, path, required=None, chunksize=None):
+        """قراءة ملف مرفوع بأي صيغة مدعومة: إطار واحد، أو مولّد دفعات إذا حُدد chunksize"""
+        file_format = detect_format(path)
+        if file_format in CSV_COMPRESSION:
+            return self.read_csv(path, required=required, chunksize=chunksize,
+                                 compression=CSV_COMPRESSION[file_format])
+
+        readers = {
+            FORMAT_EXCEL: self._excel_batches,
+            FORMAT_PARQUET: self._parquet_batches,
+            FORMAT_ARROW: self._arrow_batches,
+            FORMAT_ARROW_STREAM: self._arrow_batches,
+        }
+        batches = readers[file_format](path, chunksize or READ_BATCH_ROWS)
+        # التحقق من الترويسة يحدث عند إنشاء المولّد، قبل قراءة أي صف
+        header = next(batches)
+        self.validate_header(header, required)
+        if chunksize is not None:
+            return (self.cast(chunk, required) for chunk in batches)
+        frames = list(batches)
+        if not frames:
+            return self.cast(pd.DataFrame(columns=header), required)
+        return self.cast(pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0], required)
+
+    def _excel_batches(self, path, chunksize):
+        """قراءة Excel صفاً صفاً بوضع القراءة فقط (بدون تحميل المصنف كاملاً)"""
+        import openpyxl
+
+        # openpyxl يرفض الأسماء بغير امتداد Excel، لذا يُمرَّر الملف مفتوحاً
+        handle = open(path, 'rb')
+        try:
+            workbook = openpyxl.load_workbook(handle, read_only=True, data_only=True)
+        except (zipfile.BadZipFile, KeyError, OSError) as e:
+            handle.close()
+            raise ValueError(f"Malformed file: {e}") from e
+        try:
+            rows = workbook.worksheets[0].iter_rows(values_only=True)
+            header = next(rows, None)
+            if header is None:
+                raise ValueError("Malformed file: empty worksheet")
+            # الأعمدة الفارغة في نهاية الترويسة لا تُقرأ
+            width = max((i + 1 for i, name in enumerate(header) if name is not None), default=0)
+            columns = [str(name) for name in header[:width]]
+            yield columns
+
+            batch = []
+            for row in rows:
+                if not any(value is not None for value in row[:width]):
+                    continue
+                batch.append(row[:width])
+                if len(batch) >= chunksize:
+                    yield pd.DataFrame.from_records(batch, columns=columns)
+                    batch = []
+            if batch:
+                yield pd.DataFrame.from_records(batch, columns=columns)
+        finally:
+            workbook.close()
+            handle.close()
+
+    def _parquet_batches(self, path, chunksize):
+        pq = _require_pyarrow('parquet')
+        try:
+            parquet_file = pq.ParquetFile(path)
+        except Exception as e:
+            raise ValueError(f"Malformed file: {e}") from e
+        yield parquet_file.schema_arrow.names
+        for batch in parquet_file.iter_batches(batch_size=chunksize):
+            yield batch.to_pandas()
+
+    def _arrow_batches(self, path, chunksize):
+        import pyarrow as pa
+
+        _require_pyarrow('ipc')
+        source = pa.memory_map(path, 'r')
+        try:
+            try:
+                # ملف Arrow IPC (Feather v2) أو تدفق IPC
+                reader = pa.ipc.open_file(source)
+                table = reader.read_all()
+            except pa.ArrowInvalid:
+                source.seek(0)
+                table = pa.ipc.open_stream(source).read_all()
+        except pa.ArrowInvalid as e:
+            raise ValueError(f"Malformed file: {e}") from e
+        yield table.schema.names
+        # الجدول مقروء من الذاكرة المعيّنة؛ التحويل إلى pandas يتم دفعة بعد دفعة
+        for batch in table.to_batches(max_chunksize=chunksize):
+            yield batch.to_pandas()
+
+    def coerce_record(self, record):
+        """نسخة من معاملة JSON بأنواع المخطط، أو ValueError باسم العمود الذي لا يتحول
+
+        تُطبَّق على كل طلب قبل دمجه مع طلبات أخرى في دفعة واحدة، حتى لا تُفشل
+        قيمة خاطئة في طلب واحد تقييم البقية.
+        """
+        coerced = dict(record)
+        for col, dtype in self._dtypes_for(record).items():
+            value = record[col]
+            if value is None or isinstance(value, (dict, list)):
+                raise ValueError(f"{col}: expected a value, got {type(value).__name__}")
+            if dtype == 'category':
+                coerced[col] = str(value)
+                continue
+            if isinstance(value, bool):
+                raise ValueError(f"{col}: expected a number, got {value!r}")
+            try:
+                number = float(value)
+            except (TypeError, ValueError):
+                raise ValueError(f"{col}: expected a number, got {value!r}") from None
+            if dtype == 'int8':
+                # نفس ما يقبله read_csv لأعمدة الأعلام: عدد صحيح ضمن int8
+                if not number.is_integer() or not -128 <= number <= 127:
+                    raise ValueError(f"{col}: expected a small integer flag, got {value!r}")
+                coerced[col] = int(number)
+            else:
+                coerced[col] = number
+        return coerced
+
+    def cast(self, df, required=None):
+        """تطبيق نفس الأنواع على إطار مقروء مسبقاً (مثل ملفات Excel)"""
+        self.validate_header(df.columns, required)
+        dtypes = self._dtypes_for(df.columns)
+        try:
+            # الفئات تُحوَّل إلى نص أولاً لتطابق ما يُنتجه read_csv
+            df = df.astype({col: 'string' for col, dtype in dtypes.items() if dtype == 'category'})
+            df = df.astype(dtypes)
+        except (ValueError, TypeError) as e:
+            raise ValueError(f"Malformed file: {e}") from e
+        return self.encode_categories(df)
+
+
+def _require_pyarrow(module):
+    try:
+        if module == 'parquet':
+            import pyarrow.parquet as parquet
+            return parquet
+        import pyarrow.ipc as ipc
+        return ipc
+    except ImportError as e:
+        raise ValueError("Parquet/Arrow uploads require the pyarrow package") from e
+
+
+def detect_format(path, sample_bytes=4096):
+    """صيغة الملف من محتواه (التوقيع في أول البايتات) بدل امتداد الاسم"""
+    with open(path, 'rb') as f:
+        head = f.read(sample_bytes)
+
+    if head.startswith(b'\x1f\x8b'):
+        return FORMAT_CSV_GZIP
+    if head.startswith(b'\x28\xb5\x2f\xfd'):
+        return FORMAT_CSV_ZSTD
+    if head.startswith(b'PAR1'):
+        return FORMAT_PARQUET
+    if head.startswith(b'ARROW1'):
+        return FORMAT_ARROW
+    if head.startswith(b'\xff\xff\xff\xff'):
+        return FORMAT_ARROW_STREAM
+    if head.startswith(b'PK\x03\x04'):
+        try:
+            with zipfile.ZipFile(path) as archive:
+                if any(name.startswith('xl/') for name in archive.namelist()):
+                    return FORMAT_EXCEL
+        except zipfile.BadZipFile:
+            pass
+        raise ValueError("Unsupported file format: zip archive is not an Excel workbook")
+    if b'\x00' in head:
+        raise ValueError("Unsupported file format")
+    return FORMAT_CSV
+
+
+def metadata_rows(path, file_format):
+    """عدد الصفوف من البيانات الوصفية لملفات Parquet/Arrow (None لبقية الصيغ)"""
+    try:
+        if file_format == FORMAT_PARQUET:
+            return _require_pyarrow('parquet').ParquetFile(path).metadata.num_rows
+        if file_format == FORMAT_ARROW:
+            import pyarrow as pa
+            reader = _require_pyarrow('ipc').open_file(pa.memory_map(path, 'r'))
+            return sum(reader.get_batch(i).num_rows for i in range(reader.num_record_batches))
+    except Exception:
+        return None
+    return None
+
+
+feature_schema = FeatureSchema()
@@ -0,0 +1,288 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from mysql.connector import Error
+
+from config import get_db_connection
+from result_store import ResultStoreWriter, open_results, records, store_filename
+from scoring import estimate_rows, score_upload
+
+# عدد المهام التي تُقيَّم في نفس الوقت
+JOB_WORKERS = 2
+# أقصى عدد مهام منتظرة أو قيد التنفيذ قبل رفض الطلبات الجديدة
+MAX_PENDING_JOBS = 32
+# أقل فترة بين تحديثات التقدم في قاعدة البيانات
+PROGRESS_FLUSH_SECONDS = 2.0
+# مدة الاحتفاظ بنتائج المهام المنتهية في الذاكرة
+JOB_RESULT_TTL_SECONDS = 3600
+
+USER_DATA_FOLDER = "user_data"
+# يُعاد مع نتيجة مهمة قُيّمت ولم تُحفظ تجربتها
+SAVE_FAILED_WARNING = "Results were scored but could not be saved to your history"
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, job_id, user_id, filename, path, save_data, status='queued', rows_processed=0):
+        self.id = job_id
+        self.user_id = user_id
+        self.filename = filename
+        self.path = path
+        self.save_data = save_data
+        self.status = status
+        self.rows_processed = rows_processed
+        self.rows_total = None
+        self.error = None
+        self.warning = None
+        self.result = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._last_flush = 0.0
+
+    def to_dict(self):
+        eta = None
+        if self.status == 'running' and self.rows_total and self.rows_processed:
+            elapsed = time.time() - self.started_at
+            remaining = max(self.rows_total - self.rows_processed, 0)
+            eta = round(elapsed / self.rows_processed * remaining, 1)
+        return {
+            "id": self.id,
+            "filename": self.filename,
+            "status": self.status,
+            "rows_processed": self.rows_processed,
+            "rows_total": self.rows_total,
+            "eta_seconds": eta,
+            "error": self.error,
+            "warning": self.warning,
+        }
+
+
+class JobManager:
+    """تشغيل تقييم الملفات في الخلفية مع حفظ الحالة في جدول user_experiments"""
+
+    def __init__(self, save_experiment, workers=JOB_WORKERS, max_pending=MAX_PENDING_JOBS):
+        self.save_experiment = save_experiment
+        self.workers = workers
+        self.max_pending = max_pending
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def _get_executor(self):
+        # يُنشأ عند أول مهمة حتى يعمل بعد fork في كل عامل على حدة
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="jobs")
+        return self._executor
+
+    def _pending_count(self):
+        return sum(1 for job in self._jobs.values() if job.status in ('queued', 'running'))
+
+    def _prune(self):
+        cutoff = time.time() - JOB_RESULT_TTL_SECONDS
+        for job_id in [j.id for j in self._jobs.values() if j.finished_at and j.finished_at < cutoff]:
+            del self._jobs[job_id]
+
+    def submit(self, user_id, filename, path, save_data, job_id=None):
+        """تسجيل مهمة جديدة وإرجاعها فوراً قبل بدء التقييم"""
+        with self._lock:
+            self._prune()
+            if self._pending_count() >= self.max_pending:
+                raise JobQueueFull("Too many scoring jobs in progress, try again later")
+            job = Job(job_id or str(uuid.uuid4()), user_id, filename, path, save_data)
+            self._jobs[job.id] = job
+            executor = self._get_executor()
+
+        if job_id is None:
+            self._insert(job)
+        executor.submit(self._run, job)
+        return job
+
+    def _insert(self, job):
+        connection = get_db_connection()
+        if connection:
+            try:
+                cursor = connection.cursor()
+                cursor.execute(
+                    """INSERT INTO user_experiments
+                    (id, user_id, filename, total_count, fraud_count, fraud_rate, created_at,
+                     is_temporary, status, rows_processed, upload_path)
+                    VALUES (%s, %s, %s, 0, 0, 0, %s, %s, %s, 0, %s)""",
+                    (job.id, job.user_id, job.filename, datetime.now(),
+                     not job.save_data, job.status, job.path)
+                )
+                connection.commit()
+            except Error as e:
+                logger.error("Error saving job %s: %s", job.id, e)
+            finally:
+                cursor.close()
+                connection.close()
+
+    def _persist(self, job):
+        connection = get_db_connection()
+        if connection:
+            try:
+                cursor = connection.cursor()
+                cursor.execute(
+                    "UPDATE user_experiments SET status = %s, rows_processed = %s, error = %s WHERE id = %s",
+                    (job.status, job.rows_processed, job.error, job.id)
+                )
+                connection.commit()
+            except Error as e:
+                logger.error("Error updating job %s: %s", job.id, e)
+            finally:
+                cursor.close()
+                connection.close()
+        job._last_flush = time.monotonic()
+
+    def _progress(self, job, rows):
+        job.rows_processed = rows
+        if time.monotonic() - job._last_flush >= PROGRESS_FLUSH_SECONDS:
+            self._persist(job)
+
+    def _run(self, job):
+        job.status = 'running'
+        job.started_at = time.time()
+        store = None
+        try:
+            job.rows_total = estimate_rows(job.path)
+            self._persist(job)
+            if job.save_data:
+                store = ResultStoreWriter(os.path.join(USER_DATA_FOLDER, store_filename(job.id)))
+            # CSV يُقرأ دائماً على دفعات حتى يظهر التقدم أثناء التقييم
+            response = {"success": True, **score_upload(job.path, stream=True, store=store,
+                                                        progress=lambda rows: self._progress(job, rows))}
+            response["filename"] = job.filename
+            response["experiment_id"] = job.id
+            if store is not None:
+                store.close()
+                store = None
+
+            saved = self.save_experiment(job.user_id, job.filename, response,
+                                         save_data=job.save_data, experiment_id=job.id)
+            if saved is None:
+                # التقييم نجح وقاعدة البيانات غير متاحة؛ النتيجة تبقى في الذاكرة مع تحذير
+                logger.warning("Job %s scored but its experiment was not saved", job.id)
+                job.warning = SAVE_FAILED_WARNING
+                response["warning"] = SAVE_FAILED_WARNING
+                response.pop("experiment_id")
+            job.result = response
+            job.rows_total = job.rows_processed = response['total_count']
+            job.status = 'done'
+            logger.debug("✅ Job %s complete: %s fraud cases out of %s",
+                         job.id, response['fraud_count'], response['total_count'])
+        except Exception as e:
+            logger.exception("Job %s failed: %s", job.id, e)
+            job.status = 'failed'
+            job.error = str(e)
+            self._persist(job)
+        finally:
+            if store is not None:
+                store.abort()
+            job.finished_at = time.time()
+            if job.path and os.path.exists(job.path):
+                os.remove(job.path)
+
+    def _load(self, job_id):
+        connection = get_db_connection()
+        if connection:
+            try:
+                cursor = connection.cursor(dictionary=True)
+                cursor.execute("SELECT * FROM user_experiments WHERE id = %s", (job_id,))
+                return cursor.fetchone()
+            except Error as e:
+                logger.error("Error loading job %s: %s", job_id, e)
+            finally:
+                cursor.close()
+                connection.close()
+        return None
+
+    def get(self, job_id):
+        """حالة المهمة من الذاكرة أو من قاعدة البيانات بعد إعادة التشغيل"""
+        job = self._jobs.get(job_id)
+        if job:
+            return job.user_id, job.to_dict()
+        row = self._load(job_id)
+        if not row:
+            return None
+        return row['user_id'], {
+            "id": row['id'],
+            "filename": row['filename'],
+            "status": row.get('status') or 'done',
+            "rows_processed": row.get('rows_processed') or row['total_count'],
+            "rows_total": row['total_count'] if row.get('status', 'done') == 'done' else None,
+            "eta_seconds": None,
+            "error": row.get('error'),
+        }
+
+    def result(self, job_id):
+        """النتيجة النهائية للمهمة أو None إذا لم تنتهِ بعد"""
+        job = self._jobs.get(job_id)
+        if job:
+            return job.result
+        row = self._load(job_id)
+        if not row or (row.get('status') or 'done') != 'done':
+            return None
+        data = []
+        if row.get('result_filename'):
+            result_path = os.path.join(USER_DATA_FOLDER, row['result_filename'])
+            if os.path.exists(result_path):
+                results = open_results(result_path)
+                data = records(results.read(0, 50))
+                explanations = results.attachment('explanations') or {}
+                for position, record in enumerate(data):
+                    if str(position) in explanations:
+                        record['explanation'] = explanations[str(position)]
+        rollup = json.loads(row['rollup']) if row.get('rollup') else None
+        return {
+            "success": True,
+            "total_count": row['total_count'],
+            "fraud_count": row['fraud_count'],
+            "fraud_rate": float(row['fraud_rate']),
+            "data": data,
+            "filename": row['filename'],
+            "experiment_id": row['id'],
+            "highest_fraud_amount": rollup['highest_fraud_amount'] if rollup else None,
+            "most_common_type": rollup['most_common_type'] if rollup else None,
+            "rollup": rollup,
+        }
+
+    def recover(self):
+        """إعادة جدولة المهام التي انقطعت بسبب إعادة تشغيل الخادم"""
+        connection = get_db_connection()
+        if not connection:
+            return
+        try:
+            cursor = connection.cursor(dictionary=True)
+            cursor.execute(
+                "SELECT id, user_id, filename, upload_path, is_temporary FROM user_experiments "
+                "WHERE status IN ('queued', 'running')"
+            )
+            rows = cursor.fetchall()
+            for row in rows:
+                if row['upload_path'] and os.path.exists(row['upload_path']):
+                    logger.info("🔁 Resuming job %s", row['id'])
+                    self.submit(row['user_id'], row['filename'], row['upload_path'],
+                                not row['is_temporary'], job_id=row['id'])
+                else:
+                    cursor.execute(
+                        "UPDATE user_experiments SET status = 'failed', error = %s WHERE id = %s",
+                        ("Interrupted by server restart", row['id'])
+                    )
+            connection.commit()
+        except Error as e:
+            logger.error("Error recovering jobs: %s", e)
+        finally:
+            cursor.close()
+            connection.close()
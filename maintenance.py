@@ -0,0 +1,396 @@
+"""صيانة دورية لمساحة التخزين وجدول التجارب
+
+python maintenance.py  (تشغيل واحد، مثلاً من cron)
+
+في كل دورة:
+- حذف صفوف تجارب الضيوف (is_temporary) المنتهية على دفعات صغيرة
+- حذف نتائج المستخدمين الأقدم من RESULT_TTL_DAYS أو الزائدة عن حصة المستخدم
+- ضغط النتائج الأقدم من COMPACT_AFTER_DAYS في أرشيف يبقى قابلاً للقراءة
+- حذف نسخ التصدير القديمة والملفات المرفوعة المتروكة والنتائج غير المرتبطة بأي تجربة
+
+كل عامل يشغّل خيط الصيانة، لكن قفل الملف يضمن أن دورة واحدة فقط تعمل
+على نفس المجلد في نفس الوقت وأنها لا تتكرر قبل انقضاء الفترة.
+"""
+import fcntl
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from mysql.connector import Error
+
+from config import get_db_connection
+from metrics import Gauge, registry
+from result_export import EXPORTS_DIR
+from result_store import ARCHIVE_SUFFIX, archive_results, results_size
+
+USER_DATA_FOLDER = "user_data"
+UPLOAD_FOLDER = "uploads"
+# الفترة بين دورات الصيانة
+MAINTENANCE_INTERVAL_SECONDS = int(os.environ.get('MAINTENANCE_INTERVAL_SECONDS', 3600))
+# مدة الاحتفاظ بنتائج المستخدمين المحفوظة (0 يعطل الحذف حسب العمر)
+RESULT_TTL_DAYS = int(os.environ.get('RESULT_TTL_DAYS', 180))
+# أقصى مساحة لنتائج كل مستخدم؛ الأقدم يُحذف أولاً عند التجاوز (0 يعطل الحصة)
+USER_QUOTA_BYTES = int(os.environ.get('USER_QUOTA_BYTES', 2 * 1024 ** 3))
+# النتائج الأقدم من هذه المدة تُضغط في أرشيف (0 يعطل الضغط)
+COMPACT_AFTER_DAYS = int(os.environ.get('COMPACT_AFTER_DAYS', 14))
+# أقصى عدد تجارب تُضغط في الدورة الواحدة حتى لا تطول
+MAX_COMPACTIONS_PER_RUN = 200
+# صفوف تجارب الضيوف تُحذف بعد هذه المدة
+GUEST_TTL_HOURS = int(os.environ.get('GUEST_TTL_HOURS', 24))
+# أقصى عدد صفوف ضيوف في الجدول؛ الأقدم يُحذف أولاً
+GUEST_MAX_ROWS = int(os.environ.get('GUEST_MAX_ROWS', 100_000))
+# عدد الصفوف في كل DELETE حتى لا يُقفل الجدول طويلاً، مع استراحة بين الدفعات
+DELETE_BATCH_ROWS = 1000
+DELETE_BATCH_PAUSE_SECONDS = 0.05
+# الملفات المرفوعة غير المرتبطة بمهمة جارية تُحذف بعد هذه المدة
+UPLOAD_STALE_SECONDS = 6 * 3600
+# نسخ التصدير الجاهزة تُحذف بعد هذه المدة وتُبنى من جديد عند الطلب
+EXPORT_TTL_SECONDS = 24 * 3600
+# النتائج غير المرتبطة بأي تجربة تُحذف بعد هذه المدة (تغطي الكتابة الجارية قبل حفظ الصف)
+ORPHAN_GRACE_SECONDS = 24 * 3600
+# انتظار أول دورة بعد الإقلاع
+MAINTENANCE_START_DELAY_SECONDS = 60
+# ملف القفل بين العمليات؛ محتواه وقت انتهاء آخر دورة
+LOCK_FILE = ".maintenance.lock"
+
+logger = logging.getLogger(__name__)
+
+
+def _age(path, now):
+    try:
+        return now - os.path.getmtime(path)
+    except OSError:
+        return 0
+
+
+def _remove(path):
+    """حذف ملف أو مجلد وإرجاع المساحة المحررة"""
+    size = results_size(path)
+    try:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+        else:
+            return 0
+    except OSError as e:
+        logger.warning("Could not remove %s: %s", path, e)
+        return 0
+    return size
+
+
+class StorageMaintenance:
+    """فرض مدد الاحتفاظ والحصص وضغط النتائج القديمة في الخلفية"""
+
+    def __init__(self, user_data_folder=USER_DATA_FOLDER, upload_folder=UPLOAD_FOLDER,
+                 interval=MAINTENANCE_INTERVAL_SECONDS):
+        self.user_data_folder = user_data_folder
+        self.upload_folder = upload_folder
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._stop = threading.Event()
+        self.removed = defaultdict(int)
+        self.freed_bytes = 0
+        self.storage_bytes = {}
+        self.last_run = None
+        self.last_duration = None
+
+    def start(self):
+        """تشغيل خيط الصيانة في هذه العملية (مرة واحدة لكل عملية بعد fork)"""
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._loop, name="maintenance", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self):
+        # الدورة الأولى بعد الإقلاع بقليل حتى لا تبطئ تحميل الخادم
+        if self._stop.wait(min(MAINTENANCE_START_DELAY_SECONDS, self.interval)):
+            return
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.exception("Storage maintenance failed: %s", e)
+            self._stop.wait(self.interval)
+
+    def run_once(self, force=False):
+        """دورة صيانة واحدة إذا لم تعمل عملية أخرى خلال الفترة؛ يرجع الإحصائيات أو None"""
+        os.makedirs(self.user_data_folder, exist_ok=True)
+        with open(os.path.join(self.user_data_folder, LOCK_FILE), 'a+') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                # عملية أخرى تعمل الآن
+                return None
+            try:
+                lock_file.seek(0)
+                content = lock_file.read().strip()
+                last_run = float(content) if content else 0.0
+                # العمال يستيقظون في أوقات مختلفة؛ من يجد دورة حديثة يتخطى
+                if not force and time.time() - last_run < self.interval * 0.9:
+                    return None
+                self._run()
+                lock_file.seek(0)
+                lock_file.truncate()
+                lock_file.write(str(time.time()))
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        return self.stats()
+
+    def _run(self):
+        start = time.perf_counter()
+        connection = get_db_connection()
+        referenced = None
+        active_uploads = None
+        if connection:
+            try:
+                self._purge_guest_rows(connection)
+                rows = self._load_results(connection)
+                # الأسماء قبل الضغط تبقى "مرتبطة" في هذه الدورة فتُحذف النسخ المستبدلة في الدورة التالية
+                referenced = {row['result_filename'] for row in rows}
+                rows = self._expire_results(connection, rows)
+                rows = self._enforce_quotas(connection, rows)
+                referenced |= self._compact(connection, rows)
+                active_uploads = self._active_uploads(connection)
+            except Error as e:
+                logger.error("Storage maintenance database step failed: %s", e)
+                referenced = active_uploads = None
+            finally:
+                connection.close()
+
+        # بدون قاعدة البيانات لا يُعرف ما هو مرتبط بتجربة، فلا يُحذف شيء من الملفات
+        if referenced is not None:
+            self._sweep_user_data(referenced)
+        if active_uploads is not None:
+            self._sweep_uploads(active_uploads)
+        self.storage_bytes = {
+            "results": results_size(self.user_data_folder),
+            "uploads": results_size(self.upload_folder),
+        }
+        self.last_run = time.time()
+        self.last_duration = time.perf_counter() - start
+        logger.info("Storage maintenance finished in %.1fs: %s", self.last_duration, dict(self.removed))
+
+    def _delete_in_batches(self, connection, query, params):
+        """تنفيذ DELETE ... LIMIT على دفعات مع تثبيت كل دفعة حتى لا تطول الأقفال"""
+        cursor = connection.cursor()
+        total = 0
+        try:
+            while True:
+                cursor.execute(query, (*params, DELETE_BATCH_ROWS))
+                connection.commit()
+                total += cursor.rowcount
+                if cursor.rowcount < DELETE_BATCH_ROWS:
+                    return total
+                time.sleep(DELETE_BATCH_PAUSE_SECONDS)
+        finally:
+            cursor.close()
+
+    def _purge_guest_rows(self, connection):
+        # المهام الجارية تبقى حتى تنتهي مهما كان عمرها
+        finished = "is_temporary = TRUE AND status IN ('done', 'failed')"
+        cutoff = datetime.now() - timedelta(hours=GUEST_TTL_HOURS)
+        deleted = self._delete_in_batches(
+            connection,
+            f"DELETE FROM user_experiments WHERE {finished} AND created_at < %s ORDER BY created_at LIMIT %s",
+            (cutoff,))
+
+        cursor = connection.cursor()
+        try:
+            cursor.execute(
+                "SELECT created_at FROM user_experiments WHERE is_temporary = TRUE "
+                "ORDER BY created_at DESC LIMIT 1 OFFSET %s", (GUEST_MAX_ROWS,))
+            rows = cursor.fetchall()
+        finally:
+            cursor.close()
+        if rows:
+            deleted += self._delete_in_batches(
+                connection,
+                f"DELETE FROM user_experiments WHERE {finished} AND created_at <= %s ORDER BY created_at LIMIT %s",
+                (rows[0][0],))
+        self.removed['guest_rows'] += deleted
+
+    def _load_results(self, connection):
+        """التجارب التي لها نتائج محفوظة مع حجمها (يُحسب ويُخزَّن إذا لم يكن معروفاً)"""
+        cursor = connection.cursor(dictionary=True)
+        try:
+            cursor.execute(
+                "SELECT id, user_id, result_filename, result_bytes, created_at FROM user_experiments "
+                "WHERE result_filename IS NOT NULL"
+            )
+            rows = cursor.fetchall()
+            unknown = [row for row in rows if row['result_bytes'] is None]
+            for row in unknown:
+                row['result_bytes'] = results_size(os.path.join(self.user_data_folder, row['result_filename']))
+            if unknown:
+                cursor.executemany("UPDATE user_experiments SET result_bytes = %s WHERE id = %s",
+                                   [(row['result_bytes'], row['id']) for row in unknown])
+                connection.commit()
+            return rows
+        finally:
+            cursor.close()
+
+    def _drop_results(self, connection, rows, reason):
+        """فك ارتباط النتائج بالتجارب ثم حذف ملفاتها؛ صف التجربة وأرقامها يبقيان"""
+        if not rows:
+            return
+        cursor = connection.cursor()
+        try:
+            cursor.executemany(
+                "UPDATE user_experiments SET result_filename = NULL, result_bytes = NULL "
+                "WHERE id = %s AND result_filename = %s",
+                [(row['id'], row['result_filename']) for row in rows])
+            connection.commit()
+        finally:
+            cursor.close()
+        for row in rows:
+            path = os.path.join(self.user_data_folder, row['result_filename'])
+            self.freed_bytes += _remove(path) + _remove(f"{path}.{EXPORTS_DIR}")
+        self.removed[reason] += len(rows)
+
+    def _expire_results(self, connection, rows):
+        if not RESULT_TTL_DAYS:
+            return rows
+        cutoff = datetime.now() - timedelta(days=RESULT_TTL_DAYS)
+        expired = [row for row in rows if row['created_at'] < cutoff]
+        self._drop_results(connection, expired, 'expired_results')
+        return [row for row in rows if row['created_at'] >= cutoff]
+
+    def _enforce_quotas(self, connection, rows):
+        if not USER_QUOTA_BYTES:
+            return rows
+        by_user = defaultdict(list)
+        for row in rows:
+            by_user[row['user_id']].append(row)
+        evicted = []
+        for user_rows in by_user.values():
+            used = 0
+            # الأحدث أولاً: ما يتجاوز الحصة بعد جمع الأحدث يُحذف
+            for row in sorted(user_rows, key=lambda r: r['created_at'], reverse=True):
+                used += row['result_bytes'] or 0
+                if used > USER_QUOTA_BYTES:
+                    evicted.append(row)
+        self._drop_results(connection, evicted, 'quota_evictions')
+        evicted_ids = {row['id'] for row in evicted}
+        return [row for row in rows if row['id'] not in evicted_ids]
+
+    def _compact(self, connection, rows):
+        """ضغط النتائج القديمة؛ يرجع أسماء الأرشيفات الجديدة"""
+        if not COMPACT_AFTER_DAYS:
+            return set()
+        cutoff = datetime.now() - timedelta(days=COMPACT_AFTER_DAYS)
+        candidates = [row for row in rows if row['created_at'] < cutoff
+                      and not row['result_filename'].endswith((ARCHIVE_SUFFIX, '.gz'))]
+        archived = set()
+        cursor = connection.cursor()
+        try:
+            for row in sorted(candidates, key=lambda r: r['created_at'])[:MAX_COMPACTIONS_PER_RUN]:
+                path = os.path.join(self.user_data_folder, row['result_filename'])
+                if not os.path.exists(path):
+                    continue
+                try:
+                    target = archive_results(path)
+                except (OSError, ValueError) as e:
+                    logger.warning("Could not compact %s: %s", path, e)
+                    continue
+                name = os.path.basename(target)
+                cursor.execute(
+                    "UPDATE user_experiments SET result_filename = %s, result_bytes = %s "
+                    "WHERE id = %s AND result_filename = %s",
+                    (name, os.path.getsize(target), row['id'], row['result_filename']))
+                connection.commit()
+                archived.add(name)
+                self.removed['compacted'] += 1
+        finally:
+            cursor.close()
+        return archived
+
+    def _active_uploads(self, connection):
+        cursor = connection.cursor()
+        try:
+            cursor.execute(
+                "SELECT upload_path FROM user_experiments "
+                "WHERE status IN ('queued', 'running') AND upload_path IS NOT NULL"
+            )
+            return {os.path.abspath(path) for (path,) in cursor.fetchall()}
+        finally:
+            cursor.close()
+
+    def _sweep_exports(self, directory, now):
+        for entry in os.scandir(directory):
+            if entry.is_file() and now - entry.stat().st_mtime > EXPORT_TTL_SECONDS:
+                self.freed_bytes += _remove(entry.path)
+                self.removed['exports'] += 1
+        try:
+            if not os.listdir(directory):
+                os.rmdir(directory)
+        except OSError:
+            # تصدير جديد بدأ في نفس اللحظة
+            pass
+
+    def _sweep_user_data(self, referenced):
+        """مسح واحد لمجلد النتائج: نسخ التصدير القديمة والنتائج غير المرتبطة بتجربة"""
+        now = time.time()
+        suffix = f".{EXPORTS_DIR}"
+        for entry in os.scandir(self.user_data_folder):
+            if entry.name.startswith('.'):
+                continue
+            if entry.name.endswith(suffix) and entry.name[:-len(suffix)] in referenced:
+                self._sweep_exports(entry.path, now)
+            elif entry.name in referenced:
+                exports = os.path.join(entry.path, EXPORTS_DIR)
+                if entry.is_dir() and os.path.isdir(exports):
+                    self._sweep_exports(exports, now)
+            elif _age(entry.path, now) > ORPHAN_GRACE_SECONDS:
+                # مخازن بدون صف، كتابة متوقفة (.tmp)، أو نسخة استُبدلت بأرشيف في دورة سابقة
+                self.freed_bytes += _remove(entry.path)
+                self.removed['orphans'] += 1
+
+    def _sweep_uploads(self, active_uploads):
+        if not os.path.isdir(self.upload_folder):
+            return
+        now = time.time()
+        for entry in os.scandir(self.upload_folder):
+            if os.path.abspath(entry.path) in active_uploads:
+                continue
+            if _age(entry.path, now) > UPLOAD_STALE_SECONDS:
+                self.freed_bytes += _remove(entry.path)
+                self.removed['stale_uploads'] += 1
+
+    def stats(self):
+        return {
+            "last_run": datetime.fromtimestamp(self.last_run).isoformat() if self.last_run else None,
+            "last_duration_seconds": round(self.last_duration, 3) if self.last_duration is not None else None,
+            "storage_bytes": dict(self.storage_bytes),
+            "freed_bytes": self.freed_bytes,
+            "removed": dict(self.removed),
+        }
+
+
+storage_maintenance = StorageMaintenance()
+
+registry.register(Gauge(
+    'fraud_storage_bytes', 'Disk used by saved results and uploads at the last maintenance run',
+    lambda: dict(storage_maintenance.storage_bytes), labelnames=('area',)))
+registry.register(Gauge(
+    'fraud_storage_maintenance_removed', 'Items removed or compacted by storage maintenance in this process',
+    lambda: dict(storage_maintenance.removed), labelnames=('kind',)))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO').upper(),
+                        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    print(json.dumps(storage_maintenance.run_once(force=True), indent=2))
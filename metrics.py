@@ -0,0 +1,173 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# حدود المدرجات الزمنية (بالثواني) من أجزاء المللي ثانية حتى دقائق
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+ROW_BUCKETS = (1, 10, 100, 1_000, 10_000, 100_000, 1_000_000, 10_000_000)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+            lines.extend(self._render_samples(items))
+        return lines
+
+
+class Gauge(Metric):
+    """قيمة لحظية تُقرأ من دالة عند كل طلب لـ /metrics"""
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, callback, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        # callback ترجع رقماً، أو قاموساً {قيم الوسوم: رقم} عند وجود وسوم
+        self.callback = callback
+
+    def render(self):
+        value = self.callback()
+        items = sorted(value.items()) if self.labelnames else [((), value)]
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for key, sample in items:
+            key = key if isinstance(key, tuple) else (key,)
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(sample)}")
+        return lines
+
+
+class Histogram(Metric):
+    """مدرج تكراري تراكمي بصيغة Prometheus (bucket/sum/count)"""
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def totals(self):
+        """مجموع القيم المرصودة لكل قيم وسوم {(...): ثوانٍ} (لقياس الفروق في أدوات القياس)"""
+        with self._lock:
+            return {key: state[1] for key, state in self._values.items()}
+
+    def _render_samples(self, items):
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, [('le', _format_value(float(bound)))])
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum{labels} {_format_value(total)}"
+            yield f"{self.name}_count{labels} {count}"
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        """كل المقاييس بصيغة Prometheus النصية"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception:
+                # مقياس معطوب لا يُسقط صفحة المقاييس كاملة
+                continue
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+stage_seconds = registry.register(Histogram(
+    'fraud_stage_seconds', 'Time spent in each scoring pipeline stage', labelnames=('stage',)))
+upload_rows = registry.register(Histogram(
+    'fraud_upload_rows', 'Rows scored per uploaded file', buckets=ROW_BUCKETS))
+model_predict_seconds = registry.register(Histogram(
+    'fraud_model_predict_seconds', 'CatBoost predict_proba latency per call', labelnames=('model', 'model_version')))
+model_predict_rows = registry.register(Histogram(
+    'fraud_model_predict_rows', 'Rows per CatBoost predict_proba call', buckets=ROW_BUCKETS))
+db_query_seconds = registry.register(Histogram(
+    'fraud_db_query_seconds', 'MySQL statement latency by statement type', labelnames=('operation',)))
+db_pool_wait_seconds = registry.register(Histogram(
+    'fraud_db_pool_wait_seconds', 'Time spent obtaining a pooled MySQL connection'))
+http_request_seconds = registry.register(Histogram(
+    'fraud_http_request_seconds', 'HTTP request latency by endpoint', labelnames=('endpoint', 'method', 'status')))
+
+
+@contextmanager
+def stage(name):
+    """قياس مرحلة من مسار التقييم"""
+    with stage_seconds.time(stage=name):
+        yield
+
+
+def timed_iter(iterable, name):
+    """تمرير عناصر iterable مع احتساب زمن جلب كل عنصر ضمن المرحلة name"""
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            stage_seconds.observe(time.perf_counter() - start, stage=name)
+            return
+        stage_seconds.observe(time.perf_counter() - start, stage=name)
+        yield item
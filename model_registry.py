@@ -0,0 +1,145 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+
+from catboost import CatBoostClassifier
+
+from feature_engine import MODEL_FEATURES, model_features
+
+MODEL_PATH = "fra_catboost_model.cbm"
+# كل النماذج المرفقة؛ تختلف في الأعمدة وعدد الأشجار (وبالتالي كلفة التقييم)
+MODEL_FILES = [
+    "fra_catboost_model.cbm",
+    "fraud_model.cbm",
+    "catboost_model.cbm",
+    "fraud_catboost_model.cbm",
+]
+
+logger = logging.getLogger(__name__)
+
+
+def file_sha256(path, block_size=1 << 20):
+    """حساب بصمة الملف لمعرفة ما إذا تغيّر محتواه فعلاً"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def model_name(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+class LoadedModel:
+    """نسخة محمّلة من النموذج مع بياناتها المحسوبة مسبقاً (لا تتغير بعد الإنشاء)"""
+
+    def __init__(self, path, model, version, mtime, size):
+        self.path = path
+        self.name = model_name(path)
+        self.model = model
+        self.version = version
+        self.mtime = mtime
+        self.size = size
+        self.feature_names = list(model.feature_names_)
+        # كلفة تقريبية لكل صف: عدد الأشجار × العمق
+        self.cost = model.tree_count_ * (model.get_all_params().get('depth') or 6)
+        self.loaded_at = time.time()
+        # خطة محاذاة الأعمدة لكل شكل من أشكال الإدخال
+        self._alignment_plans = {}
+
+    def alignment_plan(self, columns):
+        """الأعمدة الناقصة لشكل إدخال معين: ما يمكن اشتقاقه وما يُعبَّأ بصفر"""
+        key = tuple(columns)
+        plan = self._alignment_plans.get(key)
+        if plan is None:
+            present = set(key)
+            missing = [c for c in self.feature_names if c not in present]
+            derived = [c for c in missing if c in MODEL_FEATURES]
+            plan = (derived, [c for c in missing if c not in MODEL_FEATURES])
+            self._alignment_plans[key] = plan
+        return plan
+
+    def align(self, df):
+        """ترتيب الأعمدة حسب ما تدرب عليه النموذج"""
+        derived, zeros = self.alignment_plan(df.columns)
+        if derived:
+            df = model_features(df, derived)
+        if zeros:
+            df = df.assign(**{col: 0 for col in zeros})
+        return df[self.feature_names]
+
+
+class ModelRegistry:
+    """سجل مشترك للنموذج: تحميل مرة واحدة وإعادة تحميل ذرية عند تغيّر الملف"""
+
+    def __init__(self, model_path=MODEL_PATH, check_interval=2.0):
+        self.model_path = model_path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._current = None
+        self._last_check = 0.0
+        self._listeners = []
+
+    def add_listener(self, callback):
+        """تسجيل دالة تُستدعى بالنموذج الجديد كلما تغيّرت نسخته"""
+        self._listeners.append(callback)
+
+    def _load(self):
+        stat = os.stat(self.model_path)
+        version = file_sha256(self.model_path)
+        if self._current is not None and self._current.version == version:
+            # تغيّر وقت التعديل فقط وليس المحتوى
+            self._current.mtime = stat.st_mtime
+            self._current.size = stat.st_size
+            return self._current
+
+        model = CatBoostClassifier()
+        model.load_model(self.model_path)
+        loaded = LoadedModel(self.model_path, model, version, stat.st_mtime, stat.st_size)
+        # استبدال المرجع دفعة واحدة حتى لا يرى أي طلب نموذجاً نصف محمّل
+        previous, self._current = self._current, loaded
+        logger.info("Model loaded from %s (version %s)", self.model_path, version[:12])
+        if previous is not None:
+            for callback in self._listeners:
+                callback(loaded)
+        return loaded
+
+    def _is_stale(self):
+        current = self._current
+        try:
+            stat = os.stat(self.model_path)
+        except OSError:
+            # إبقاء النسخة الحالية إذا اختفى الملف مؤقتاً أثناء الاستبدال
+            return False
+        return stat.st_mtime != current.mtime or stat.st_size != current.size
+
+    def get(self):
+        """إرجاع النموذج الحالي مع التحقق الدوري من تغيّر الملف"""
+        current = self._current
+        now = time.monotonic()
+        if current is not None and now - self._last_check < self.check_interval:
+            return current
+
+        with self._lock:
+            if self._current is None:
+                self._load()
+            elif now - self._last_check >= self.check_interval and self._is_stale():
+                try:
+                    self._load()
+                except Exception as e:
+                    logger.error("Error reloading model, keeping version %s: %s", self._current.version[:12], e)
+            self._last_check = now
+            return self._current
+
+    def reload(self):
+        """إعادة تحميل فورية بغض النظر عن فترة التحقق"""
+        with self._lock:
+            self._load()
+            self._last_check = time.monotonic()
+            return self._current
+
+
+model_registry = ModelRegistry()
@@ -0,0 +1,257 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from metrics import Gauge, registry
+from model_registry import MODEL_FILES, MODEL_PATH, ModelRegistry, model_name, model_registry
+from scoring import add_batch_listener, predict_probas
+
+# النماذج التي تُقيَّم في الظل بجانب النموذج الأساسي (أسماء بدون .cbm مفصولة بفواصل)
+SHADOW_MODELS = [name for name in os.environ.get('SHADOW_MODELS', '').split(',') if name]
+# ميزانية زمن التقييم الفوري بالمللي ثانية؛ بدونها يُستخدم النموذج الأساسي دائماً
+ROUTING_BUDGET_MS = float(os.environ['ROUTING_BUDGET_MS']) if os.environ.get('ROUTING_BUDGET_MS') else None
+# أقل اتفاق مع النموذج الأساسي (من التقييم الظلي) لنموذج يُوجَّه إليه عند تجاوز الميزانية
+ROUTING_MIN_AGREEMENT = float(os.environ.get('ROUTING_MIN_AGREEMENT', 0.98))
+# عدد الصفوف المقارنة قبل الوثوق بنسبة الاتفاق
+ROUTING_MIN_COMPARED_ROWS = 1_000
+# أقصى عدد صفوف من كل دفعة تُقيَّم في الظل (عينة موزعة بانتظام)
+SHADOW_MAX_ROWS = 10_000
+# الدفعات الظلية المنتظرة؛ الزائد يُهمل حتى لا يتأخر المسار الأساسي
+SHADOW_MAX_PENDING = 4
+# عدد القياسات الأخيرة المحفوظة لكل نموذج
+LATENCY_WINDOW = 512
+
+logger = logging.getLogger(__name__)
+
+
+class ModelStats:
+    """زمن التقييم لكل نموذج ومدى اتفاقه مع النموذج الأساسي"""
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self.calls = 0
+        self.rows = 0
+        self.seconds = 0.0
+        self.samples = deque(maxlen=window)
+        self.compared = 0
+        self.agreed = 0
+        self.abs_diff = 0.0
+        self.flagged = 0
+        self.champion_flagged = 0
+        self.dropped = 0
+
+    def record(self, rows, seconds):
+        self.calls += 1
+        self.rows += rows
+        self.seconds += seconds
+        self.samples.append((rows, seconds * 1000))
+
+    def estimate_ms(self, rows):
+        """الزمن المتوقع لدفعة بحجم rows من قياسات دفعات بحجم قريب"""
+        if not self.samples:
+            return None
+        samples = np.array(self.samples, dtype=np.float64)
+        sizes = np.maximum(samples[:, 0], 1)
+        near = (sizes >= rows / 2) & (sizes <= rows * 2)
+        if near.any():
+            samples, sizes = samples[near], sizes[near]
+        return float(np.median(samples[:, 1] / sizes) * max(rows, 1))
+
+    def to_dict(self):
+        latencies = np.array([ms for _, ms in self.samples]) if self.samples else np.zeros(1)
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        return {
+            "calls": self.calls,
+            "rows": self.rows,
+            "ms_per_1k_rows": round(self.seconds * 1000 / self.rows * 1000, 3) if self.rows else None,
+            "p50_ms": round(float(p50), 3),
+            "p95_ms": round(float(p95), 3),
+            "p99_ms": round(float(p99), 3),
+            "compared_rows": self.compared,
+            "agreement": round(self.agreed / self.compared, 4) if self.compared else None,
+            "mean_abs_probability_diff": round(self.abs_diff / self.compared, 4) if self.compared else None,
+            "fraud_rate": round(self.flagged / self.compared, 4) if self.compared else None,
+            "champion_fraud_rate": round(self.champion_flagged / self.compared, 4) if self.compared else None,
+            "dropped_batches": self.dropped,
+        }
+
+
+class ModelSet:
+    """عدة نماذج محمّلة جنباً إلى جنب: نموذج أساسي ونماذج ظل وسياسة اختيار حسب الزمن"""
+
+    def __init__(self, paths=MODEL_FILES, champion=MODEL_PATH, shadows=SHADOW_MODELS, champion_registry=None):
+        self.registries = {
+            model_name(path): champion_registry if champion_registry and path == champion else ModelRegistry(path)
+            for path in paths
+        }
+        self.champion = model_name(champion)
+        if self.champion not in self.registries:
+            raise ValueError(f"Champion model {champion} is not in the model set")
+        unknown = [name for name in shadows if name not in self.registries]
+        if unknown:
+            raise ValueError(f"Unknown shadow models: {', '.join(unknown)}")
+        self.shadows = [name for name in shadows if name != self.champion]
+        self._stats = {name: ModelStats() for name in self.registries}
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pending = 0
+
+    def get(self, name=None):
+        return self.registries[name or self.champion].get()
+
+    def load(self):
+        """تحميل كل النماذج عند الإقلاع حتى لا يُحمَّل أي منها داخل طلب"""
+        for name in self.registries:
+            loaded = self.get(name)
+            logger.info("Loaded model %s (version %s)", name, loaded.version[:12])
+
+    def _loaded(self, name):
+        # النموذج المحمّل حالياً بدون تحميل (مسار الطلب لا يقرأ ملفات النماذج)
+        return self.registries[name]._current
+
+    def _get_executor(self):
+        # يُنشأ عند أول استخدام حتى لا تُورَّث خيوطه عبر fork
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shadow")
+        return self._executor
+
+    def record(self, name, rows, seconds):
+        with self._lock:
+            self._stats[name].record(rows, seconds)
+
+    def on_batch(self, prepared, loaded, probas, seconds):
+        """يُستدعى بعد كل دفعة: تسجيل الزمن وإرسال عينة للتقييم الظلي"""
+        if loaded.name not in self._stats:
+            return
+        self.record(loaded.name, len(prepared), seconds)
+        if loaded.name != self.champion or not self.shadows or len(prepared) == 0:
+            return
+
+        with self._lock:
+            if self._pending >= SHADOW_MAX_PENDING:
+                for name in self.shadows:
+                    self._stats[name].dropped += 1
+                return
+            self._pending += 1
+
+        if len(prepared) > SHADOW_MAX_ROWS:
+            rows = np.linspace(0, len(prepared) - 1, SHADOW_MAX_ROWS).astype(int)
+            prepared, probas = prepared.iloc[rows], probas[rows]
+        self._get_executor().submit(self._shadow, prepared, np.asarray(probas))
+
+    def _shadow(self, prepared, champion_probas):
+        try:
+            for name in self.shadows:
+                try:
+                    self.compare(name, prepared, champion_probas)
+                except Exception as e:
+                    logger.error("Shadow scoring with %s failed: %s", name, e)
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    def compare(self, name, prepared, champion_probas):
+        """تقييم نفس الدفعة المحضّرة بنموذج آخر ومقارنة قراراته بالنموذج الأساسي"""
+        loaded = self.get(name)
+        # خيط واحد حتى لا ينافس التقييم الظلي الطلبات على الأنوية
+        start = time.perf_counter()
+        probas = predict_probas(loaded.align(prepared), loaded, workers=1)
+        seconds = time.perf_counter() - start
+
+        shadow_flags = probas > 0.5
+        champion_flags = champion_probas > 0.5
+        with self._lock:
+            stats = self._stats[name]
+            stats.record(len(prepared), seconds)
+            stats.compared += len(prepared)
+            stats.agreed += int((shadow_flags == champion_flags).sum())
+            stats.abs_diff += float(np.abs(probas - champion_probas).sum())
+            stats.flagged += int(shadow_flags.sum())
+            stats.champion_flagged += int(champion_flags.sum())
+        return probas
+
+    def estimate_ms(self, name, rows):
+        """الزمن المتوقع؛ النماذج غير المقاسة تُقدَّر من كلفتها النسبية لنموذج مقاس"""
+        with self._lock:
+            estimate = self._stats[name].estimate_ms(rows)
+            if estimate is not None:
+                return estimate
+            measured = [(n, self._stats[n].estimate_ms(rows)) for n in self.registries]
+        measured = [(n, ms) for n, ms in measured if ms is not None and self._loaded(n) is not None]
+        if not measured or self._loaded(name) is None:
+            return None
+        reference, reference_ms = measured[0]
+        return reference_ms * self._loaded(name).cost / self._loaded(reference).cost
+
+    def _agreeing(self):
+        """النماذج التي بلغ اتفاقها المقاس مع الأساسي ROUTING_MIN_AGREEMENT: {الاسم: الاتفاق}"""
+        with self._lock:
+            return {name: stats.agreed / stats.compared for name, stats in self._stats.items()
+                    if name != self.champion and stats.compared >= ROUTING_MIN_COMPARED_ROWS
+                    and stats.agreed / stats.compared >= ROUTING_MIN_AGREEMENT}
+
+    def route(self, rows, budget_ms=None):
+        """اسم النموذج الذي يُستخدم لدفعة بحجم rows ضمن ميزانية الزمن
+
+        الأساسي إذا كان ضمن الميزانية أو لم يُقس بعد. البدائل هي فقط النماذج
+        التي ثبت اتفاقها معه في التقييم الظلي؛ بدون بيانات اتفاق يبقى الأساسي.
+        من البدائل يُختار الأعلى اتفاقاً ضمن الميزانية، وإلا الأسرع إن كان
+        أسرع من الأساسي.
+        """
+        if budget_ms is None:
+            return self.champion
+        champion_ms = self.estimate_ms(self.champion, rows)
+        if champion_ms is None or champion_ms <= budget_ms:
+            return self.champion
+
+        agreement = self._agreeing()
+        known = {name: ms for name in agreement if self._loaded(name) is not None
+                 and (ms := self.estimate_ms(name, rows)) is not None}
+        within = [name for name, ms in known.items() if ms <= budget_ms]
+        if within:
+            return max(within, key=lambda name: (agreement[name], -known[name]))
+        if known:
+            fastest = min(known, key=known.get)
+            if known[fastest] < champion_ms:
+                return fastest
+        return self.champion
+
+    def stats(self):
+        with self._lock:
+            per_model = {name: stats.to_dict() for name, stats in self._stats.items()}
+        for name, registry_ in self.registries.items():
+            loaded = registry_._current
+            per_model[name].update({
+                "path": registry_.model_path,
+                "loaded": loaded is not None,
+                "version": loaded.version[:12] if loaded else None,
+                "features": len(loaded.feature_names) if loaded else None,
+                "relative_cost": loaded.cost if loaded else None,
+            })
+        return {
+            "champion": self.champion,
+            "shadows": self.shadows,
+            "routing_budget_ms": ROUTING_BUDGET_MS,
+            "routing_min_agreement": ROUTING_MIN_AGREEMENT,
+            "pending_shadow_batches": self._pending,
+            "models": per_model,
+        }
+
+    def agreement(self):
+        with self._lock:
+            return {name: self._stats[name].agreed / self._stats[name].compared
+                    for name in self.shadows if self._stats[name].compared}
+
+
+model_set = ModelSet(champion_registry=model_registry)
+add_batch_listener(model_set.on_batch)
+
+registry.register(Gauge(
+    'fraud_shadow_agreement', 'Share of shadow model decisions matching the champion',
+    model_set.agreement, labelnames=('model',)))
@@ -0,0 +1,138 @@
+import hmac
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+
+from metrics import Gauge, Histogram, registry
+
+# كلفة bcrypt (log2 لعدد الجولات)؛ التجزئات الأقل كلفة تُرقّى عند تسجيل الدخول
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', 12))
+# عدد الخيوط المخصصة للتجزئة حتى لا تستهلك كل الأنوية أثناء موجات تسجيل الدخول
+AUTH_HASH_WORKERS = int(os.environ.get('AUTH_HASH_WORKERS', 2))
+# أقصى عدد عمليات منتظرة أو قيد التنفيذ قبل رفض الطلبات الجديدة
+AUTH_MAX_PENDING = int(os.environ.get('AUTH_MAX_PENDING', 64))
+# أقصى انتظار لنتيجة التجزئة في مسار الطلب
+AUTH_TIMEOUT_SECONDS = 10
+
+logger = logging.getLogger(__name__)
+
+
+class HashQueueFull(Exception):
+    pass
+
+
+def hash_cost(hashed):
+    """كلفة تجزئة bcrypt المخزنة ($2b$12$...) أو None إذا لم تكن تجزئة bcrypt"""
+    parts = hashed.split('$')
+    if len(parts) != 4 or not parts[1].startswith('2') or not parts[2].isdigit():
+        return None
+    return int(parts[2])
+
+
+def needs_rehash(hashed, rounds=BCRYPT_ROUNDS):
+    cost = hash_cost(hashed)
+    return cost is None or cost < rounds
+
+
+class PasswordHasher:
+    """تجزئة كلمات المرور والتحقق منها على خيوط مخصصة محدودة العدد"""
+
+    def __init__(self, rounds=BCRYPT_ROUNDS, workers=AUTH_HASH_WORKERS, max_pending=AUTH_MAX_PENDING):
+        self.rounds = rounds
+        self.workers = workers
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pending = 0
+        self.rejected = 0
+
+    def _get_executor(self):
+        # يُنشأ عند أول استخدام حتى لا تُورَّث خيوطه عبر fork
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="auth-hash")
+        return self._executor
+
+    def submit(self, operation, fn, *args):
+        """تنفيذ fn على خيوط التجزئة وإرجاع Future (HashQueueFull عند الامتلاء)"""
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self.rejected += 1
+                raise HashQueueFull("Too many authentication requests in progress, try again later")
+            self._pending += 1
+        queued_at = time.perf_counter()
+
+        def run():
+            auth_queue_wait_seconds.observe(time.perf_counter() - queued_at)
+            try:
+                with auth_hash_seconds.time(operation=operation):
+                    return fn(*args)
+            finally:
+                with self._lock:
+                    self._pending -= 1
+
+        try:
+            return self._get_executor().submit(run)
+        except Exception:
+            with self._lock:
+                self._pending -= 1
+            raise
+
+    def _hash(self, password):
+        return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=self.rounds)).decode('utf-8')
+
+    def hash(self, password, timeout=AUTH_TIMEOUT_SECONDS):
+        return self.submit('hash', self._hash, password).result(timeout=timeout)
+
+    def _verify(self, password, hashed):
+        if hash_cost(hashed) is None:
+            # كلمات مرور قديمة محفوظة كنص صريح قبل التشفير
+            return hmac.compare_digest(password.encode('utf-8'), hashed.encode('utf-8'))
+        try:
+            return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+        except ValueError:
+            return False
+
+    def verify(self, password, hashed, timeout=AUTH_TIMEOUT_SECONDS):
+        return self.submit('verify', self._verify, password, hashed).result(timeout=timeout)
+
+    def needs_rehash(self, hashed):
+        return needs_rehash(hashed, self.rounds)
+
+    def rehash_later(self, password, save):
+        """ترقية التجزئة في الخلفية بعد تسجيل دخول ناجح؛ تُؤجَّل لدخول لاحق عند الضغط"""
+        def run():
+            save(self._hash(password))
+
+        try:
+            future = self.submit('rehash', run)
+        except HashQueueFull:
+            return None
+        future.add_done_callback(_log_rehash_error)
+        return future
+
+    def pending(self):
+        return self._pending
+
+
+def _log_rehash_error(future):
+    if future.exception() is not None:
+        logger.error("Password rehash failed: %s", future.exception())
+
+
+password_hasher = PasswordHasher()
+
+auth_hash_seconds = registry.register(Histogram(
+    'fraud_auth_hash_seconds', 'bcrypt time per operation on the auth executor', labelnames=('operation',)))
+auth_queue_wait_seconds = registry.register(Histogram(
+    'fraud_auth_queue_wait_seconds', 'Time auth hashing work waited for a free executor thread'))
+registry.register(Gauge(
+    'fraud_auth_queue_depth', 'Auth hashing operations queued or running', password_hasher.pending))
+registry.register(Gauge(
+    'fraud_auth_rejected_operations', 'Auth hashing operations rejected because the queue was full',
+    lambda: password_hasher.rejected))
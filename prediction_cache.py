@@ -0,0 +1,87 @@
+import copy
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# أقصى عدد ملفات محفوظة نتائجها في الذاكرة
+CACHE_MAX_ENTRIES = 256
+# مدة صلاحية النتيجة المحفوظة
+CACHE_TTL_SECONDS = 24 * 3600
+
+
+class PredictionCache:
+    """نتائج التقييم حسب بصمة محتوى الملف ونسخة النموذج (LRU مع مدة صلاحية)"""
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, ttl_seconds=CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, content_hash, model_version, need_store=False):
+        """النتيجة المحفوظة أو None؛ need_store يتطلب وجود النتائج الكاملة على القرص"""
+        key = (content_hash, model_version)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry['created'] > self.ttl_seconds:
+                del self._entries[key]
+                self.expirations += 1
+                entry = None
+            if entry is not None and need_store and not (entry['store_path'] and os.path.isdir(entry['store_path'])):
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return copy.deepcopy(entry['result']), entry['store_path']
+
+    def put(self, content_hash, model_version, result, store_path=None):
+        key = (content_hash, model_version)
+        with self._lock:
+            previous = self._entries.get(key)
+            if store_path is None and previous is not None:
+                # لا نفقد مسار النتائج الكاملة عند تكرار رفع نفس الملف كضيف
+                store_path = previous['store_path']
+            self._entries[key] = {
+                "result": copy.deepcopy(result),
+                "store_path": store_path,
+                "created": time.monotonic(),
+            }
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+
+    def on_model_reload(self, loaded):
+        # نسخة النموذج جزء من المفتاح، لكن المدخلات القديمة لن تُستخدم بعد الآن
+        self.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
+
+
+prediction_cache = PredictionCache()
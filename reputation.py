@@ -0,0 +1,414 @@
+"""فهرس سمعة الكيانات: القائمة السوداء وما سبق رؤيته لكل مستخدم
+
+القائمة السوداء تُقرأ من ملف CSV محلي بعمودين (kind,value) حيث kind أحد
+ENTITY_KINDS، وتُعاد قراءتها تلقائياً عند تعديل الملف. كل قيمة تُخزَّن كبصمة
+uint64 في مصفوفة مرتبة، فالبحث عن دفعة كاملة هو searchsorted واحد
+(8 بايت لكل مدخل، وأقل من ميكروثانية للصف مع عشرة ملايين مدخل).
+
+"ما سبق رؤيته" أزواج (المستخدم، الوجهة) و(المستخدم، IP) من التجارب المحفوظة
+لمستخدمين مسجلين فقط (record_results)، محفوظة بنفس الطريقة في
+REPUTATION_SEEN_PATH ومشتركة بين العمال عبر الملف. رفع الضيوف وطلبات
+/api/score لا تُضاف إليها، وإلا أمكن لأي طلب تبييض أزواج يختارها.
+"""
+import fcntl
+import hashlib
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from metrics import Gauge, registry
+from result_store import open_results
+
+# الكيانات التي يمكن حظرها في ملف القائمة السوداء
+ENTITY_KINDS = ('destination_account', 'ip', 'device')
+# للنموذج علامة حظر واحدة: أي كيان محظور في المعاملة يرفع blacklisted_dest
+BLACKLIST_FLAG_KINDS = ENTITY_KINDS
+# الكيانات التي يُتذكر ظهورها لكل مستخدم عبر الملفات، والإشارة التي تُصحَّح بها
+SEEN_SIGNALS = {'destination_account': 'new_destination', 'ip': 'ip_unusual'}
+BLACKLIST_PATH = os.environ.get('BLACKLIST_PATH', 'blacklist.csv')
+# بصمات القائمة المحسوبة تُحفظ بجانب الملف (قراءة CSV بعشرة ملايين سطر تأخذ ثوانٍ)
+COMPILED_SUFFIX = '.idx.npz'
+REPUTATION_SEEN_PATH = os.environ.get('REPUTATION_SEEN_PATH', 'reputation_seen.npz')
+# أقل فترة بين فحص تعديل الملفين
+REPUTATION_CHECK_SECONDS = 2.0
+# الإضافات الجديدة تُجمع في مصفوفة صغيرة وتُدمج في الأساسية عند هذا الحد
+SEEN_PENDING_MAX = 1_000_000
+# حفظ الإضافات في الملف بعد هذا العدد أو هذه المدة (في الخلفية)
+SEEN_FLUSH_ENTRIES = 100_000
+SEEN_FLUSH_SECONDS = 60
+# عدد الصفوف المقروءة من مخزن النتائج في كل دفعة عند تذكر تجربة محفوظة
+RECORD_CHUNK_ROWS = 500_000
+# فوق هذه الأحجام تُرتب البصمات المطلوبة قبل البحث (المصفوفة أكبر من ذاكرة المعالج المؤقتة)
+SORTED_LOOKUP_MIN_ENTRIES = 1 << 16
+SORTED_LOOKUP_MIN_ROWS = 1024
+# خلط بصمة المستخدم مع بصمة الكيان في بصمة زوج واحدة
+_PAIR_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+logger = logging.getLogger(__name__)
+
+
+def hash_values(values):
+    """بصمات uint64 ثابتة بين العمليات لقيم نصية (نفس الدالة للملف والمعاملات)"""
+    values = np.asarray(values, dtype=object)
+    if len(values) == 0:
+        return np.empty(0, dtype=np.uint64)
+    if pd.api.types.infer_dtype(values, skipna=True) != 'string':
+        # أرقام الحسابات المرسلة كأعداد تطابق نفس القيمة النصية في الملف
+        values = values.astype(str).astype(object)
+    return pd.util.hash_array(values, categorize=False)
+
+
+def column_hashes(series):
+    """بصمة قيمة العمود لكل صف وقناع القيم المفقودة
+
+    للأعمدة الفئوية (كما تُقرأ الملفات المرفوعة) تُحسب البصمة لكل فئة مرة
+    واحدة ثم تُوزَّع بالأكواد.
+    """
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        codes = series.cat.codes.to_numpy()
+        hashes = hash_values(series.cat.categories.to_numpy(dtype=object))
+        return np.append(hashes, np.uint64(0))[codes], codes < 0
+    values = series.to_numpy(dtype=object)
+    return hash_values(values), pd.isna(values)
+
+
+def pair_hashes(users, values):
+    with np.errstate(over='ignore'):
+        return (users * _PAIR_MULTIPLIER) ^ values
+
+
+def _member(sorted_hashes, hashes):
+    if len(sorted_hashes) == 0 or len(hashes) == 0:
+        return np.zeros(len(hashes), dtype=bool)
+    if len(sorted_hashes) >= SORTED_LOOKUP_MIN_ENTRIES and len(hashes) >= SORTED_LOOKUP_MIN_ROWS:
+        # البحث بترتيب البصمات يجعل الوصول للمصفوفة الكبيرة شبه متتابع بدل قفزات عشوائية في الذاكرة
+        order = np.argsort(hashes)
+        found = np.empty(len(hashes), dtype=bool)
+        found[order] = _search(sorted_hashes, hashes[order])
+        return found
+    return _search(sorted_hashes, hashes)
+
+
+def _search(sorted_hashes, hashes):
+    index = np.searchsorted(sorted_hashes, hashes)
+    index[index == len(sorted_hashes)] = 0
+    return sorted_hashes[index] == hashes
+
+
+def _merge(a, b):
+    # دمج مصفوفتين مرتبتين بلا تكرار مشترك: الترتيب المستقر (timsort) يدمج المقطعين خطياً
+    return np.sort(np.concatenate([a, b]), kind='stable')
+
+
+class HashSet:
+    """مجموعة بصمات مرتبة: أساسية كبيرة وإضافات حديثة صغيرة تُدمج عند امتلائها"""
+
+    def __init__(self, hashes=None):
+        self.main = np.unique(np.asarray(hashes, dtype=np.uint64)) if hashes is not None else np.empty(0, np.uint64)
+        self.pending = np.empty(0, dtype=np.uint64)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.main) + len(self.pending)
+
+    def contains(self, hashes):
+        # قراءة المرجعين بدون قفل: الدمج يستبدل main قبل تفريغ pending
+        main, pending = self.main, self.pending
+        found = _member(main, hashes)
+        if len(pending):
+            found |= _member(pending, hashes)
+        return found
+
+    def add(self, hashes):
+        """إضافة بصمات وإرجاع عدد الجديد منها"""
+        hashes = np.unique(hashes)
+        with self._lock:
+            new = hashes[~self.contains(hashes)]
+            if len(new) == 0:
+                return 0
+            self.pending = _merge(self.pending, new)
+            if len(self.pending) > SEEN_PENDING_MAX:
+                self.main = _merge(self.main, self.pending)
+                self.pending = np.empty(0, dtype=np.uint64)
+            return len(new)
+
+    def snapshot(self):
+        with self._lock:
+            return self.main, self.pending
+
+    def replace(self, main, flushed_pending=None):
+        """استبدال الأساسية (بعد الحفظ أو التحميل) مع إبقاء ما أُضيف بعد اللقطة"""
+        with self._lock:
+            pending = self.pending
+            if flushed_pending is not None and len(flushed_pending):
+                pending = np.setdiff1d(pending, flushed_pending, assume_unique=True)
+            pending = pending[~_member(main, pending)]
+            self.main = main
+            self.pending = pending
+
+
+class ReputationIndex:
+    """القائمة السوداء وما سبق رؤيته مع إعادة التحميل عند تعديل الملفات"""
+
+    def __init__(self, blacklist_path=BLACKLIST_PATH, seen_path=REPUTATION_SEEN_PATH,
+                 check_interval=REPUTATION_CHECK_SECONDS):
+        self.blacklist_path = blacklist_path
+        self.seen_path = seen_path
+        self.check_interval = check_interval
+        self.blacklists = {kind: HashSet() for kind in ENTITY_KINDS}
+        self.seen = {kind: HashSet() for kind in SEEN_SIGNALS}
+        self.blacklist_version = None
+        self._blacklist_stat = None
+        self._seen_stat = None
+        self._unflushed = 0
+        self._last_flush = time.monotonic()
+        self._last_check = 0.0
+        self._loaded = False
+        self._lock = threading.Lock()
+        self._executor = None
+        self._background = None
+        self._listeners = []
+
+    @property
+    def version(self):
+        """نسخة الفهرس في مفتاح النتائج المحفوظة: بصمة القائمة السوداء فقط
+
+        ما سبق رؤيته لا يدخل في النسخة، وإلا أبطل حفظ كل تجربة كل النتائج
+        المحفوظة. نتيجة محفوظة قد تسبق أزواجاً تُذكرت بعدها، كما يحدث أصلاً
+        بين العمال حتى يُقرأ ملف ما سبق رؤيته.
+        """
+        return self.blacklist_version[:12] if self.blacklist_version else '-'
+
+    def add_listener(self, callback):
+        """تسجيل دالة تُستدعى بالفهرس كلما تغيّرت القائمة السوداء"""
+        self._listeners.append(callback)
+
+    def _get_executor(self):
+        # يُنشأ عند أول استخدام حتى لا تُورَّث خيوطه عبر fork
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="reputation")
+        return self._executor
+
+    def _run_background(self, task):
+        # مهمة خلفية واحدة في كل وقت (إعادة تحميل أو حفظ)
+        if self._background is None or self._background.done():
+            self._background = self._get_executor().submit(task)
+
+    @staticmethod
+    def _stat(path):
+        try:
+            stat = os.stat(path)
+            return stat.st_mtime, stat.st_size
+        except OSError:
+            return None
+
+    def load(self):
+        """التحميل الأول (متزامن)؛ التعديلات اللاحقة تُحمَّل في الخلفية"""
+        with self._lock:
+            if self._loaded:
+                return
+            self._loaded = True
+        self._load_blacklist()
+        self._load_seen()
+
+    def _load_blacklist(self):
+        stat = self._stat(self.blacklist_path)
+        if stat is None:
+            blacklists, version = {kind: HashSet() for kind in ENTITY_KINDS}, None
+        else:
+            with open(self.blacklist_path, 'rb') as f:
+                version = hashlib.sha256(f.read()).hexdigest()
+            if version == self.blacklist_version:
+                self._blacklist_stat = stat
+                return
+            blacklists = {kind: HashSet(hashes) for kind, hashes in self._compile_blacklist(version).items()}
+        previous = self.blacklist_version
+        self.blacklists, self.blacklist_version, self._blacklist_stat = blacklists, version, stat
+        logger.info("Blacklist loaded from %s: %s", self.blacklist_path,
+                    {kind: len(entries) for kind, entries in blacklists.items()})
+        if previous != version:
+            for callback in self._listeners:
+                callback(self)
+
+    def _compile_blacklist(self, version):
+        """بصمات كل نوع من ملف CSV، مع نسخة مجمَّعة بجانبه تُغني عن قراءته بعد إعادة التشغيل"""
+        compiled_path = f"{self.blacklist_path}{COMPILED_SUFFIX}"
+        try:
+            with np.load(compiled_path) as compiled:
+                if str(compiled['version']) == version:
+                    return {kind: compiled[kind] for kind in ENTITY_KINDS}
+        except (OSError, KeyError, ValueError):
+            pass
+
+        entries = pd.read_csv(self.blacklist_path, dtype={'kind': 'category', 'value': str}, comment='#',
+                              skipinitialspace=True, usecols=['kind', 'value']).dropna()
+        unknown = set(entries['kind'].cat.categories) - set(ENTITY_KINDS)
+        if unknown:
+            logger.warning("Ignoring unknown blacklist kinds: %s", ', '.join(sorted(unknown)))
+        hashes = {kind: np.unique(hash_values(entries.loc[entries['kind'] == kind, 'value'].to_numpy(dtype=object)))
+                  for kind in ENTITY_KINDS}
+        try:
+            tmp_path = f"{compiled_path}.tmp.npz"
+            np.savez(tmp_path, version=np.array(version), **hashes)
+            os.replace(tmp_path, compiled_path)
+        except OSError as e:
+            logger.warning("Could not save compiled blacklist %s: %s", compiled_path, e)
+        return hashes
+
+    def _load_seen(self):
+        stat = self._stat(self.seen_path)
+        if stat is None or stat == self._seen_stat:
+            return
+        with np.load(self.seen_path) as stored:
+            for kind, entries in self.seen.items():
+                if kind in stored:
+                    entries.replace(_merge_unique(stored[kind], entries.main))
+        self._seen_stat = stat
+        logger.info("Seen-before index loaded from %s: %s", self.seen_path,
+                    {kind: len(entries) for kind, entries in self.seen.items()})
+
+    def _reload(self):
+        try:
+            if self._stat(self.blacklist_path) != self._blacklist_stat:
+                self._load_blacklist()
+            self._load_seen()
+        except Exception as e:
+            logger.error("Error reloading reputation index, keeping current lists: %s", e)
+
+    def _check(self):
+        if not self._loaded:
+            self.load()
+            return
+        now = time.monotonic()
+        if now - self._last_check < self.check_interval:
+            return
+        self._last_check = now
+        if (self._stat(self.blacklist_path) != self._blacklist_stat
+                or self._stat(self.seen_path) != self._seen_stat):
+            self._run_background(self._reload)
+
+    def lookup(self, df, seen_kinds=SEEN_SIGNALS):
+        """أعلام دفعة كاملة: blacklisted (أي كيان محظور) وseen_<kind> لكل كيان في seen_kinds"""
+        self._check()
+        hashed = {}
+
+        def hashes_of(column):
+            if column not in hashed:
+                hashed[column] = column_hashes(df[column])
+            return hashed[column]
+
+        result = {}
+        blacklisted = np.zeros(len(df), dtype=bool)
+        for kind in BLACKLIST_FLAG_KINDS:
+            entries = self.blacklists[kind]
+            if len(entries) and kind in df.columns:
+                hashes, missing = hashes_of(kind)
+                blacklisted |= entries.contains(hashes) & ~missing
+        result['blacklisted'] = blacklisted
+
+        if 'user_id' in df.columns:
+            for kind in seen_kinds:
+                entries = self.seen[kind]
+                if kind in df.columns and len(entries):
+                    users, _ = hashes_of('user_id')
+                    values, missing = hashes_of(kind)
+                    result[f'seen_{kind}'] = entries.contains(pair_hashes(users, values)) & ~missing
+        return result
+
+    def record(self, df):
+        """تذكر أزواج (المستخدم، الكيان) في دفعة موثوقة للملفات اللاحقة"""
+        if len(df) == 0 or 'user_id' not in df.columns:
+            return
+        users, missing_users = column_hashes(df['user_id'])
+        added = 0
+        for kind, entries in self.seen.items():
+            if kind in df.columns:
+                values, missing = column_hashes(df[kind])
+                added += entries.add(pair_hashes(users, values)[~(missing | missing_users)])
+        if not added:
+            return
+        with self._lock:
+            self._unflushed += added
+            due = self._unflushed >= SEEN_FLUSH_ENTRIES or time.monotonic() - self._last_flush >= SEEN_FLUSH_SECONDS
+        if due:
+            self._run_background(self.flush)
+
+    def record_results(self, path, chunk_rows=RECORD_CHUNK_ROWS):
+        """تذكر أزواج تجربة محفوظة من مخزن نتائجها (المصدر الموثوق الوحيد)"""
+        results = open_results(path)
+        columns = [c for c in ('user_id', *SEEN_SIGNALS) if c in results.columns]
+        if 'user_id' not in columns:
+            return
+        for start in range(0, len(results), chunk_rows):
+            self.record(results.read(start, start + chunk_rows, columns))
+
+    def record_results_later(self, path):
+        """record_results في خيط الفهرس حتى لا ينتظر حفظ التجربة قراءة كل نتائجها"""
+        self._get_executor().submit(self._record_results_logged, path)
+
+    def _record_results_logged(self, path):
+        try:
+            self.record_results(path)
+        except Exception as e:
+            # فشل التذكر لا يُفشل الحفظ؛ الأزواج تبقى "جديدة" فقط
+            logger.error("Could not record %s in reputation index: %s", path, e)
+
+    def flush(self):
+        """حفظ ما سبق رؤيته في الملف مع دمج ما حفظته العمليات الأخرى"""
+        with self._lock:
+            self._unflushed = 0
+            self._last_flush = time.monotonic()
+        with open(f"{self.seen_path}.lock", 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                stored = {}
+                if self._stat(self.seen_path) not in (None, self._seen_stat):
+                    with np.load(self.seen_path) as data:
+                        stored = {kind: data[kind] for kind in data.files}
+                merged, flushed = {}, {}
+                for kind, entries in self.seen.items():
+                    main, pending = entries.snapshot()
+                    combined = _merge(main, pending)
+                    if kind in stored:
+                        combined = _merge_unique(stored[kind], combined)
+                    merged[kind], flushed[kind] = combined, pending
+                tmp_path = f"{self.seen_path}.tmp.npz"
+                np.savez(tmp_path, **merged)
+                os.replace(tmp_path, self.seen_path)
+                self._seen_stat = self._stat(self.seen_path)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        for kind, entries in self.seen.items():
+            entries.replace(merged[kind], flushed[kind])
+
+    def stats(self):
+        return {
+            "blacklist_path": self.blacklist_path,
+            "blacklist_version": self.blacklist_version[:12] if self.blacklist_version else None,
+            "blacklisted": {kind: len(entries) for kind, entries in self.blacklists.items()},
+            "seen": {kind: len(entries) for kind, entries in self.seen.items()},
+        }
+
+
+def _merge_unique(a, b):
+    if len(a) == 0:
+        return b
+    if len(b) == 0:
+        return a
+    return np.union1d(a, b)
+
+
+reputation_index = ReputationIndex()
+
+registry.register(Gauge(
+    'fraud_reputation_entries', 'Entries in the blacklist and seen-before indexes',
+    lambda: {**{('blacklist', kind): len(entries) for kind, entries in reputation_index.blacklists.items()},
+             **{('seen', kind): len(entries) for kind, entries in reputation_index.seen.items()}},
+    labelnames=('index', 'kind')))
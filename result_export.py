@@ -0,0 +1,99 @@
+import os
+import unicodedata
+import uuid
+import zlib
+from urllib.parse import quote
+
+from result_store import ROW_GROUP_SIZE
+
+FORMAT_CSV = 'csv'
+FORMAT_NDJSON = 'ndjson'
+EXPORT_FORMATS = {
+    FORMAT_CSV: 'text/csv',
+    FORMAT_NDJSON: 'application/x-ndjson',
+}
+COMPRESSION_GZIP = 'gzip'
+# عدد الصفوف المقروءة من المخزن في كل جزء من التصدير (الذاكرة تعتمد عليه لا على حجم النتائج)
+EXPORT_CHUNK_ROWS = ROW_GROUP_SIZE
+EXPORTS_DIR = "exports"
+
+
+def export_filename(name, fmt, compression=None):
+    base = os.path.splitext(os.path.basename(name or 'results'))[0]
+    return f"{base}_results.{fmt}" + ('.gz' if compression == COMPRESSION_GZIP else '')
+
+
+def export_path(results_path, fmt, compression=None):
+    """مكان نسخة التصدير الجاهزة: داخل مجلد المخزن، أو بجانب ملفات CSV القديمة"""
+    directory = os.path.join(results_path, EXPORTS_DIR) if os.path.isdir(results_path) else f"{results_path}.{EXPORTS_DIR}"
+    return os.path.join(directory, f"results.{fmt}" + ('.gz' if compression == COMPRESSION_GZIP else ''))
+
+
+def content_disposition(download_name):
+    """ترويسة التنزيل مع دعم أسماء الملفات غير اللاتينية (نفس طريقة send_file)"""
+    try:
+        download_name.encode('ascii')
+        return {"filename": download_name}
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize('NFKD', download_name).encode('ascii', 'ignore').decode('ascii')
+        return {"filename": simple, "filename*": f"UTF-8''{quote(download_name, safe='!#$&+^`|~')}"}
+
+
+def _encode(df, fmt, header):
+    if fmt == FORMAT_CSV:
+        return df.to_csv(index=False, header=header).encode('utf-8')
+    text = df.to_json(orient='records', lines=True, date_format='iso', force_ascii=False)
+    return (text if text.endswith('\n') else text + '\n').encode('utf-8')
+
+
+def export_chunks(results, fmt, compression=None, chunk_rows=EXPORT_CHUNK_ROWS):
+    """كل صفوف النتائج بصيغة CSV أو NDJSON على أجزاء من البايتات
+
+    الناتج حتمي (gzip بدون وقت في الترويسة) حتى تتطابق البايتات بين
+    التنزيل الأول والاستئناف من نسخة التصدير المحفوظة.
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unsupported export format: {fmt}")
+    if compression not in (None, COMPRESSION_GZIP):
+        raise ValueError(f"Unsupported compression: {compression}")
+    # wbits=31: ترويسة gzip قياسية بوقت تعديل صفري
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compression else None
+
+    total = len(results)
+    if total == 0 and fmt == FORMAT_CSV:
+        chunk = (','.join(results.columns) + '\n').encode('utf-8')
+        yield compressor.compress(chunk) + compressor.flush() if compressor else chunk
+        return
+    for start in range(0, total, chunk_rows):
+        chunk = _encode(results.read(start, start + chunk_rows), fmt, header=start == 0)
+        if compressor:
+            chunk = compressor.compress(chunk)
+            if not chunk:
+                continue
+        yield chunk
+    if compressor:
+        yield compressor.flush()
+
+
+def save_while_streaming(chunks, target):
+    """تمرير الأجزاء للعميل مع كتابتها في نسخة التصدير؛ تُعتمد النسخة فقط إذا اكتمل التنزيل"""
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    tmp_path = f"{target}.{uuid.uuid4().hex}.tmp"
+    completed = False
+    try:
+        with open(tmp_path, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                yield chunk
+        completed = True
+        os.replace(tmp_path, target)
+    finally:
+        if not completed and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def build_export(results, target, fmt, compression=None):
+    """كتابة نسخة التصدير كاملة على القرص (للاستئناف قبل اكتمال أي تنزيل)"""
+    for _ in save_while_streaming(export_chunks(results, fmt, compression), target):
+        pass
+    return target
@@ -0,0 +1,537 @@
+import gzip
+import json
+import logging
+import os
+import shutil
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+from ingestion import feature_schema
+
+# عدد الصفوف في كل مجموعة صفوف (وحدة الإحصائيات والتخطي عند التصفية)
+ROW_GROUP_SIZE = 65_536
+META_FILE = "meta.json"
+STORE_SUFFIX = "_results"
+# امتداد مخزن النتائج بعد ضغطه في ملف واحد (ArchivedResultStore)
+ARCHIVE_SUFFIX = ".zip"
+# ترتيبات محسوبة مسبقاً عند الكتابة (الأعلى احتمالاً أولاً)
+SORTED_COLUMNS = ['fraud_probability']
+# أنواع infer_dtype لعمود object تُعامل كأرقام عند الكتابة في عمود رقمي
+NUMERIC_INFERRED = ('integer', 'floating', 'mixed-integer-float', 'boolean', 'empty')
+
+logger = logging.getLogger(__name__)
+
+
+def store_filename(experiment_id):
+    return f"{experiment_id}{STORE_SUFFIX}"
+
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+class ResultStoreWriter:
+    """كتابة نتائج التقييم عموداً عموداً على دفعات (ملف ثنائي لكل عمود)"""
+
+    def __init__(self, path, row_group_size=ROW_GROUP_SIZE, schema=feature_schema):
+        self.path = path
+        self.row_group_size = row_group_size
+        self.schema = schema
+        self.columns = None
+        self.rows = 0
+        self.row_groups = []
+        self._files = {}
+        self._vocab = {}
+        self._adopted = False
+        self._tmp_path = f"{path}.tmp"
+        if os.path.exists(self._tmp_path):
+            shutil.rmtree(self._tmp_path)
+        os.makedirs(self._tmp_path)
+
+    def _storage_for(self, name, series):
+        """نوع التخزين: من مخطط الميزات للأعمدة المعروفة، وإلا من أول دفعة"""
+        known = self.schema.dtypes.get(name) if self.schema is not None else None
+        if known == 'category':
+            return 'dict', 'int32'
+        if known is not None:
+            return 'numeric', np.dtype(known).str
+        dtype = series.dtype
+        if pd.api.types.is_datetime64_any_dtype(dtype):
+            return 'datetime', 'int64'
+        if series.isna().all():
+            # عمود فارغ في أول دفعة: النصوص هي الأعم (الأرقام اللاحقة تُحفظ كقيم نصية)
+            return 'dict', 'int32'
+        if pd.api.types.is_bool_dtype(dtype) or (
+                pd.api.types.is_numeric_dtype(dtype) and not isinstance(dtype, pd.CategoricalDtype)):
+            if isinstance(dtype, pd.api.extensions.ExtensionDtype):
+                # الأنواع القابلة للإفراغ (Int64، boolean) تُخزَّن float64 مع NaN للقيم المفقودة
+                return 'numeric', '<f8'
+            return 'numeric', np.dtype(dtype).str
+        # النصوص والفئات تُخزَّن كأكواد int32 مع قاموس القيم
+        return 'dict', 'int32'
+
+    def _define(self, df):
+        self.columns = []
+        for i, name in enumerate(df.columns):
+            kind, storage = self._storage_for(name, df[name])
+            if kind == 'dict':
+                self._vocab[name] = {}
+            self.columns.append({"name": str(name), "file": f"{i}.bin", "kind": kind, "dtype": storage})
+            self._files[name] = open(os.path.join(self._tmp_path, f"{i}.bin"), 'ab')
+
+    def _promotion(self, column, series):
+        """النوع الأوسع المطلوب لقيم دفعة لا يسعها تخزين العمود الحالي، أو None"""
+        if column['kind'] != 'numeric':
+            return None
+        dtype = series.dtype
+        numeric = not isinstance(dtype, pd.CategoricalDtype) and (
+            pd.api.types.is_numeric_dtype(dtype) or pd.api.types.is_bool_dtype(dtype))
+        if dtype == object and pd.api.types.infer_dtype(series, skipna=True) in NUMERIC_INFERRED:
+            # أرقام أو أعلام مع قيم مفقودة تصل كـ object
+            numeric, dtype = True, np.dtype('float64')
+        if not numeric:
+            return 'dict', 'int32'
+        if np.dtype(column['dtype']).kind in 'iub' and (
+                series.isna().any() or pd.api.types.is_float_dtype(dtype)):
+            # عدد صحيح مع قيمة مفقودة أو كسرية: float64 بدل تحويل NaN إلى أصغر int64
+            return 'numeric', '<f8'
+        return None
+
+    def _promote(self, column, kind, storage):
+        """إعادة كتابة ما كُتب من العمود بالنوع الأوسع (مرة واحدة لكل عمود على الأكثر)"""
+        name = column['name']
+        path = os.path.join(self._tmp_path, column['file'])
+        self._files[name].close()
+        values = np.fromfile(path, dtype=column['dtype'])
+        if kind == 'dict':
+            self._vocab[name] = {}
+            existing = pd.Series(values)
+            if np.dtype(column['dtype']).kind in 'iub':
+                existing = existing.astype(object)
+            values = self._encode_dict(name, existing)
+            for group in self.row_groups:
+                group['stats'].pop(name, None)
+        values.astype(storage).tofile(path)
+        logger.debug("Promoted result column %s from %s to %s", name, column['dtype'], storage)
+        column['kind'], column['dtype'] = kind, storage
+        self._files[name] = open(path, 'ab')
+
+    def _encode_dict(self, name, series):
+        vocab = self._vocab[name]
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            codes, uniques = series.cat.codes.to_numpy(), series.cat.categories
+        else:
+            codes, uniques = pd.factorize(series.astype(object).where(series.notna(), None))
+        mapping = np.array([vocab.setdefault(str(v), len(vocab)) for v in uniques] + [-1], dtype=np.int32)
+        # الكود -1 (قيمة مفقودة) يشير إلى آخر عنصر في mapping
+        return mapping[codes]
+
+    def append(self, df):
+        """إضافة دفعة من الصفوف بنفس أعمدة الدفعة الأولى"""
+        if len(df) == 0:
+            return
+        if self.columns is None:
+            self._define(df)
+
+        arrays = {}
+        for column in self.columns:
+            series = df[column['name']]
+            promotion = self._promotion(column, series)
+            if promotion is not None:
+                self._promote(column, *promotion)
+            if column['kind'] == 'dict':
+                arrays[column['name']] = self._encode_dict(column['name'], series)
+            elif column['kind'] == 'datetime':
+                arrays[column['name']] = pd.to_datetime(series).to_numpy('datetime64[ns]').view('int64')
+            elif np.dtype(column['dtype']).kind == 'f':
+                arrays[column['name']] = series.to_numpy(dtype=column['dtype'], na_value=np.nan)
+            else:
+                arrays[column['name']] = series.to_numpy().astype(column['dtype'], copy=False)
+
+        for start in range(0, len(df), self.row_group_size):
+            stop = min(start + self.row_group_size, len(df))
+            stats = {}
+            for column in self.columns:
+                values = arrays[column['name']][start:stop]
+                self._files[column['name']].write(np.ascontiguousarray(values).tobytes())
+                if column['kind'] == 'numeric' and values.dtype.kind in 'fiub':
+                    with np.errstate(all='ignore'):
+                        low, high = np.nanmin(values), np.nanmax(values)
+                    if not np.isnan(low):
+                        stats[column['name']] = {"min": low.item(), "max": high.item()}
+            self.row_groups.append({"offset": self.rows, "rows": stop - start, "stats": stats})
+            self.rows += stop - start
+
+    def _write_orders(self):
+        """ترتيب الصفوف تنازلياً لكل عمود في SORTED_COLUMNS حتى تكون الصفحة الأولى فورية"""
+        orders = {}
+        if not self.rows:
+            # مخزن بلا صفوف: ترتيب فارغ حتى يعمل الطلب المرتب بدل رفض الترتيب
+            for name in SORTED_COLUMNS:
+                filename = f"order_{name}.bin"
+                open(os.path.join(self._tmp_path, filename), 'wb').close()
+                orders[name] = {"file": filename, "dtype": 'int32'}
+            return orders
+        for column in self.columns or []:
+            if column['name'] not in SORTED_COLUMNS or column['kind'] != 'numeric':
+                continue
+            values = np.memmap(os.path.join(self._tmp_path, column['file']),
+                               dtype=column['dtype'], mode='r', shape=(self.rows,))
+            dtype = 'int32' if self.rows < 2 ** 31 else 'int64'
+            # ترتيب مستقر: الصفوف المتساوية تبقى بترتيبها في الملف
+            order = np.argsort(-np.asarray(values, dtype=np.float64), kind='stable').astype(dtype)
+            filename = f"order_{column['file']}"
+            order.tofile(os.path.join(self._tmp_path, filename))
+            orders[column['name']] = {"file": filename, "dtype": dtype}
+            del values
+        return orders
+
+    def attach(self, name, payload):
+        """حفظ بيانات إضافية مع النتائج (مثل أسباب التصنيف) كملف JSON"""
+        with open(os.path.join(self._tmp_path, f"{name}.json"), 'w', encoding='utf-8') as f:
+            json.dump(payload, f, default=str)
+
+    def adopt(self, source_path):
+        """استخدام نتائج مخزن مكتمل بدل الكتابة (روابط صلبة بدون نسخ البيانات)"""
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+        shutil.rmtree(self._tmp_path)
+        shutil.copytree(source_path, self._tmp_path, copy_function=_link_or_copy)
+        self._adopted = True
+
+    def close(self):
+        """إنهاء الكتابة ونقل المجلد إلى مكانه النهائي دفعة واحدة"""
+        if self._adopted:
+            return self._publish()
+        for f in self._files.values():
+            f.close()
+        orders = self._write_orders()
+        meta = {
+            "version": 1,
+            "rows": self.rows,
+            "row_group_size": self.row_group_size,
+            "columns": self.columns or [],
+            "row_groups": self.row_groups,
+            "vocab": {name: list(vocab) for name, vocab in self._vocab.items()},
+            "orders": orders,
+        }
+        with open(os.path.join(self._tmp_path, META_FILE), 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        return self._publish()
+
+    def _publish(self):
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.replace(self._tmp_path, self.path)
+        return self.path
+
+    def abort(self):
+        for f in self._files.values():
+            f.close()
+        shutil.rmtree(self._tmp_path, ignore_errors=True)
+
+
+class ResultStore:
+    """قراءة كسولة لنتائج تجربة عبر memory-map: صفحات، أعمدة محددة، أو نطاق احتمال"""
+
+    def __init__(self, path):
+        self.path = path
+        self.meta = self._read_json(META_FILE)
+        self.rows = self.meta['rows']
+        self.columns = [c['name'] for c in self.meta['columns']]
+        self._spec = {c['name']: c for c in self.meta['columns']}
+        self._vocab = {name: np.array(values + [None], dtype=object)
+                       for name, values in self.meta.get('vocab', {}).items()}
+        self._maps = {}
+
+    def __len__(self):
+        return self.rows
+
+    def _read_json(self, name):
+        with open(os.path.join(self.path, name), encoding='utf-8') as f:
+            return json.load(f)
+
+    def _has(self, name):
+        return os.path.exists(os.path.join(self.path, name))
+
+    def _array(self, filename, dtype):
+        return np.memmap(os.path.join(self.path, filename), dtype=dtype, mode='r', shape=(self.rows,))
+
+    def raw(self, name):
+        """المصفوفة الخام للعمود (أكواد للأعمدة النصية) بدون نسخ"""
+        if name not in self._maps:
+            spec = self._spec[name]
+            if self.rows == 0:
+                self._maps[name] = np.empty(0, dtype=spec['dtype'])
+            else:
+                self._maps[name] = self._array(spec['file'], spec['dtype'])
+        return self._maps[name]
+
+    def _decode(self, name, values):
+        spec = self._spec[name]
+        if spec['kind'] == 'dict':
+            return self._vocab[name][values]
+        if spec['kind'] == 'datetime':
+            return np.asarray(values).view('datetime64[ns]')
+        return np.asarray(values)
+
+    def take(self, indices, columns=None):
+        """صفوف محددة بأرقامها مع إسقاط الأعمدة غير المطلوبة"""
+        columns = columns or self.columns
+        indices = np.asarray(indices, dtype=np.int64)
+        # الفهرس هو رقم الصف في النتائج (لربط الصفوف بالبيانات المرفقة)
+        return pd.DataFrame({name: self._decode(name, self.raw(name)[indices]) for name in columns}, index=indices)
+
+    def read(self, start=0, stop=None, columns=None):
+        columns = columns or self.columns
+        stop = self.rows if stop is None else min(stop, self.rows)
+        start = min(start, stop)
+        return pd.DataFrame({name: self._decode(name, self.raw(name)[start:stop]) for name in columns})
+
+    def page(self, page, page_size=50, columns=None):
+        return self.read(page * page_size, (page + 1) * page_size, columns)
+
+    def attachment(self, name):
+        """بيانات مرفقة بالنتائج عبر ResultStoreWriter.attach أو None"""
+        if not self._has(f"{name}.json"):
+            return None
+        return self._read_json(f"{name}.json")
+
+    def order(self, name):
+        """ترتيب الصفوف المحسوب مسبقاً (الأعلى أولاً) أو None إذا لم يُحسب"""
+        spec = self.meta.get('orders', {}).get(name)
+        if spec is None:
+            return None
+        key = f"order:{name}"
+        if key not in self._maps:
+            # ملف فارغ لا يمكن عمل memory-map له
+            self._maps[key] = self._array(spec['file'], spec['dtype']) if self.rows else np.empty(0, spec['dtype'])
+        return self._maps[key]
+
+    def _mask(self, indices, filters):
+        mask = np.ones(len(indices), dtype=bool)
+        for name, value in filters.items():
+            if name not in self._spec:
+                continue
+            values = self.raw(name)[indices]
+            if self._spec[name]['kind'] == 'dict':
+                vocab = self.meta['vocab'][name]
+                if str(value) not in vocab:
+                    return np.zeros(len(indices), dtype=bool)
+                mask &= values == vocab.index(str(value))
+            else:
+                mask &= values == float(value)
+        return mask
+
+    def query(self, filters=None, low=None, high=None, sort=None, position=0, limit=50,
+              columns=None, block_size=8192):
+        """صفحة من الصفوف المطابقة للمرشحات بدءاً من موضع في الترتيب المطلوب
+
+        يرجع (DataFrame, الموضع التالي أو None).
+        """
+        filters = filters or {}
+        if not self.rows:
+            # يشمل المخازن الفارغة المكتوبة قبل حفظ ترتيب فارغ لها
+            return pd.DataFrame(columns=columns or self.columns), None
+        order = self.order(sort) if sort else None
+        if sort and order is None:
+            raise ValueError(f"No precomputed order for {sort}")
+        probability = self.raw('fraud_probability') if (low is not None or high is not None) else None
+        end = self.rows
+        if sort == 'fraud_probability' and probability is not None:
+            # الترتيب تنازلي: البحث الثنائي يحدد نطاق المواضع داخل [low, high]
+            if high is not None:
+                position = max(position, self._bisect(order, probability, lambda v: v <= high))
+            if low is not None:
+                end = self._bisect(order, probability, lambda v: v < low)
+
+        found = []
+        count = 0
+        while position < end and count < limit:
+            stop = min(position + max(block_size, limit), end)
+            indices = np.asarray(order[position:stop]) if order is not None else np.arange(position, stop)
+            mask = self._mask(indices, filters)
+            if probability is not None:
+                values = probability[indices]
+                if low is not None:
+                    mask &= values >= low
+                if high is not None:
+                    mask &= values <= high
+            hits = np.flatnonzero(mask)[:limit - count]
+            if len(hits) and count + len(hits) == limit:
+                # الصفحة اكتملت: المؤشر التالي بعد آخر صف أُرجع
+                stop = position + hits[-1] + 1
+            found.append(indices[hits])
+            count += len(hits)
+            position = stop
+
+        indices = np.concatenate(found) if found else np.empty(0, dtype=np.int64)
+        next_position = position if position < end else None
+        return self.take(indices, columns), next_position
+
+    def _bisect(self, order, values, predicate):
+        """أول موضع في الترتيب تتحقق عنده predicate (القيم تنازلية)"""
+        lo, hi = 0, self.rows
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if predicate(values[order[mid]]):
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo
+
+    def probability_range(self, low=None, high=None, columns=None, column='fraud_probability'):
+        """الصفوف ضمن نطاق احتمال مع تخطي مجموعات الصفوف خارج النطاق حسب إحصائياتها"""
+        parts = []
+        for group in self.meta['row_groups']:
+            stats = group['stats'].get(column)
+            if stats is None:
+                continue
+            if (low is not None and stats['max'] < low) or (high is not None and stats['min'] > high):
+                continue
+            start = group['offset']
+            values = np.asarray(self.raw(column)[start:start + group['rows']])
+            mask = np.ones(len(values), dtype=bool)
+            if low is not None:
+                mask &= values >= low
+            if high is not None:
+                mask &= values <= high
+            parts.append(np.flatnonzero(mask) + start)
+        indices = np.concatenate(parts) if parts else np.empty(0, dtype=np.int64)
+        return self.take(indices, columns)
+
+
+class ArchivedResultStore(ResultStore):
+    """مخزن نتائج مضغوط في ملف zip واحد بنفس واجهة القراءة
+
+    العمود يُفك كاملاً إلى الذاكرة عند أول قراءة بدل memory-map، وهذا مقبول
+    للتجارب القديمة التي نادراً ما تُفتح.
+    """
+
+    def _read_json(self, name):
+        with zipfile.ZipFile(self.path) as archive:
+            return json.loads(archive.read(name))
+
+    def _has(self, name):
+        with zipfile.ZipFile(self.path) as archive:
+            return name in archive.namelist()
+
+    def _array(self, filename, dtype):
+        with zipfile.ZipFile(self.path) as archive:
+            return np.frombuffer(archive.read(filename), dtype=dtype)
+
+
+class CsvResults:
+    """نتائج قديمة محفوظة كـ CSV بنفس واجهة القراءة"""
+
+    def __init__(self, path):
+        self.path = path
+        self.columns = pd.read_csv(path, nrows=0).columns.tolist()
+        self._rows = None
+
+    def __len__(self):
+        if self._rows is None:
+            opener = gzip.open if self.path.endswith('.gz') else open
+            with opener(self.path, 'rb') as f:
+                self._rows = max(sum(1 for _ in f) - 1, 0)
+        return self._rows
+
+    def read(self, start=0, stop=None, columns=None):
+        nrows = None if stop is None else max(stop - start, 0)
+        return pd.read_csv(self.path, skiprows=range(1, start + 1), nrows=nrows, usecols=columns)
+
+    def page(self, page, page_size=50, columns=None):
+        return self.read(page * page_size, (page + 1) * page_size, columns)
+
+    def attachment(self, name):
+        return None
+
+    def take(self, indices, columns=None):
+        return self.read(columns=columns).iloc[np.asarray(indices, dtype=np.int64)].reset_index(drop=True)
+
+    def query(self, filters=None, low=None, high=None, sort=None, position=0, limit=50, columns=None):
+        # الملفات القديمة صغيرة (الصفوف المعروضة فقط) فتُصفّى في الذاكرة
+        df = self.read()
+        mask = pd.Series(True, index=df.index)
+        for name, value in (filters or {}).items():
+            if name not in df.columns:
+                continue
+            # المرشحات الرقمية (predicted_fraud) تُقارن كأرقام: "1" في الملف تساوي 1.0
+            if isinstance(value, (int, float, np.number)) and not isinstance(value, bool):
+                mask &= pd.to_numeric(df[name], errors='coerce') == value
+            else:
+                mask &= df[name].astype(str) == str(value)
+        if low is not None:
+            mask &= df['fraud_probability'] >= low
+        if high is not None:
+            mask &= df['fraud_probability'] <= high
+        df = df[mask]
+        if sort:
+            df = df.sort_values(sort, ascending=False, kind='stable')
+        page = df.iloc[position:position + limit]
+        next_position = position + limit if position + limit < len(df) else None
+        return page[columns or df.columns].reset_index(drop=True), next_position
+
+    def probability_range(self, low=None, high=None, columns=None, column='fraud_probability'):
+        df = self.read(columns=columns if columns is None or column in columns else columns + [column])
+        mask = pd.Series(True, index=df.index)
+        if low is not None:
+            mask &= df[column] >= low
+        if high is not None:
+            mask &= df[column] <= high
+        return df.loc[mask, columns or df.columns].reset_index(drop=True)
+
+
+def open_results(path):
+    """فتح نتائج تجربة سواء كانت بالتنسيق العمودي (مجلد أو أرشيف مضغوط) أو CSV قديم"""
+    if os.path.isdir(path):
+        return ResultStore(path)
+    if path.endswith(ARCHIVE_SUFFIX):
+        return ArchivedResultStore(path)
+    return CsvResults(path)
+
+
+def results_size(path):
+    """حجم نتائج تجربة على القرص بالبايت (مع نسخ التصدير داخل المجلد)"""
+    if not os.path.isdir(path):
+        return os.path.getsize(path) if os.path.exists(path) else 0
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def archive_results(path):
+    """ضغط نتائج تجربة في ملف واحد يبقى قابلاً للقراءة عبر open_results
+
+    المجلد العمودي يُضغط في zip (بدون نسخ التصدير)، وملف CSV القديم في gzip.
+    يرجع مسار الأرشيف؛ الأصل لا يُحذف هنا.
+    """
+    if os.path.isdir(path):
+        target = path + ARCHIVE_SUFFIX
+        tmp_path = f"{target}.tmp"
+        with zipfile.ZipFile(tmp_path, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+            for name in sorted(os.listdir(path)):
+                if os.path.isfile(os.path.join(path, name)):
+                    archive.write(os.path.join(path, name), name)
+    else:
+        target = path + '.gz'
+        tmp_path = f"{target}.tmp"
+        with open(path, 'rb') as src, gzip.open(tmp_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+    os.replace(tmp_path, target)
+    return target
+
+
+def records(df):
+    return df.replace({np.nan: None}).to_dict(orient="records")
@@ -0,0 +1,120 @@
+import numpy as np
+import pandas as pd
+
+# الأبعاد التي تُجمَّع عليها النتائج؛ hour تُشتق من transaction_date
+ROLLUP_DIMENSIONS = ['type', 'branch', 'device', 'location', 'currency', 'hour']
+# حدود فئات المبالغ (الفئة الأخيرة لكل ما يتجاوز آخر حد)
+AMOUNT_BUCKETS = (0, 100, 500, 1_000, 5_000, 10_000, 50_000, 100_000)
+# أقصى عدد قيم محفوظة لكل بُعد؛ الباقي يُجمع تحت OTHER_VALUE
+MAX_GROUPS_PER_DIMENSION = 50
+OTHER_VALUE = '__other__'
+UNKNOWN_VALUE = '__unknown__'
+
+# أعمدة إحصائيات كل مجموعة: العدد، الاحتيال، مجموع المبالغ، مجموع مبالغ الاحتيال، ثم المدرجان
+_COUNT, _FRAUD, _AMOUNT, _FRAUD_AMOUNT = range(4)
+_BINS = len(AMOUNT_BUCKETS) + 1
+_WIDTH = 4 + 2 * _BINS
+
+
+def _dimension_values(df, dimension):
+    if dimension == 'hour':
+        hours = pd.to_datetime(df['transaction_date'], errors='coerce').dt.hour
+        return hours.astype('Int64').astype(object).where(hours.notna(), None)
+    return df[dimension]
+
+
+class Rollup:
+    """تجميع نتائج التقييم في تمرير واحد (دفعة بدفعة) حسب عدة أبعاد
+
+    كل دفعة تُختزل بـ bincount إلى مصفوفة صغيرة لكل بُعد ثم تُدمج في
+    المجاميع، فلا تُقرأ النتائج الخام مرة أخرى.
+    """
+
+    def __init__(self, dimensions=ROLLUP_DIMENSIONS):
+        self.dimensions = list(dimensions)
+        self.totals = np.zeros(_WIDTH)
+        self.highest_fraud_amount = None
+        self.groups = {dimension: {} for dimension in self.dimensions}
+
+    def _batch_stats(self, codes, n_groups, fraud, amount, bucket):
+        stats = np.zeros((n_groups, _WIDTH))
+        stats[:, _COUNT] = np.bincount(codes, minlength=n_groups)
+        stats[:, _FRAUD] = np.bincount(codes, weights=fraud, minlength=n_groups)
+        stats[:, _AMOUNT] = np.bincount(codes, weights=amount, minlength=n_groups)
+        stats[:, _FRAUD_AMOUNT] = np.bincount(codes, weights=amount * fraud, minlength=n_groups)
+        cells = codes * _BINS + bucket
+        stats[:, 4:4 + _BINS] = np.bincount(cells, minlength=n_groups * _BINS).reshape(n_groups, _BINS)
+        stats[:, 4 + _BINS:] = np.bincount(cells, weights=fraud, minlength=n_groups * _BINS).reshape(n_groups, _BINS)
+        return stats
+
+    def add(self, df, preds):
+        """إضافة دفعة مقيَّمة (الأعمدة الخام مع التصنيفات بنفس الترتيب)"""
+        if len(df) == 0:
+            return
+        fraud = (np.asarray(preds) == 1).astype(np.float64)
+        amount = np.nan_to_num(pd.to_numeric(df['amount'], errors='coerce').to_numpy(dtype=np.float64))
+        bucket = np.searchsorted(AMOUNT_BUCKETS, amount, side='right')
+
+        self.totals += self._batch_stats(np.zeros(len(df), dtype=np.int64), 1, fraud, amount, bucket)[0]
+        if fraud.any():
+            highest = float(amount[fraud > 0].max())
+            if self.highest_fraud_amount is None or highest > self.highest_fraud_amount:
+                self.highest_fraud_amount = highest
+
+        for dimension in self.dimensions:
+            if dimension != 'hour' and dimension not in df.columns:
+                continue
+            codes, uniques = pd.factorize(_dimension_values(df, dimension), use_na_sentinel=True)
+            # القيم المفقودة (-1) تُجمع في مجموعة إضافية
+            codes = np.where(codes < 0, len(uniques), codes)
+            stats = self._batch_stats(codes, len(uniques) + 1, fraud, amount, bucket)
+            groups = self.groups[dimension]
+            for value, row in zip(list(uniques) + [UNKNOWN_VALUE], stats):
+                if row[_COUNT] == 0:
+                    continue
+                key = str(value)
+                if key in groups:
+                    groups[key] += row
+                else:
+                    groups[key] = row.copy()
+
+    def _most_common_fraud(self, dimension):
+        groups = self.groups.get(dimension) or {}
+        candidates = {value: row[_FRAUD] for value, row in groups.items() if row[_FRAUD] > 0}
+        return max(candidates, key=candidates.get) if candidates else None
+
+    @staticmethod
+    def _entry(row):
+        count, fraud = int(row[_COUNT]), int(row[_FRAUD])
+        return {
+            "count": count,
+            "fraud_count": fraud,
+            "fraud_rate": round(fraud / count * 100, 2) if count else 0.0,
+            "amount_sum": round(float(row[_AMOUNT]), 2),
+            "fraud_amount_sum": round(float(row[_FRAUD_AMOUNT]), 2),
+            "amount_histogram": row[4:4 + _BINS].astype(int).tolist(),
+            "fraud_amount_histogram": row[4 + _BINS:].astype(int).tolist(),
+        }
+
+    def to_dict(self, max_groups=MAX_GROUPS_PER_DIMENSION):
+        """الملخص المضغوط المحفوظ مع التجربة"""
+        dimensions = {}
+        for dimension, groups in self.groups.items():
+            if not groups:
+                continue
+            if dimension == 'hour':
+                # الساعات بترتيبها الزمني لرسم المنحنى مباشرة
+                ordered = sorted(groups.items(), key=lambda item: int(item[0]) if item[0].isdigit() else 24)
+            else:
+                ordered = sorted(groups.items(), key=lambda item: (-item[1][_COUNT], item[0]))
+            kept, rest = ordered[:max_groups], ordered[max_groups:]
+            if rest:
+                kept.append((OTHER_VALUE, np.sum([row for _, row in rest], axis=0)))
+            dimensions[dimension] = [{"value": value, **self._entry(row)} for value, row in kept]
+        return {
+            "amount_buckets": list(AMOUNT_BUCKETS),
+            "overall": self._entry(self.totals),
+            "highest_fraud_amount": self.highest_fraud_amount,
+            "most_common_type": self._most_common_fraud('type'),
+            "dimensions": dimensions,
+        }
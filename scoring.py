@@ -0,0 +1,366 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from explanations import ExplanationRun, explanation_cache
+from feature_engine import DERIVED_SIGNALS, FeatureState, derive_signals
+from ingestion import FORMAT_CSV, detect_format, feature_schema, metadata_rows
+from metrics import model_predict_rows, model_predict_seconds, stage, timed_iter, upload_rows
+from model_registry import file_sha256, model_registry
+from prediction_cache import prediction_cache
+from reputation import SEEN_SIGNALS, reputation_index
+from rollups import Rollup
+
+logger = logging.getLogger(__name__)
+
+# عدد الصفوف في كل دفعة عند القراءة المتدفقة
+STREAM_CHUNK_SIZE = 50_000
+# الملفات الأكبر من هذا الحجم تُقيَّم بالتدفق بدل قراءتها كاملة
+STREAM_THRESHOLD_BYTES = 50 * 1024 * 1024
+PREVIEW_ROWS = 50
+
+# التقييم المتوازي: عدد الأجزاء المتزامنة وعدد خيوط CatBoost لكل جزء
+SCORING_WORKERS = os.cpu_count() or 1
+SCORING_THREAD_COUNT = 1
+# الإطارات الأصغر من هذا تُقيَّم في استدعاء واحد
+PARALLEL_MIN_ROWS = 20_000
+
+required_columns = ['user_id',
+ 'transaction_date',
+ 'type',
+ 'amount',
+ 'old_balance',
+ 'new_balance',
+ 'balance_mismatch',
+ 'amount_spike',
+ 'destination_account',
+ 'new_destination',
+ 'blacklisted_dest',
+ 'source_account',
+ 'branch',
+ 'currency',
+ 'device',
+ 'device_change',
+ 'ip',
+ 'ip_unusual',
+ 'location',
+ 'odd_hour',
+ 'velocity']
+
+# أعلام يفرضها فهرس السمعة (القائمة السوداء للخادم)؛ تُعبَّأ إن لم يرسلها العميل
+REPUTATION_SIGNALS = ['blacklisted_dest']
+
+# الأعمدة التي يجب أن يرسلها العميل؛ الإشارات المشتقة تُحسب إن لم تُرسل
+raw_columns = [c for c in required_columns if c not in DERIVED_SIGNALS and c not in REPUTATION_SIGNALS]
+
+# دوال تحضير البيانات
+def prepare_data(df, state=None):
+    logger.debug("Original columns: %s", df.columns.tolist())
+
+    supplied = set(df.columns)
+    # حساب الإشارات الناقصة من المعاملات الخام (القيم المرسلة تبقى كما هي)
+    df = derive_signals(df, state)
+    df = apply_reputation(df, reputation_index, supplied)
+
+    missing = [c for c in required_columns if c not in df.columns]
+    if missing:
+        raise ValueError(f"Missing columns: {', '.join(missing)}")
+
+    # الأعمدة الخاصة بنماذج أخرى (hour, balance_diff, ...) تُشتق في LoadedModel.align
+
+    final_columns = ['user_id',
+ 'transaction_date',
+ 'type',
+ 'amount',
+ 'old_balance',
+ 'new_balance',
+ 'balance_mismatch',
+ 'amount_spike',
+ 'destination_account',
+ 'new_destination',
+ 'blacklisted_dest',
+ 'source_account',
+ 'branch',
+ 'currency',
+ 'device',
+ 'device_change',
+ 'ip',
+ 'ip_unusual',
+ 'location',
+ 'odd_hour',
+ 'velocity']
+
+    logger.debug("Final columns for model: %s", final_columns)
+    return df[final_columns]
+
+
+def apply_reputation(df, reputation, supplied=()):
+    """فرض القائمة السوداء وتصحيح إشارات "جديد" بما رآه الخادم في تجارب محفوظة
+
+    الكيان المحظور يرفع blacklisted_dest حتى لو أرسل العميل 0، والوجهة أو
+    IP الذي سبق ظهوره لنفس المستخدم يُنزل new_destination أو ip_unusual إذا
+    كانت الإشارة مشتقة هنا فقط؛ القيمة المرسلة من العميل (supplied) لا تُنزل.
+    """
+    if len(df) == 0:
+        return df
+    seen_kinds = [kind for kind, signal in SEEN_SIGNALS.items() if signal not in supplied]
+    flags = reputation.lookup(df, seen_kinds)
+    updates = {}
+    if 'blacklisted_dest' not in df.columns:
+        updates['blacklisted_dest'] = flags['blacklisted'].astype(np.int8)
+    elif flags['blacklisted'].any():
+        updates['blacklisted_dest'] = np.where(flags['blacklisted'], 1, df['blacklisted_dest'].to_numpy()).astype(np.int8)
+    for kind, signal in SEEN_SIGNALS.items():
+        seen = flags.get(f'seen_{kind}')
+        if seen is not None and signal in df.columns and seen.any():
+            updates[signal] = np.where(seen, 0, df[signal].to_numpy()).astype(np.int8)
+    return df.assign(**updates) if updates else df
+
+
+_executor = None
+_executor_lock = threading.Lock()
+# دوال تُستدعى بعد تقييم كل دفعة (مثل التقييم الظلي بنماذج أخرى)
+_batch_listeners = []
+
+
+def add_batch_listener(callback):
+    """تسجيل دالة تُستدعى بـ (prepared, loaded, probas, seconds) بعد كل دفعة"""
+    _batch_listeners.append(callback)
+
+
+def _get_executor():
+    # يُنشأ عند أول استخدام حتى لا تُورَّث خيوطه عبر fork
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=SCORING_WORKERS, thread_name_prefix="scoring")
+    return _executor
+
+
+def predict_probas(features, loaded, workers=None, thread_count=None):
+    """احتمال الاحتيال لكل صف مع تقسيم الإطار على عدة خيوط (CatBoost يحرر الـ GIL)"""
+    workers = workers or SCORING_WORKERS
+    thread_count = thread_count or SCORING_THREAD_COUNT
+    model = loaded.model
+
+    model_predict_rows.observe(len(features))
+
+    if workers <= 1 or len(features) < PARALLEL_MIN_ROWS:
+        with model_predict_seconds.time(model=loaded.name, model_version=loaded.version[:12]):
+            return model.predict_proba(features, thread_count=thread_count * workers)[:, 1]
+
+    bounds = np.linspace(0, len(features), workers + 1, dtype=int)
+    shards = [features.iloc[start:end] for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+    executor = _get_executor() if workers == SCORING_WORKERS else ThreadPoolExecutor(max_workers=workers)
+    try:
+        # map تحافظ على ترتيب الأجزاء
+        with model_predict_seconds.time(model=loaded.name, model_version=loaded.version[:12]):
+            parts = executor.map(lambda shard: model.predict_proba(shard, thread_count=thread_count, verbose=False)[:, 1], shards)
+            return np.concatenate(list(parts))
+    finally:
+        if executor is not _executor:
+            executor.shutdown(wait=False)
+
+
+def labels_from_probas(probas, loaded):
+    """التصنيف من نفس الاحتمالات بدل تمرير ثانٍ عبر النموذج (نفس عتبة predict)"""
+    return loaded.model.classes_[(probas > 0.5).astype(int)]
+
+
+def score_frame(df, loaded=None, workers=None, thread_count=None, state=None, explain=None):
+    """تقييم دفعة واحدة وإرجاع التصنيفات والاحتمالات
+
+    إذا مُرِّر explain (ExplanationRun) تُرسل الصفوف المشبوهة لحساب أسبابها.
+    """
+    loaded = loaded or model_registry.get()
+    started = time.perf_counter()
+    with stage('prepare'):
+        prepared = prepare_data(df, state)
+    with stage('align'):
+        features = loaded.align(prepared)
+    with stage('predict'):
+        start = time.perf_counter()
+        probas = predict_probas(features, loaded, workers, thread_count)
+        seconds = time.perf_counter() - start
+        preds = labels_from_probas(probas, loaded)
+    if explain is not None:
+        explain.add(features, probas, loaded, time.perf_counter() - started)
+    for callback in _batch_listeners:
+        callback(prepared, loaded, probas, seconds)
+    return preds, probas
+
+
+def should_stream(path):
+    return os.path.getsize(path) > STREAM_THRESHOLD_BYTES
+
+
+def _preview_records(df, preds, probas):
+    df = df.assign(
+        predicted_fraud=preds[:len(df)],
+        fraud_probability=np.round(probas[:len(df)] * 100, 2)
+    )
+    return df.replace({np.nan: None}).to_dict(orient="records")
+
+
+def _finish_explanations(explain, preview, store):
+    """انتظار الشروح وإضافتها لصفوف المعاينة وحفظها مع النتائج"""
+    with stage('explain_wait'):
+        explanations = explain.finish()
+    for row, record in enumerate(preview):
+        if row in explanations:
+            record['explanation'] = explanations[row]
+    if store is not None:
+        store.attach('explanations', {str(row): explanation for row, explanation in explanations.items()})
+    return explain.summary()
+
+
+def _rollup_fields(rollup):
+    """التجميعات حسب الأبعاد مع أبرز قيمها في أعلى الاستجابة"""
+    summary = rollup.to_dict()
+    return {
+        "highest_fraud_amount": summary['highest_fraud_amount'],
+        "most_common_type": summary['most_common_type'],
+        "rollup": summary,
+    }
+
+
+def score_streaming(path, chunk_size=STREAM_CHUNK_SIZE, preview_rows=PREVIEW_ROWS, progress=None, store=None,
+                    loaded=None):
+    """تقييم ملف على دفعات بحيث تعتمد الذاكرة على حجم الدفعة لا حجم الملف"""
+    # نفس نسخة النموذج لكامل الملف حتى لو تغيّر أثناء المعالجة
+    loaded = loaded or model_registry.get()
+    total_count = 0
+    fraud_count = 0
+    preview = []
+    # تاريخ المستخدمين ينتقل بين الدفعات حتى تطابق الإشارات المشتقة قراءة الملف كاملاً
+    state = FeatureState()
+    explain = ExplanationRun()
+    rollup = Rollup()
+
+    chunks = feature_schema.read(path, required=raw_columns, chunksize=chunk_size)
+    for chunk in timed_iter(chunks, 'parse'):
+        preds, probas = score_frame(chunk, loaded, state=state, explain=explain)
+        with stage('rollup'):
+            rollup.add(chunk, preds)
+        total_count += len(chunk)
+        fraud_count += int((preds == 1).sum())
+
+        if len(preview) < preview_rows:
+            preview.extend(_preview_records(chunk.head(preview_rows - len(preview)), preds, probas))
+
+        if store is not None:
+            with stage('store'):
+                store.append(chunk.assign(predicted_fraud=preds, fraud_probability=np.round(probas * 100, 2)))
+
+        if progress:
+            progress(total_count)
+
+    return {
+        "total_count": total_count,
+        "fraud_count": fraud_count,
+        "fraud_rate": round(fraud_count / total_count * 100, 2) if total_count else 0.0,
+        "data": preview,
+        "explanations": _finish_explanations(explain, preview, store),
+        **_rollup_fields(rollup),
+    }
+
+
+def score_file(path, stream=None, progress=None, store=None, loaded=None):
+    """تقييم ملف مرفوع (CSV عادي أو مضغوط، Excel، Parquet، Arrow) وإرجاع الإحصائيات وأول الصفوف
+
+    إذا مُرِّر store (ResultStoreWriter) تُكتب فيه كل الصفوف المقيَّمة.
+    """
+    logger.debug("📂 Processing file: %s", path)
+    if stream is None:
+        stream = should_stream(path)
+
+    if stream:
+        # الملفات الكبيرة تُقرأ وتُقيَّم على دفعات
+        logger.debug("🌊 Scoring file in streaming mode")
+        return score_streaming(path, progress=progress, store=store, loaded=loaded)
+
+    # قراءة بأنواع صريحة من features.json بعد التحقق من الترويسة
+    with stage('parse'):
+        df = feature_schema.read(path, required=raw_columns)
+
+    logger.debug("✅ File loaded successfully with %d rows", len(df))
+
+    loaded = loaded or model_registry.get()
+    logger.debug("🤖 Using model version %s", loaded.version[:12])
+
+    # تمرير واحد عبر النموذج موزع على الأنوية
+    explain = ExplanationRun()
+    preds, probas = score_frame(df, loaded, explain=explain)
+    fraud_count = int((preds == 1).sum())
+    rollup = Rollup()
+    with stage('rollup'):
+        rollup.add(df, preds)
+
+    if progress:
+        progress(len(df))
+
+    if store is not None:
+        with stage('store'):
+            store.append(df.assign(predicted_fraud=preds, fraud_probability=np.round(probas * 100, 2)))
+
+    preview = _preview_records(df.head(PREVIEW_ROWS), preds, probas)
+    return {
+        "total_count": len(df),
+        "fraud_count": fraud_count,
+        "fraud_rate": round(fraud_count / len(df) * 100, 2) if len(df) else 0.0,
+        "data": preview,
+        "explanations": _finish_explanations(explain, preview, store),
+        **_rollup_fields(rollup),
+    }
+
+
+def score_upload(path, stream=None, progress=None, store=None):
+    """تقييم ملف مرفوع مع إعادة استخدام النتيجة إذا سبق تقييم نفس المحتوى بنفس النموذج"""
+    loaded = model_registry.get()
+    with stage('hash'):
+        content_hash = file_sha256(path)
+    # النتيجة تعتمد على النموذج وعلى القائمة السوداء (ما سبق رؤيته خارج المفتاح)
+    version = f"{loaded.version}:{reputation_index.version}"
+    cached = prediction_cache.get(content_hash, version, need_store=store is not None)
+    if cached is not None:
+        result, store_path = cached
+        logger.debug("⚡ Cache hit for %s", content_hash[:12])
+        if store is not None:
+            store.adopt(store_path)
+        if progress:
+            progress(result['total_count'])
+        return result
+
+    result = score_file(path, stream=stream, progress=progress, store=store, loaded=loaded)
+    upload_rows.observe(result['total_count'])
+    prediction_cache.put(content_hash, version, result, store.path if store is not None else None)
+    return result
+
+
+def estimate_rows(path, sample_bytes=1 << 16):
+    """عدد الصفوف من بيانات Parquet/Arrow الوصفية، أو تقديره لـ CSV من متوسط طول السطر"""
+    try:
+        file_format = detect_format(path)
+    except ValueError:
+        return None
+    if file_format != FORMAT_CSV:
+        return metadata_rows(path, file_format)
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        sample = f.read(sample_bytes)
+    lines = sample.count(b'\n')
+    if len(sample) == size:
+        return max(lines - 1, 0)
+    return int(size / (len(sample) / lines)) - 1 if lines else None
+
+
+# أي تغيير في ملف النموذج يُبطل النتائج المحفوظة
+model_registry.add_listener(prediction_cache.on_model_reload)
+model_registry.add_listener(explanation_cache.on_model_reload)
+# وكذلك تغيير القائمة السوداء (نسخة الفهرس في المفتاح، والنتائج القديمة لن تُطلب بعد الآن)
+reputation_index.add_listener(lambda index: prediction_cache.clear())
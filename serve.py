@@ -0,0 +1,121 @@
+"""تشغيل الخادم للإنتاج بعدة عمليات تتشارك نسخة واحدة من النماذج
+
+python serve.py --workers 4 --threads 8
+
+العملية الرئيسية تحمّل النماذج وfeatures.json وتجهّز قاعدة البيانات مرة
+واحدة، ثم تنسخ العمال بـ fork فتتشارك صفحات الذاكرة (copy-on-write) بدل
+تحميل نسخة من النموذج في كل عامل. العمال لا يُستبدلون بعد عدد من الطلبات
+(لا يوجد max_requests) لأن مهام الخلفية (JobManager) تعمل داخلهم وتنقطع مع
+العامل. تغيير ملف النموذج يُحمَّل في كل عامل على حدة؛ لإعادة مشاركته يُعاد
+تشغيل الخادم.
+
+app.run في app.py يبقى لخادم التطوير فقط.
+"""
+import argparse
+import gc
+import logging
+import os
+
+from gunicorn.app.base import BaseApplication
+
+SERVE_BIND = os.environ.get('SERVE_BIND', '0.0.0.0:5000')
+SERVE_WORKERS = int(os.environ.get('SERVE_WORKERS', os.cpu_count() or 1))
+# خيوط كل عامل للطلبات المتزامنة (رفع الملفات وانتظار قاعدة البيانات)
+SERVE_THREADS = int(os.environ.get('SERVE_THREADS', 4))
+# /predict يقيّم الملف داخل الطلب، لذا المهلة أطول من الافتراضي
+SERVE_TIMEOUT_SECONDS = int(os.environ.get('SERVE_TIMEOUT_SECONDS', 300))
+# مهلة إنهاء الطلبات الجارية عند الاستبدال أو الإيقاف
+SERVE_GRACEFUL_TIMEOUT_SECONDS = int(os.environ.get('SERVE_GRACEFUL_TIMEOUT_SECONDS', 60))
+
+logger = logging.getLogger(__name__)
+
+
+def preload():
+    """كل ما يُحمَّل مرة واحدة في العملية الرئيسية قبل fork"""
+    from app import app, migrate_experiments_table
+    from config import db_pool
+    from model_set import model_set
+    from reputation import reputation_index
+    from static_assets import static_assets
+
+    # كل النماذج تُحمَّل هنا (التوجيه لا يحمّل نموذجاً داخل طلب)
+    model_set.load()
+    migrate_experiments_table()
+    # الصفحات تُضغط مرة واحدة هنا وتتشاركها العمال
+    static_assets.load()
+    # القائمة السوداء وما سبق رؤيته تُحمَّل مرة واحدة وتتشاركها العمال حتى أول تعديل
+    reputation_index.load()
+    # اتصالات العملية الرئيسية لا تُورَّث للعمال
+    db_pool.close_idle()
+    return app
+
+
+def when_ready(server):
+    # نقل كائنات التحميل إلى جيل دائم لا يفحصه الـ GC، فلا تُنسخ صفحاتها في العمال
+    gc.collect()
+    gc.freeze()
+    logger.info("Frozen %d objects before forking workers", gc.get_freeze_count())
+
+
+def post_fork(server, worker):
+    import scoring
+
+    # أنوية الجهاز تُقسم على العمال بدل أن يفتح كل عامل خيطاً لكل نواة
+    scoring.SCORING_WORKERS = max(1, (os.cpu_count() or 1) // server.cfg.workers)
+
+
+def post_worker_init(worker):
+    from maintenance import storage_maintenance
+
+    # أول عامل فقط يستأنف المهام المنقطعة حتى لا تُعاد جدولتها مرة لكل عامل
+    if worker.age == 1:
+        from app import job_manager
+        job_manager.recover()
+    # كل عامل يشغّل خيط الصيانة وقفل الملف يختار واحداً في كل دورة (يستمر بعد استبدال العمال)
+    storage_maintenance.start()
+
+
+def worker_exit(server, worker):
+    logger.info("Worker %s exited after %s requests", worker.pid, getattr(worker, 'nr', '?'))
+
+
+class FraudServer(BaseApplication):
+    def __init__(self, options):
+        self.options = options
+        self.application = preload()
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.application
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bind', default=SERVE_BIND)
+    parser.add_argument('--workers', type=int, default=SERVE_WORKERS)
+    parser.add_argument('--threads', type=int, default=SERVE_THREADS)
+    parser.add_argument('--timeout', type=int, default=SERVE_TIMEOUT_SECONDS)
+    parser.add_argument('--graceful-timeout', type=int, default=SERVE_GRACEFUL_TIMEOUT_SECONDS)
+    args = parser.parse_args()
+
+    FraudServer({
+        'bind': args.bind,
+        'workers': args.workers,
+        'worker_class': 'gthread',
+        'threads': args.threads,
+        'timeout': args.timeout,
+        'graceful_timeout': args.graceful_timeout,
+        'preload_app': True,
+        'when_ready': when_ready,
+        'post_fork': post_fork,
+        'post_worker_init': post_worker_init,
+        'worker_exit': worker_exit,
+    }).run()
+
+
+if __name__ == '__main__':
+    main()
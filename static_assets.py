@@ -0,0 +1,219 @@
+"""خدمة الصفحات والأصول الثابتة من الذاكرة مضغوطة مسبقاً
+
+كل ملف يُقرأ مرة واحدة ويُضغط بـ gzip وbrotli (إن وُجدت المكتبة) ثم يُرسل
+النسخة التي يقبلها المتصفح مع ETag وCache-Control، وطلبات التحقق المشروطة
+تُجاب بـ 304 بدون جسم. الصفحات العامة (الرئيسية، الدخول، التسجيل) والأصول
+غير HTML تُخدم من StaticAssetMiddleware قبل Flask، فلا تُفك الجلسة ولا تعمل
+before_request. باقي الصفحات تمر بالتحقق في Flask ثم تُرسل بـ send_asset.
+"""
+import gzip
+import hashlib
+import logging
+import os
+import threading
+import time
+from email.utils import formatdate, parsedate_to_datetime
+
+from werkzeug.security import safe_join
+
+from metrics import http_request_seconds
+
+try:
+    import brotli
+except ImportError:
+    # brotli اختياري؛ بدونه تُرسل نسخة gzip فقط
+    brotli = None
+
+STATIC_ROOT = "."
+# أنواع الملفات التي تُخدم كأصول ثابتة (ملفات الكود وقاعدة البيانات والنماذج لا تُخدم من هنا)
+ASSET_TYPES = {
+    '.html': 'text/html; charset=utf-8',
+    '.css': 'text/css; charset=utf-8',
+    '.js': 'text/javascript; charset=utf-8',
+    '.svg': 'image/svg+xml',
+    '.png': 'image/png',
+    '.jpg': 'image/jpeg',
+    '.ico': 'image/x-icon',
+    '.woff2': 'font/woff2',
+}
+# الأنواع النصية التي تستفيد من الضغط
+COMPRESSIBLE_TYPES = ('.html', '.css', '.js', '.svg')
+# الصفحات المتاحة بدون تسجيل دخول: المسار ← الملف
+PUBLIC_PAGES = {
+    '/': 'home.html',
+    '/home.html': 'home.html',
+    '/login': 'login.html',
+    '/login.html': 'login.html',
+    '/register': 'register.html',
+    '/register.html': 'register.html',
+}
+# أسماء HTML ثابتة (بدون بصمة) فيُعاد التحقق منها كل مرة، وهذا يكلف 304 فقط
+HTML_CACHE_CONTROL = 'no-cache'
+ASSET_CACHE_CONTROL = 'public, max-age=3600'
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 11
+# أقل فترة بين فحص الملف على القرص حتى تظهر التعديلات بدون إعادة تشغيل
+ASSET_CHECK_SECONDS = 2.0
+
+logger = logging.getLogger(__name__)
+
+
+def _accepted_encodings(header):
+    """الترميزات المقبولة من Accept-Encoding (مع استبعاد q=0)"""
+    accepted = set()
+    for part in (header or '').split(','):
+        token, _, params = part.partition(';')
+        params = params.strip().replace(' ', '')
+        if params.startswith('q='):
+            try:
+                if float(params[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        if token.strip():
+            accepted.add(token.strip().lower())
+    return accepted
+
+
+class Asset:
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        stat = os.stat(path)
+        self.mtime, self.size = stat.st_mtime, stat.st_size
+        self.checked = time.monotonic()
+        extension = os.path.splitext(name)[1].lower()
+        self.mimetype = ASSET_TYPES[extension]
+        self.cache_control = HTML_CACHE_CONTROL if extension == '.html' else ASSET_CACHE_CONTROL
+        self.last_modified = formatdate(int(self.mtime), usegmt=True)
+
+        with open(path, 'rb') as f:
+            body = f.read()
+        self.etag = hashlib.sha256(body).hexdigest()[:20]
+        self.variants = {'identity': body}
+        if extension in COMPRESSIBLE_TYPES:
+            compressed = {'gzip': gzip.compress(body, GZIP_LEVEL, mtime=0)}
+            if brotli is not None:
+                compressed['br'] = brotli.compress(body, quality=BROTLI_QUALITY)
+            # تُحفظ النسخة المضغوطة فقط إذا كانت أصغر فعلاً
+            self.variants.update({encoding: data for encoding, data in compressed.items() if len(data) < len(body)})
+
+    def changed(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return True
+        return (stat.st_mtime, stat.st_size) != (self.mtime, self.size)
+
+    def select(self, accept_encoding):
+        accepted = _accepted_encodings(accept_encoding)
+        for encoding in ('br', 'gzip'):
+            if encoding in self.variants and (encoding in accepted or '*' in accepted):
+                return encoding
+        return 'identity'
+
+    def not_modified(self, environ):
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+        if if_none_match:
+            if if_none_match.strip() == '*':
+                return True
+            # أي نسخة من نفس المحتوى تكفي (المتصفح قد يغير الترميز المطلوب)
+            tags = {tag.strip().removeprefix('W/').strip('"').split('-')[0] for tag in if_none_match.split(',')}
+            return self.etag in tags
+        if_modified_since = environ.get('HTTP_IF_MODIFIED_SINCE')
+        if if_modified_since:
+            try:
+                return int(self.mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def respond(self, environ):
+        """(الحالة، الترويسات، الجسم) لهذا الطلب"""
+        encoding = self.select(environ.get('HTTP_ACCEPT_ENCODING'))
+        etag = self.etag if encoding == 'identity' else f"{self.etag}-{encoding}"
+        headers = [
+            ('ETag', f'"{etag}"'),
+            ('Cache-Control', self.cache_control),
+            ('Last-Modified', self.last_modified),
+            ('Vary', 'Accept-Encoding'),
+        ]
+        if self.not_modified(environ):
+            return '304 Not Modified', headers, b''
+        body = self.variants[encoding]
+        headers += [('Content-Type', self.mimetype), ('Content-Length', str(len(body)))]
+        if encoding != 'identity':
+            headers.append(('Content-Encoding', encoding))
+        return '200 OK', headers, body
+
+
+class AssetCache:
+    """الأصول المحمّلة في الذاكرة حسب اسم الملف، مع إعادة التحميل عند تعديله"""
+
+    def __init__(self, root=STATIC_ROOT):
+        self.root = root
+        self._assets = {}
+        self._lock = threading.Lock()
+
+    def load(self):
+        """تحميل وضغط كل الأصول مرة واحدة (عند الإقلاع قبل fork)"""
+        for name in sorted(os.listdir(self.root)):
+            if os.path.splitext(name)[1].lower() in ASSET_TYPES and os.path.isfile(os.path.join(self.root, name)):
+                self.get(name)
+        logger.info("Loaded %d static assets (brotli %s)", len(self._assets),
+                    'enabled' if brotli is not None else 'unavailable')
+
+    def get(self, name):
+        """الأصل باسم الملف أو None إذا لم يكن أصلاً ثابتاً"""
+        if os.path.splitext(name)[1].lower() not in ASSET_TYPES:
+            return None
+        asset = self._assets.get(name)
+        if asset is not None:
+            if time.monotonic() - asset.checked < ASSET_CHECK_SECONDS:
+                return asset
+            asset.checked = time.monotonic()
+            if not asset.changed():
+                return asset
+
+        path = safe_join(self.root, name)
+        if path is None or not os.path.isfile(path):
+            with self._lock:
+                self._assets.pop(name, None)
+            return None
+        asset = Asset(name, path)
+        with self._lock:
+            self._assets[name] = asset
+        return asset
+
+    def public_name(self, path):
+        """اسم الأصل إذا كان المسار عاماً (صفحة عامة أو أصل غير HTML)"""
+        if path in PUBLIC_PAGES:
+            return PUBLIC_PAGES[path]
+        extension = os.path.splitext(path)[1].lower()
+        if extension in ASSET_TYPES and extension != '.html':
+            return path.lstrip('/')
+        return None
+
+
+class StaticAssetMiddleware:
+    """خدمة الأصول العامة على مستوى WSGI قبل Flask (بدون جلسة أو before_request)"""
+
+    def __init__(self, app, assets):
+        self.app = app
+        self.assets = assets
+
+    def __call__(self, environ, start_response):
+        if environ.get('REQUEST_METHOD') in ('GET', 'HEAD'):
+            name = self.assets.public_name(environ.get('PATH_INFO', ''))
+            asset = self.assets.get(name) if name else None
+            if asset is not None:
+                started = time.perf_counter()
+                status, headers, body = asset.respond(environ)
+                start_response(status, headers)
+                http_request_seconds.observe(time.perf_counter() - started, endpoint='static_asset',
+                                             method=environ['REQUEST_METHOD'], status=status.split()[0])
+                return [] if environ['REQUEST_METHOD'] == 'HEAD' else [body]
+        return self.app(environ, start_response)
+
+
+static_assets = AssetCache()